@@ -0,0 +1,75 @@
+import contextlib
+import contextvars
+import ssl
+
+import aiohttp
+import certifi
+from aiogram.utils import json
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+_lane = contextvars.ContextVar('bot_api_lane', default=INTERACTIVE)
+
+
+def current_lane():
+    return _lane.get()
+
+
+@contextlib.contextmanager
+def bulk_requests():
+    """Запросы к Bot API внутри блока (и в созданных в нём задачах) идут по полосе bulk"""
+    token = _lane.set(BULK)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class ApiSessions:
+    """Сессии aiohttp для Bot API, по одной на полосу со своим пулом соединений.
+
+    Ответы пользователям (interactive) и массовые отправки (bulk) не делят
+    сокеты: рассылка, занявшая весь свой пул, ждёт только своих соединений.
+    Соединения держатся keep-alive, DNS-ответы кэшируются на dns_ttl секунд.
+    """
+
+    def __init__(self, limits, keepalive=30, dns_ttl=300, connect_timeout=10, total_timeout=60):
+        self.limits = dict(limits)
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        # sock_connect, а не connect: ожидание свободного соединения в пуле — не ошибка сети
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout)
+        self._ssl = ssl.create_default_context(cafile=certifi.where())
+        self._sessions = {}
+
+    def get(self, lane):
+        """Сессия полосы lane; создаётся при первом запросе внутри event loop"""
+        session = self._sessions.get(lane)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limits[lane],
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive,
+                ssl=self._ssl
+            )
+            session = self._sessions[lane] = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout, json_serialize=json.dumps)
+        return session
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+    def stats(self):
+        result = {}
+        for lane, limit in self.limits.items():
+            session = self._sessions.get(lane)
+            connector = session.connector if session is not None and not session.closed else None
+            result[lane] = {
+                'limit': limit,
+                'in_use': len(connector._acquired) if connector is not None else 0,
+                'idle': sum(len(conns) for conns in connector._conns.values()) if connector is not None else 0
+            }
+        return result
@@ -0,0 +1,104 @@
+"""Бенчмарк регистрации пользователя (/start) в зависимости от размера таблицы users.
+
+Сравнивает текущий Storage.add_user (один UPSERT, счётчик на триггере) со
+старой схемой: SELECT + UPDATE/INSERT + COUNT(*) по пользователю и по всей
+таблице. Запуск:
+
+    python benchmarks/bench_add_user.py --sizes 1000 100000 1000000 --calls 2000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage  # noqa: E402
+
+
+def legacy_add_user(db_path, user_id, username, first_name, last_name, language_code):
+    """Копия прежнего add_user из bot.py: новое соединение и четыре запроса"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
+    if c.fetchone():
+        c.execute('UPDATE users SET last_activity = ?, username = ?, first_name = ?, last_name = ? WHERE user_id = ?',
+                  (datetime.now(), username, first_name, last_name, user_id))
+    else:
+        c.execute('''INSERT INTO users
+                     (user_id, username, first_name, last_name, language_code, joined_at, last_activity)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  (user_id, username, first_name, last_name, language_code, datetime.now(), datetime.now()))
+    conn.commit()
+    c.execute('SELECT COUNT(*) FROM users WHERE user_id = ?', (user_id,))
+    c.fetchone()
+    c.execute('SELECT COUNT(*) FROM users')
+    c.fetchone()
+    conn.close()
+
+
+def populate(db_path, size):
+    conn = sqlite3.connect(db_path)
+    now = int(time.time())
+    with conn:
+        conn.executemany('''INSERT INTO users
+                            (user_id, username, first_name, last_name, language_code, joined_at, last_activity)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         ((i, f"user{i}", "Имя", "Фамилия", "ru", now, now) for i in range(1, size + 1)))
+    conn.close()
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def run_size(size, calls):
+    tmp = tempfile.mkdtemp()
+    db_path = os.path.join(tmp, "bench.db")
+    storage = Storage(db_path)
+    storage.init_db()
+    populate(db_path, size)
+
+    # Половина вызовов — существующие пользователи, половина — новые
+    ids = [random.randint(1, size) if i % 2 else size + i + 1 for i in range(calls)]
+
+    current = []
+    for user_id in ids:
+        started = time.perf_counter()
+        await storage.add_user(user_id, "name", "Имя", "Фамилия", "ru")
+        current.append(time.perf_counter() - started)
+    await storage.close()
+
+    legacy = []
+    for user_id in ids:
+        user_id += calls * 2
+        started = time.perf_counter()
+        legacy_add_user(db_path, user_id, "name", "Имя", "Фамилия", "ru")
+        legacy.append(time.perf_counter() - started)
+    return current, legacy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--calls", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"{'rows':>10} | {'upsert p50 ms':>13} | {'upsert p99 ms':>13} | {'legacy p50 ms':>13} | {'legacy p99 ms':>13}")
+    for size in args.sizes:
+        current, legacy = asyncio.run(run_size(size, args.calls))
+        print(f"{size:>10} | {statistics.median(current) * 1000:>13.3f} | {percentile(current, 0.99) * 1000:>13.3f} | "
+              f"{statistics.median(legacy) * 1000:>13.3f} | {percentile(legacy, 0.99) * 1000:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Бенчмарк выбора обработчика нажатия inline-кнопки.
+
+Сравнивает прежнюю схему — цепочку callback_query_handler с lambda-фильтрами
+и if/elif по callback.data.split("_")[1] в общем админском обработчике — с
+CallbackRouter: один обработчик aiogram и словарь маршрутов по префиксу.
+Оба варианта регистрируются в настоящем Dispatcher с пустыми обработчиками,
+так что измеряется только путь от notify() до вызова нужной функции.
+Для роутера отдельно замеряются кнопки старого формата (перевод через
+upgrade_legacy). Запуск:
+
+    python benchmarks/bench_callbacks.py --iterations 20000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import CallbackQuery, User
+
+from callbacks import ADMIN, BROADCAST_CONTROL, SUBSCRIPTION, CallbackRouter, upgrade_legacy
+
+TOKEN = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENC"
+# Кнопки в порядке фильтров прежней схемы: чем дальше обработчик, тем больше проверок
+LEGACY_BUTTONS = ['check_subscription', 'admin_list_users', 'admin_broadcast', 'admin_stats',
+                  'admin_back', 'admin_channel_settings', 'bcast_pause_42']
+
+
+def legacy_dispatcher(dp, hits):
+    """Обработчики и фильтры в том виде, в каком они были в bot.py"""
+    @dp.callback_query_handler(lambda c: c.data == "check_subscription")
+    async def process_subscription(callback):
+        hits.append('sub')
+
+    @dp.callback_query_handler(lambda c: c.data == "admin_list_users")
+    async def process_list_users(callback):
+        hits.append('list_users')
+
+    @dp.callback_query_handler(lambda c: c.data == "admin_broadcast")
+    async def process_broadcast_callback(callback):
+        hits.append('broadcast')
+
+    @dp.callback_query_handler(lambda c: c.data.startswith("admin_") and c.data not in ["admin_list_users", "admin_broadcast"])
+    async def process_admin_callback(callback):
+        action = callback.data.split("_")[1]
+        if action == "stats":
+            hits.append(action)
+        elif action == "broadcast":
+            hits.append(action)
+        elif action == "users":
+            hits.append(action)
+        elif action == "settings":
+            hits.append(action)
+        elif action == "back":
+            hits.append(action)
+
+    @dp.callback_query_handler(lambda c: c.data.startswith("bcast_"))
+    async def process_broadcast_control(callback):
+        _, action, job_id = callback.data.split("_")
+        hits.append(action)
+
+
+def router_dispatcher(dp, hits):
+    """То же через CallbackRouter, как в нынешнем bot.py"""
+    router = CallbackRouter(legacy=upgrade_legacy)
+    dp.register_callback_query_handler(router.dispatch)
+
+    async def show(callback):
+        hits.append('screen')
+
+    screens = {'stats': show, 'broadcast': show, 'users': show, 'list_users': show,
+               'settings': show, 'back': show}
+
+    @router.route(SUBSCRIPTION)
+    async def process_subscription(callback):
+        hits.append('sub')
+
+    @router.route(ADMIN)
+    async def process_admin_callback(callback, screen):
+        show_screen = screens.get(screen)
+        if show_screen is None:
+            hits.append('missing')
+            return
+        await show_screen(callback)
+
+    @router.route(BROADCAST_CONTROL)
+    async def process_broadcast_control(callback, action, job_id):
+        hits.append(action)
+
+
+def make_callback(data):
+    return CallbackQuery(**{"id": "1", "chat_instance": "1", "data": data,
+                            "from": {"id": 1, "is_bot": False, "first_name": "U"}})
+
+
+async def measure(dp, buttons, iterations):
+    """Среднее время notify() на одно нажатие по каждой кнопке, мкс"""
+    result = {}
+    for data in buttons:
+        callback = make_callback(data)
+        # Фильтр состояния FSM, который aiogram добавляет к каждому обработчику, берёт пользователя из контекста
+        User.set_current(callback.from_user)
+        for _ in range(min(1000, iterations)):
+            await dp.callback_query_handlers.notify(callback)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await dp.callback_query_handlers.notify(callback)
+        result[data] = (time.perf_counter() - start) / iterations * 1e6
+    return result
+
+
+async def main(args):
+    bot = Bot(token=TOKEN)
+    Bot.set_current(bot)
+    hits = []
+    legacy = Dispatcher(bot)
+    legacy_dispatcher(legacy, hits)
+    routed = Dispatcher(bot)
+    router_dispatcher(routed, hits)
+    Dispatcher.set_current(routed)
+
+    legacy_times = await measure(legacy, LEGACY_BUTTONS, args.iterations)
+    upgraded_times = await measure(routed, LEGACY_BUTTONS, args.iterations)
+    current_times = await measure(routed, [upgrade_legacy(data) for data in LEGACY_BUTTONS], args.iterations)
+
+    print(f"{'кнопка':<24} {'фильтры':>10} {'роутер':>10} {'роутер, старый формат':>22}   (мкс на нажатие)")
+    for data in LEGACY_BUTTONS:
+        print(f"{data:<24} {legacy_times[data]:>10.2f} {current_times[upgrade_legacy(data)]:>10.2f} "
+              f"{upgraded_times[data]:>22.2f}")
+    total = {name: sum(times.values()) / len(times)
+             for name, times in (('фильтры', legacy_times), ('роутер', current_times),
+                                 ('роутер, старый формат', upgraded_times))}
+    print(f"{'в среднем':<24} {total['фильтры']:>10.2f} {total['роутер']:>10.2f} {total['роутер, старый формат']:>22.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000, help='нажатий на каждую кнопку')
+    asyncio.run(main(parser.parse_args()))
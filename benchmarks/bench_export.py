@@ -0,0 +1,134 @@
+"""Бенчмарк выгрузки /export на большой базе.
+
+Заполняет временную БД синтетическими пользователями и событиями stats и
+выгружает каждую таблицу в CSV и JSONL через Storage.export_table. Для
+сравнения та же выгрузка делается «в лоб»: fetchall() и сжатие всей строки
+в памяти. Для каждого варианта выводится время, размер архива, пик памяти
+Python (tracemalloc, отдельным проходом) и то, что видит остальной бот во время выгрузки:
+максимальная задержка event loop и самое долгое чтение через пул читателей.
+Запуск:
+
+    python benchmarks/bench_export.py --users 1000000 --events 3000000
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from export import TABLES
+from storage import Storage
+
+ACTIONS = ['start', 'check_subscription']
+
+
+def fill(db, users, events, seed):
+    """Пользователи и события за последний год, вставка одной транзакцией"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    conn = db._connect()
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, username, first_name, last_name, language_code, joined_at, '
+            'last_activity, is_subscribed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((user_id, f"user_{user_id}", "Иван", "Петров" if user_id % 3 else None, 'ru',
+              now - rng.randrange(365 * 86400), now - rng.randrange(86400), user_id % 2)
+             for user_id in range(1, users + 1)))
+        conn.executemany(
+            'INSERT INTO stats (user_id, action, timestamp) VALUES (?, ?, ?)',
+            ((rng.randrange(1, users + 1), ACTIONS[i % 2], now - rng.randrange(365 * 86400))
+             for i in range(events)))
+    conn.close()
+
+
+def naive_export(c, table, fmt):
+    """Выгрузка без порций: все строки и весь текст в памяти, затем сжатие"""
+    columns = TABLES[table]
+    rows = c.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {columns[0]}").fetchall()
+    out = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+    return io.BytesIO(gzip.compress(out.getvalue().encode(), 6)), len(rows)
+
+
+async def observe(db, stop):
+    """Максимальная задержка event loop и самое долгое чтение из пула читателей, мс"""
+    max_lag = max_read = 0.0
+    interval = 0.01
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - start - interval)
+        start = time.perf_counter()
+        await db.count_users()
+        max_read = max(max_read, time.perf_counter() - start)
+    return max_lag * 1000, max_read * 1000
+
+
+async def run(db, label, export):
+    # Первый проход — время и влияние на бота, второй — память: tracemalloc сильно замедляет Python-код
+    stop = asyncio.Event()
+    observer = asyncio.create_task(observe(db, stop))
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    spool, rows = await export()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    lag, read = await observer
+    with spool:
+        size = spool.seek(0, os.SEEK_END)
+    tracemalloc.start()
+    spool, _ = await export()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    spool.close()
+    print(f"{label:<22} {rows:>9} {elapsed:>8.1f} {size / 2 ** 20:>9.1f} {peak / 2 ** 20:>10.1f} "
+          f"{lag:>9.1f} {read:>9.1f}")
+
+
+async def main(args):
+    directory = tempfile.mkdtemp(prefix='bench-export-')
+    db_path = os.path.join(directory, 'bot.db')
+    try:
+        db = Storage(db_path, readers=2)
+        db.init_db()
+        start = time.perf_counter()
+        fill(db, args.users, args.events, args.seed)
+        print(f"{args.users} пользователей и {args.events} событий записано за {time.perf_counter() - start:.1f} с, "
+              f"БД {os.path.getsize(db_path) / 2 ** 20:.0f} МБ\n")
+        print(f"{'выгрузка':<22} {'строк':>9} {'сек':>8} {'архив, МБ':>9} {'пик, МБ':>10} "
+              f"{'лаг, мс':>9} {'чтение, мс':>9}")
+        for table in TABLES:
+            for fmt in ('csv', 'jsonl'):
+                await run(db, f"{table}.{fmt}", lambda: db.export_table(table, fmt, args.chunk_rows))
+                if not args.skip_naive:
+                    # Как было бы без потока выгрузок: целиком в памяти, на одном из читателей
+                    await run(db, f"{table}.{fmt} в лоб", lambda: db._read(naive_export, table, fmt))
+        await db.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--events', type=int, default=3000000)
+    parser.add_argument('--chunk-rows', type=int, default=5000, help='строк в одной порции чтения')
+    parser.add_argument('--skip-naive', action='store_true', help='не замерять выгрузку целиком в памяти')
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,105 @@
+"""Бенчмарк затрат на логирование одного обновления в потоке event loop.
+
+Сравнивает прежнюю схему (basicConfig, INFO, f-строки, запись в stream в
+вызывающем потоке) с logging_setup: подстановка аргументов только для
+записей, прошедших фильтры, запись через QueueListener и сэмплирование
+debug-строк. Вывод логов уходит в /dev/null,
+каждый режим запускается в отдельном процессе. Запуск:
+
+    python benchmarks/bench_logging.py --updates 20000
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HEADERS = {'Host': 'example.com', 'Content-Type': 'application/json', 'Content-Length': '312',
+           'X-Forwarded-For': '149.154.167.220', 'Accept-Encoding': 'gzip, deflate'}
+MODES = {
+    'legacy': {},
+    'json-info': {'LOG_LEVEL': 'INFO'},
+    'json-debug-1%': {'LOG_LEVEL': 'DEBUG', 'LOG_DEBUG_SAMPLE_RATE': '0.01'},
+    'json-debug-100%': {'LOG_LEVEL': 'DEBUG', 'LOG_DEBUG_SAMPLE_RATE': '1'},
+}
+
+
+def legacy_update(logger, update_id, user_id, text):
+    """Строки, которые прежний handle_webhook, middleware и /start писали на каждое обновление"""
+    logger.info("=" * 50)
+    logger.info(f"WEBHOOK: ====== НОВЫЙ ЗАПРОС ======")
+    logger.info(f"WEBHOOK: Получен HTTP запрос: POST /webhook/TOKEN")
+    logger.info(f"WEBHOOK: Headers: {dict(HEADERS)}")
+    logger.info(f"WEBHOOK: Получено обновление: {update_id}")
+    logger.info(f"WEBHOOK: Сообщение от {user_id}: {text}")
+    logger.info(f"WEBHOOK: Создан объект Update, обработка...")
+    logger.info(f"WEBHOOK: Вызов dp.process_update для update_id={update_id}")
+    logger.info(f"MIDDLEWARE: Получено сообщение от {user_id}: {text}")
+    logger.info(f"MIDDLEWARE: Тип сообщения: text")
+    logger.info(f"CMD_START: Обработка команды /start от {user_id}")
+    logger.info(f"CMD_START: Текст сообщения: {text}")
+    logger.info(f"ADD_USER: Добавление пользователя {user_id} (Имя Фамилия)")
+    logger.info(f"CMD_START: Сообщение успешно отправлено пользователю {user_id}")
+    logger.info(f"WEBHOOK: ✅ Обновление {update_id} обработано успешно")
+    logger.info(f"WEBHOOK: Отправка ответа 'OK'")
+    logger.info("=" * 50)
+
+
+def current_update(logger, update_id, user_id, text):
+    """Те же события в нынешнем виде: debug с аргументами, без дампа заголовков"""
+    from logging_setup import begin_update
+    begin_update(update_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("WEBHOOK: Сообщение от %s: %s", user_id, text)
+    logger.debug("MIDDLEWARE: Получено сообщение от %s: %s", user_id, text)
+    logger.debug("MIDDLEWARE: Тип сообщения: %s", 'text')
+    logger.debug("CMD_START: Обработка команды /start от %s", user_id)
+    logger.debug("CMD_START: Текст сообщения: %s", text)
+    logger.debug("ADD_USER: Добавление пользователя %s (%s %s)", user_id, "Имя", "Фамилия")
+    logger.debug("CMD_START: Сообщение успешно отправлено пользователю %s", user_id)
+    logger.debug("WEBHOOK: Обновление обработано")
+
+
+def run_mode(mode, updates):
+    sys.stderr = open(os.devnull, 'w')
+    if mode == 'legacy':
+        logging.basicConfig(level=logging.INFO)
+        emit = legacy_update
+        listener = None
+    else:
+        from logging_setup import setup_logging, stop_logging
+        listener = setup_logging()
+        emit = current_update
+    logger = logging.getLogger("bot")
+
+    start = time.perf_counter()
+    for i in range(updates):
+        emit(logger, i, 100000 + i % 1000, "/start")
+    loop_time = time.perf_counter() - start
+    if listener is not None:
+        stop_logging()
+    total_time = time.perf_counter() - start
+    print(f"{mode:<16} в потоке loop: {loop_time / updates * 1e6:8.1f} мкс/обновление   "
+          f"с дозаписью: {total_time / updates * 1e6:8.1f} мкс/обновление")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--mode', choices=sorted(MODES))
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.updates)
+        return
+
+    for mode, env in MODES.items():
+        subprocess.run([sys.executable, __file__, '--mode', mode, '--updates', str(args.updates)],
+                       env={**os.environ, 'LOG_FORMAT': 'json', **env}, check=True)
+
+
+if __name__ == '__main__':
+    main()
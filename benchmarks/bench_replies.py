@@ -0,0 +1,125 @@
+"""Бенчмарк подготовки ответа: текст и reply_markup в том виде, в каком их получает Bot API.
+
+Прежняя схема собирала InlineKeyboardMarkup и f-строку текста на каждый
+ответ, а aiogram сериализовал клавиатуру в JSON (prepare_arg). Сейчас
+клавиатуры — готовые JSON-строки из bot.py, тексты — константы и шаблоны
+Template. Для каждого ответа выводится время подготовки и пик выделенной
+памяти (tracemalloc). Запуск:
+
+    python benchmarks/bench_replies.py --iterations 20000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:BENCHBENCHBENCHBENCHBENCHBENCHBENC')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.payload import prepare_arg
+
+import bot as B
+from callbacks import ADMIN, SUBSCRIPTION
+
+STATS = {'total_users': 125000, 'subscribed_users': 98000, 'active_today': 4200,
+         'active_week': 21000, 'active_month': 60000}
+
+
+def legacy_start():
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Подписаться на канал 📢", url=B.CHANNEL_LINK)],
+        [InlineKeyboardButton(text="Проверить подписку ✅", callback_data=SUBSCRIPTION.pack())]
+    ])
+    return "👋 Привет! Чтобы получить ответы на Гигтесты, пожалуйста, подпишись на канал", prepare_arg(markup)
+
+
+def legacy_admin_menu(stats):
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📊 Статистика", callback_data=ADMIN.pack(screen="stats"))],
+        [InlineKeyboardButton(text="📨 Рассылка", callback_data=ADMIN.pack(screen="broadcast"))],
+        [InlineKeyboardButton(text="👥 Управление пользователями", callback_data=ADMIN.pack(screen="users"))],
+        [InlineKeyboardButton(text="⚙️ Настройки", callback_data=ADMIN.pack(screen="settings"))]
+    ])
+    text = (
+        f"👋 Добро пожаловать в админ-панель!\n\n"
+        f"📈 Общая статистика:\n"
+        f"👥 Всего пользователей: {stats['total_users']}\n"
+        f"✅ Подписано: {stats['subscribed_users']}\n"
+        f"🟢 Активных за сутки: {stats['active_today']}"
+    )
+    return text, prepare_arg(markup)
+
+
+def legacy_admin_stats(stats):
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=ADMIN.pack(screen="back"))]
+    ])
+    text = (
+        f"📊 Статистика бота:\n\n"
+        f"👥 Всего пользователей: {stats['total_users']}\n"
+        f"✅ Подписано: {stats['subscribed_users']}\n"
+        f"🟢 Активных за сутки: {stats['active_today']}\n\n"
+        f"📈 Детальная статистика:\n"
+        f"📅 За последние 7 дней: {stats['active_week']}\n"
+        f"📅 За последние 30 дней: {stats['active_month']}"
+    )
+    return text, prepare_arg(markup)
+
+
+def current_start():
+    return B.START_TEXT, prepare_arg(B.START_KEYBOARD)
+
+
+def current_admin_menu(stats):
+    return B.ADMIN_MENU_TEXT.render(stats), prepare_arg(B.ADMIN_MENU_KEYBOARD)
+
+
+def current_admin_stats(stats):
+    return B.ADMIN_STATS_TEXT.render(stats), prepare_arg(B.BACK_KEYBOARD)
+
+
+REPLIES = {
+    '/start': (legacy_start, current_start, ()),
+    'админ-меню': (legacy_admin_menu, current_admin_menu, (STATS,)),
+    'статистика': (legacy_admin_stats, current_admin_stats, (STATS,)),
+}
+
+
+def timing(build, args, iterations):
+    """Время подготовки одного ответа, мкс"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        build(*args)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def peak_memory(build, args):
+    """Пик памяти, выделенной при подготовке одного ответа, байт"""
+    tracemalloc.start()
+    build(*args)  # прогрев кэшей интерпретатора
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    build(*args)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return peak
+
+
+def main(args):
+    print(f"{'ответ':<12} {'было, мкс':>10} {'стало, мкс':>11} {'было, байт':>11} {'стало, байт':>12}")
+    for name, (legacy, current, build_args) in REPLIES.items():
+        # Ответы обеих схем должны совпадать до байта
+        assert legacy(*build_args) == current(*build_args), name
+        print(f"{name:<12} {timing(legacy, build_args, args.iterations):>10.2f} "
+              f"{timing(current, build_args, args.iterations):>11.2f} "
+              f"{peak_memory(legacy, build_args):>11} {peak_memory(current, build_args):>12}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000, help='ответов каждого вида')
+    main(parser.parse_args())
@@ -0,0 +1,144 @@
+"""Бенчмарк сводок stats для экрана статистики админ-панели.
+
+Заполняет временную БД событиями start / check_subscription / subscribed за
+последние --days дней (id растут вместе со временем, как при отложенной
+записи) и замеряет:
+
+    догон     — первый проход Storage.rollup_stats по всей истории: скорость и
+                самая долгая транзакция писателя (на столько задерживается flush)
+    прирост   — проход после --increment новых событий, как раз в STATS_ROLLUP_INTERVAL
+    запросы   — те же цифры, что на экране статистики, по сырым строкам stats
+                (индекс idx_stats_action_ts и GROUP BY user_id) и по сводкам
+
+Результаты сырых запросов и сводок сверяются. Запуск:
+
+    python benchmarks/bench_stats_rollup.py --events 5000000 --users 1000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage
+
+ACTIONS = ('start', 'check_subscription', 'subscribed')
+
+
+def events(rng, users, count, start, end):
+    """Сессии пользователей: start, затем с вероятностью проверка и подписка"""
+    # В среднем 1 + 0.7 + 0.7 * 0.6 = 2.12 события на сессию
+    timestamps = sorted(rng.randrange(start, end) for _ in range(int(count / 2.12) + 1))
+    rows = []
+    for ts in timestamps:
+        user_id = rng.randrange(1, users + 1)
+        rows.append((user_id, 'start', ts))
+        if rng.random() < 0.7:
+            rows.append((user_id, 'check_subscription', ts + 5))
+            if rng.random() < 0.6:
+                rows.append((user_id, 'subscribed', ts + 6))
+    return rows[:count]
+
+
+def insert(db, rows):
+    conn = db._connect()
+    with conn:
+        conn.executemany('INSERT INTO stats (user_id, action, timestamp) VALUES (?, ?, ?)', rows)
+    conn.close()
+
+
+def raw_analytics(c, now):
+    """Цифры экрана статистики прямо по stats"""
+    hour, today = now // 3600, now // 86400
+    result = {'events_day': {}, 'events_week': {}, 'events_month': {}}
+    for period, since in (('events_day', (hour - 23) * 3600), ('events_week', (today - 6) * 86400),
+                          ('events_month', (today - 29) * 86400)):
+        for action in ACTIONS:
+            count = c.execute('SELECT COUNT(*) FROM stats WHERE action = ? AND timestamp >= ?',
+                              (action, since)).fetchone()[0]
+            if count:
+                result[period][action] = count
+    for period, days in (('funnel_week', 7), ('funnel_month', 30)):
+        started, checked, subscribed = c.execute(
+            '''SELECT COUNT(*), COALESCE(SUM(checked), 0), COALESCE(SUM(subscribed), 0) FROM
+                   (SELECT MIN(timestamp) / 86400 AS day, MAX(action = 'check_subscription') AS checked,
+                           MAX(action = 'subscribed') AS subscribed
+                    FROM stats WHERE action IN ('start', 'check_subscription', 'subscribed') GROUP BY user_id)
+               WHERE day > ?''', (today - days,)).fetchone()
+        result[period] = {'started': started, 'checked': checked, 'subscribed': subscribed}
+    return result
+
+
+def timed(fn, repeat):
+    """Медиана времени fn(), мс, и результат последнего вызова"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000, result
+
+
+async def main(args):
+    directory = tempfile.mkdtemp(prefix='bench-rollup-')
+    db_path = os.path.join(directory, 'bot.db')
+    try:
+        db = Storage(db_path, readers=1)
+        db.init_db()
+        rng = random.Random(args.seed)
+        now = int(time.time())
+        start = time.perf_counter()
+        insert(db, events(rng, args.users, args.events, now - args.days * 86400, now - 3600))
+        print(f"{args.events} событий за {args.days} дней записано за {time.perf_counter() - start:.1f} с, "
+              f"БД {os.path.getsize(db_path) / 2 ** 20:.0f} МБ\n")
+
+        # Догон по одной транзакции, чтобы увидеть самую долгую
+        batches = []
+        start = time.perf_counter()
+        while True:
+            batch_start = time.perf_counter()
+            rows, behind = await db._write(db._rollup_stats, args.batch)
+            batches.append(time.perf_counter() - batch_start)
+            if not behind:
+                break
+        elapsed = time.perf_counter() - start
+        print(f"догон: {args.events} строк за {elapsed:.1f} с ({args.events / elapsed:,.0f} строк/с), "
+              f"транзакций {len(batches)}, самая долгая {max(batches) * 1000:.0f} мс")
+
+        insert(db, events(rng, args.users, args.increment, now - 3600, now))
+        start = time.perf_counter()
+        rows = await db.rollup_stats(args.batch)
+        print(f"прирост: {rows} строк за {(time.perf_counter() - start) * 1000:.1f} мс\n")
+
+        conn = db._connect(readonly=True)
+        now = int(time.time())
+        raw_ms, raw = timed(lambda: raw_analytics(conn, now), args.repeat)
+        rollup_ms, rollup = timed(lambda: db._get_analytics(conn, now), args.repeat)
+        conn.close()
+        for key in ('events_day', 'events_week', 'events_month', 'funnel_week', 'funnel_month'):
+            assert raw[key] == rollup[key], (key, raw[key], rollup[key])
+        print(f"{'запрос':<26} {'мс':>10}")
+        print(f"{'сырые строки stats':<26} {raw_ms:>10.1f}")
+        print(f"{'сводки':<26} {rollup_ms:>10.3f}")
+        print(f"\nворонка за 30 дней: {rollup['funnel_month']}")
+        await db.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=5000000)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--increment', type=int, default=2000, help='новых событий между проходами')
+    parser.add_argument('--batch', type=int, default=50000, help='строк stats за одну транзакцию (STATS_ROLLUP_BATCH)')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов каждого запроса (берётся медиана)')
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
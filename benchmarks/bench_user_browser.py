@@ -0,0 +1,124 @@
+"""Бенчмарк просмотра пользователей в админ-панели на большой базе.
+
+Заполняет временную БД (все миграции, включая индекс FTS5) синтетическими
+пользователями и сравнивает:
+
+    страницы  — keyset по (last_activity, user_id) против LIMIT/OFFSET на той же глубине
+    поиск     — Storage.search_users для частых и редких префиксов, первая и следующая страницы
+
+Запуск:
+
+    python benchmarks/bench_user_browser.py --users 1000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import USER_COLUMNS, Storage
+
+FIRST_NAMES = ['Иван', 'Пётр', 'Мария', 'Анна', 'Алексей', 'Дмитрий', 'Ольга', 'Елена', 'Сергей', 'Наталья',
+               'Alex', 'John', 'Maria', 'Anna', 'David', 'Kate', 'Михаил', 'Татьяна', 'Андрей', 'Юлия']
+LAST_NAMES = ['Иванов', 'Петров', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев', 'Козлов',
+              'Smith', 'Brown', 'Lee', None, None, None]
+PAGE_SIZE = 10
+
+
+def fill(db, users, seed):
+    """Пользователи с активностью за последний год; вставка одной транзакцией через триггеры"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    conn = db._connect()
+    rows = []
+    for user_id in range(1, users + 1):
+        first_name = rng.choice(FIRST_NAMES)
+        username = f"{first_name.lower()}_{rng.randrange(10 ** 6)}" if rng.random() < 0.7 else None
+        last_activity = now - rng.randrange(365 * 86400)
+        rows.append((user_id * 7919 % 10 ** 10, username, first_name, rng.choice(LAST_NAMES), 'ru',
+                     last_activity, last_activity))
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, language_code, '
+                         'joined_at, last_activity) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.close()
+
+
+def timed(fn, repeat):
+    """Медиана времени fn(), мс"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def bench_pages(conn, users, repeat):
+    print(f"{'страница':>10} {'OFFSET, мс':>12} {'keyset, мс':>12}")
+    for depth in (1, 100, 10000, users // PAGE_SIZE // 2, users // PAGE_SIZE - 1):
+        offset = (depth - 1) * PAGE_SIZE
+        # Курсор — последняя строка предыдущей страницы, как в кнопке «вперёд»
+        cursor = conn.execute('SELECT last_activity, user_id FROM users ORDER BY last_activity DESC, user_id DESC '
+                              'LIMIT 1 OFFSET ?', (max(0, offset - 1),)).fetchone()
+
+        def by_offset():
+            conn.execute(f'SELECT {USER_COLUMNS} FROM users ORDER BY last_activity DESC, user_id DESC '
+                         'LIMIT ? OFFSET ?', (PAGE_SIZE, offset)).fetchall()
+
+        def by_keyset():
+            Storage._page_users(conn.cursor(), cursor if depth > 1 else None, False, PAGE_SIZE)
+
+        print(f"{depth:>10} {timed(by_offset, repeat):>12.3f} {timed(by_keyset, repeat):>12.3f}")
+
+
+async def bench_search(db, repeat):
+    print(f"\n{'запрос':<16} {'стр. 1, мс':>11} {'стр. 2, мс':>11}")
+    for query in ('а', 'ив', 'иван', 'иван петр', 'alex_12', 'smith j', '791', 'zzz'):
+        times = []
+        rows = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows, more = await db.search_users(query, PAGE_SIZE)
+            times.append(time.perf_counter() - start)
+        first = sorted(times)[len(times) // 2] * 1000
+        second = float('nan')
+        if rows and more:
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                await db.search_users(query, PAGE_SIZE, rows[-1][0])
+                times.append(time.perf_counter() - start)
+            second = sorted(times)[len(times) // 2] * 1000
+        print(f"{query:<16} {first:>11.3f} {second:>11.3f}")
+
+
+async def main(args):
+    directory = tempfile.mkdtemp(prefix='bench-users-')
+    db_path = os.path.join(directory, 'bot.db')
+    try:
+        db = Storage(db_path, readers=1)
+        db.init_db()
+        start = time.perf_counter()
+        fill(db, args.users, args.seed)
+        print(f"{args.users} пользователей записано за {time.perf_counter() - start:.1f} с, "
+              f"БД {os.path.getsize(db_path) / 2 ** 20:.0f} МБ\n")
+        conn = db._connect(readonly=True)
+        bench_pages(conn, args.users, args.repeat)
+        conn.close()
+        await bench_search(db, args.repeat)
+        await db.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5, help='повторов каждого замера (берётся медиана)')
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,268 @@
+"""Нагрузочный тест webhook-приложения против локальной заглушки Bot API.
+
+Поднимает заглушку Bot API (sendMessage, copyMessage, getChatMember,
+answerCallbackQuery, editMessageText, setWebhook и др.) и приложение
+bot.init_app() с обычными on_startup/on_shutdown, затем с заданной
+частотой отправляет синтетические обновления на webhook:
+
+    start      — поток /start от разных пользователей
+    check      — шквал проверок подписки (повторные пользователи попадают в кэш)
+    broadcast  — рассылка администратора по всей базе
+
+Для каждого сценария выводятся пропускная способность, p50/p95/p99
+времени ответа webhook, число транзакций SQLite и запросов к Bot API.
+По умолчанию лимиты Telegram в планировщике отключены, чтобы измерять
+сам бот; --telegram-limits оставляет их. Режим приёма задаётся как
+обычно (WEBHOOK_INGEST=queue и т.д.). Запуск:
+
+    python benchmarks/loadtest.py --scenario all --rate 300 --count 3000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from aiohttp import ClientSession, TCPConnector, web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callbacks import SUBSCRIPTION
+
+TOKEN = "123456:LOADTESTLOADTESTLOADTESTLOADTESTLOA"
+ADMIN_ID = 1
+USER_BASE = 100000
+BROADCAST_PROMPT = "📨 Отправьте сообщение для рассылки:\n\nТекст"
+
+
+class FakeBotApi:
+    """Заглушка Bot API: отвечает успехом, считает вызовы по методам (GET /stats)"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.webhook = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+        self.app.router.add_get('/stats', self.stats)
+
+    async def stats(self, request):
+        return web.json_response(self.calls)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = await request.json() if request.content_type == 'application/json' else dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(data.get('chat_id') or 0)
+        if method == 'getChatMember':
+            # Нечётные пользователи подписаны
+            user_id = int(data['user_id'])
+            result = {"status": "member" if user_id % 2 else "left",
+                      "user": {"id": user_id, "is_bot": False, "first_name": "U"}}
+        elif method in ('sendMessage', 'copyMessage', 'editMessageText'):
+            result = {"message_id": self.calls[method], "date": 0, "text": "ok",
+                      "chat": {"id": chat_id, "type": "private"}}
+        elif method == 'getWebhookInfo':
+            result = self.webhook
+        elif method == 'setWebhook':
+            self.webhook = {**self.webhook, "url": data.get('url', '')}
+            result = True
+        elif method == 'getMe':
+            result = {"id": 123456, "is_bot": True, "first_name": "Bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+def serve_fake_api(latency, port_queue):
+    """Заглушка в отдельном процессе: её работа не отнимает процессор у бота"""
+    async def serve():
+        runner = web.AppRunner(FakeBotApi(latency).app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        port_queue.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def api_calls(session, api_url):
+    async with session.get(f'{api_url}/stats') as response:
+        return Counter(await response.json())
+
+
+class Traffic:
+    def __init__(self):
+        self.update_id = 0
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, user_id, text, reply_text=None):
+        message = {"message_id": self.update_id, "date": 0, "text": text,
+                   "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": "U", "username": f"u{user_id}"}}
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        if reply_text:
+            message["reply_to_message"] = {"message_id": 1, "date": 0, "text": reply_text,
+                                           "chat": {"id": user_id, "type": "private"}}
+        return {"update_id": self._next_id(), "message": message}
+
+    def callback(self, user_id, data):
+        update_id = self._next_id()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": "1", "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+            "message": {"message_id": 1, "date": 0, "text": "x", "chat": {"id": user_id, "type": "private"}}}}
+
+
+def metric_total(metric):
+    # Сумма по всем меткам; для замеров внутри одного процесса
+    return sum(child.value for child in metric._children.values())
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def replay(session, url, updates, rate):
+    """Отправляет обновления с постоянной частотой (открытая модель нагрузки)"""
+    loop = asyncio.get_running_loop()
+    latencies = []
+    statuses = Counter()
+    start = loop.time()
+
+    async def send(i, update):
+        delay = start + i / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        t = time.perf_counter()
+        try:
+            async with session.post(url, json=update) as response:
+                await response.read()
+                statuses[response.status] += 1
+        except Exception as e:
+            statuses[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - t)
+
+    await asyncio.gather(*(send(i, update) for i, update in enumerate(updates)))
+    return sorted(latencies), statuses, loop.time() - start
+
+
+async def drain(bot_module):
+    """Ждёт, пока очередь webhook и обработчики закончат работу"""
+    while True:
+        queue = bot_module.update_queue
+        if (queue is None or queue.depth == 0) and metric_total(bot_module.UPDATES_IN_FLIGHT) == 0:
+            return
+        await asyncio.sleep(0.01)
+
+
+def report(name, updates, latencies, statuses, elapsed, commits, api_calls):
+    errors = sum(count for status, count in statuses.items() if status != 200)
+    print(f"{name:<10} {len(updates):>6} обновлений за {elapsed:6.2f} с = {len(updates) / elapsed:7.1f}/с  "
+          f"p50 {percentile(latencies, 0.5) * 1000:7.2f} мс  p95 {percentile(latencies, 0.95) * 1000:7.2f} мс  "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.2f} мс  ошибок {errors}")
+    print(f"{'':<10} транзакций SQLite: {commits} ({commits / max(1, len(updates)):.2f} на обновление)  "
+          f"Bot API: {dict(api_calls)}")
+
+
+async def run_scenario(name, args, B, DB_COMMITS, session, url, traffic, api_url):
+    commits_before = metric_total(DB_COMMITS)
+    calls_before = await api_calls(session, api_url)
+
+    if name == 'start':
+        updates = [traffic.message(USER_BASE + i % args.users, '/start') for i in range(args.count)]
+    elif name == 'check':
+        updates = [traffic.callback(USER_BASE + i % args.users, SUBSCRIPTION.pack()) for i in range(args.count)]
+    else:
+        updates = [traffic.message(ADMIN_ID, 'Рассылка нагрузочного теста', reply_text=BROADCAST_PROMPT)]
+
+    started = time.perf_counter()
+    latencies, statuses, elapsed = await replay(session, url, updates, args.rate)
+    await drain(B)
+    if name == 'broadcast':
+        # Ответ webhook приходит сразу, рассылка идёт в фоне: ждём её завершения
+        while B.active_broadcasts:
+            await asyncio.sleep(0.05)
+        await B.db.flush()
+        elapsed = time.perf_counter() - started
+        sent = (await api_calls(session, api_url))['copyMessage'] - calls_before['copyMessage']
+        print(f"{'broadcast':<10} {sent} получателей за {elapsed:6.2f} с = {sent / elapsed:7.1f}/с")
+    else:
+        await B.db.flush()
+        elapsed = time.perf_counter() - started
+
+    calls = await api_calls(session, api_url)
+    calls.subtract(calls_before)
+    report(name, updates, latencies, statuses, elapsed, metric_total(DB_COMMITS) - commits_before, +calls)
+
+
+async def main(args):
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    api_process = context.Process(target=serve_fake_api, args=(args.api_latency / 1000, port_queue), daemon=True)
+    api_process.start()
+    api_url = f'http://127.0.0.1:{port_queue.get(timeout=30)}'
+
+    db_dir = tempfile.mkdtemp(prefix='loadtest-')
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN,
+        'TELEGRAM_API_URL': api_url,
+        'ADMIN_IDS': str(ADMIN_ID),
+        'BOT_MODE': 'webhook',
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if not args.telegram_limits:
+        for name in ('BOT_API_GLOBAL_RATE', 'BOT_API_CHAT_RATE', 'BROADCAST_RATE'):
+            os.environ.setdefault(name, '100000')
+        os.environ.setdefault('BOT_API_CHAT_BURST', '100000')
+
+    import bot as B
+    from storage import DB_COMMITS
+    # Путь к БД в bot.py не настраивается окружением: подменяем до первого подключения
+    B.DB_PATH = B.db.db_path = os.path.join(db_dir, 'bot.db')
+    B.db.init_db()
+    app = B.init_app()
+    app.on_startup.append(B.on_startup)
+    app.on_shutdown.append(B.on_shutdown)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{runner.addresses[0][1]}/webhook/{TOKEN}'
+
+    print(f"WEBHOOK_INGEST={B.WEBHOOK_INGEST}, задержка Bot API {args.api_latency} мс, "
+          f"частота {args.rate}/с, пользователей {args.users}, БД {B.DB_PATH}")
+    scenarios = ['start', 'check', 'broadcast'] if args.scenario == 'all' else [args.scenario]
+    traffic = Traffic()
+    try:
+        async with ClientSession(connector=TCPConnector(limit=args.connections)) as session:
+            if 'start' not in scenarios:
+                # Пользователи для проверок подписки и рассылки
+                for i in range(args.users):
+                    await B.db.add_user(USER_BASE + i, f'u{i}', 'U', None, 'ru')
+            for name in scenarios:
+                await run_scenario(name, args, B, DB_COMMITS, session, url, traffic, api_url)
+    finally:
+        await runner.cleanup()
+        api_process.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=['start', 'check', 'broadcast', 'all'], default='all')
+    parser.add_argument('--rate', type=float, default=200, help='обновлений в секунду')
+    parser.add_argument('--count', type=int, default=2000, help='обновлений в сценариях start и check')
+    parser.add_argument('--users', type=int, default=1000, help='различных пользователей')
+    parser.add_argument('--api-latency', type=float, default=0, help='задержка ответа заглушки Bot API, мс')
+    parser.add_argument('--connections', type=int, default=500, help='одновременных HTTP-соединений к webhook')
+    parser.add_argument('--telegram-limits', action='store_true', help='не отключать лимиты Telegram в планировщике')
+    asyncio.run(main(parser.parse_args()))
@@ -1,26 +1,137 @@
 import os
+import argparse
 import logging
-import sqlite3
+import socket
 from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update
+from aiogram.types import Message, InlineKeyboardButton, CallbackQuery, InputFile, Update
+from aiogram.dispatcher.handler import current_handler
 from aiogram.dispatcher.middlewares import BaseMiddleware
 import traceback
 import asyncio
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+import time
 from aiohttp import web
 from dotenv import load_dotenv
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.utils.exceptions import RetryAfter
+from api_session import BULK, INTERACTIVE, ApiSessions, bulk_requests, current_lane
+from broadcast import Broadcast, SharedTokenBucket
+from cache import TTLCache
+from callbacks import (ADMIN, BROADCAST_CONTROL, ROUTE_KEY, SUBSCRIPTION, USER_SEARCH_PAGE, USERS_PAGE,
+                       CallbackRouter, upgrade_legacy)
+from export import FORMATS, TABLES
+from fsm_storage import SharedFSMStorage
+from ingest import UpdateDeduplicator, UpdateQueue, chat_key
+from logging_setup import begin_update, setup_logging
+from loop_watchdog import LoopWatchdog
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
+from polling import UpdatePoller
+from redis_state import RedisState
+from scheduler import RequestScheduler, is_limited
+from storage import Storage
+from templates import Template, keyboard
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Настройка логирования: JSON в stderr через фоновый поток, уровни подсистем из LOG_LEVELS
+setup_logging()
+logger = logging.getLogger("bot")
 
 # Конфигурация
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'bot.db')
+DB_READERS = int(os.getenv("DB_READERS", 4))
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", 200))
+DB_FLUSH_MAX_ROWS = int(os.getenv("DB_FLUSH_MAX_ROWS", 500))
+COUNTERS_RECONCILE_INTERVAL = int(os.getenv("COUNTERS_RECONCILE_INTERVAL", 3600))
+# Сводки stats по часам и дням для статистики админ-панели: как часто учитывать
+# новые события (секунды) и сколько строк stats обрабатывать за одну транзакцию
+STATS_ROLLUP_INTERVAL = int(os.getenv("STATS_ROLLUP_INTERVAL", 60))
+STATS_ROLLUP_BATCH = int(os.getenv("STATS_ROLLUP_BATCH", 50000))
+
+# Параметры рассылки: общий лимит Telegram ~30 сообщений в секунду
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 30))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", 500))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_SHUTDOWN_TIMEOUT = float(os.getenv("BROADCAST_SHUTDOWN_TIMEOUT", 10))
+# Сколько токенов общего ограничителя рассылок воркер берёт за одно обращение к хранилищу
+BROADCAST_TOKEN_BATCH = int(os.getenv("BROADCAST_TOKEN_BATCH", 10))
+
+# Кэш проверок подписки на канал (секунды)
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", 10000))
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", 300))
+MEMBERSHIP_CACHE_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_CACHE_NEGATIVE_TTL", 10))
+
+# Просмотр пользователей в админ-панели: строк на странице и сколько помнить
+# поисковый запрос для листания его результатов (секунды)
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", 10))
+USER_SEARCH_TTL = int(os.getenv("USER_SEARCH_TTL", 86400))
+# Выгрузка таблиц командой /export: строк в одной порции чтения и сколько байт
+# архива держать в памяти, прежде чем временный файл переедет на диск
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 5000))
+EXPORT_SPOOL_SIZE = int(os.getenv("EXPORT_SPOOL_SIZE", 4 * 2 ** 20))
+# Предел размера документа для sendDocument, МБ: 50 у облачного Bot API. Локальный
+# сервер Bot API принимает до 2000 — задайте явно, прокси к api.telegram.org оставьте 50
+EXPORT_MAX_MB = float(os.getenv("EXPORT_MAX_MB", 50))
+EXPORT_MAX_BYTES = int(EXPORT_MAX_MB * 2 ** 20)
+
+# Источник обновлений: webhook или polling (getUpdates, без публичного HTTPS);
+# при запуске python bot.py переопределяется ключом --mode
+BOT_MODE = os.getenv("BOT_MODE", "webhook")
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT", 100))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 25))
+
+# Режим приёма webhook: inline — обработка до ответа Telegram, queue — ответ сразу,
+# обработка в пуле воркеров с сохранением порядка внутри чата
+WEBHOOK_INGEST = os.getenv("WEBHOOK_INGEST", "inline")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+
+# Сколько последних update_id помнить для отбрасывания повторных доставок: окно в памяти
+# воркера и время хранения в общем состоянии (секунды)
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", 10000))
+UPDATE_DEDUP_TTL = int(os.getenv("UPDATE_DEDUP_TTL", 3600))
+
+# Общее состояние воркеров: Redis-совместимый сервер или (по умолчанию) та же SQLite
+REDIS_URL = os.getenv("REDIS_URL")
+# Число воркеров gunicorn (см. gunicorn_config.py). Дедупликация обновлений и кэш
+# подписок идут через общее состояние, только если оно действительно общее: с Redis
+# или при нескольких воркерах. Одному воркеру на SQLite хватает памяти процесса —
+# без лишней транзакции писателя на каждое обновление
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+SHARED_STATE = bool(REDIS_URL) or WEB_CONCURRENCY > 1
+# Блокировка рассылки воркером (продлевается, пока рассылка идёт) и период опроса
+# команд паузы/отмены, пришедших на другие воркеры (секунды)
+BROADCAST_LEASE_TTL = float(os.getenv("BROADCAST_LEASE_TTL", 30))
+BROADCAST_CONTROL_POLL = float(os.getenv("BROADCAST_CONTROL_POLL", 1))
+# Аренда лидерства среди воркеров и процессов (секунды): лидер сверяет webhook,
+# продлевает аренду каждую треть срока, после его падения лидером становится другой
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 30))
+
+# Период замера задержки event loop и порог, после которого блокировка
+# записывается вместе со стеком блокирующего кода (секунды)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.05))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.1))
+
+# Адрес Bot API (например, локальный сервер или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+# Пулы соединений к Bot API: interactive — ответы пользователям, bulk — рассылки.
+# Keep-alive и кэш DNS (секунды), таймауты установки соединения и всего запроса
+BOT_API_CONNECTIONS = int(os.getenv("BOT_API_CONNECTIONS", 50))
+BOT_API_BULK_CONNECTIONS = int(os.getenv("BOT_API_BULK_CONNECTIONS", 20))
+BOT_API_KEEPALIVE = float(os.getenv("BOT_API_KEEPALIVE", 30))
+BOT_API_DNS_TTL = int(os.getenv("BOT_API_DNS_TTL", 300))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", 10))
+BOT_API_TIMEOUT = float(os.getenv("BOT_API_TIMEOUT", 60))
+# Лимиты Telegram на отправку сообщений: общий для всего бота в секунду (каждый из
+# WEB_CONCURRENCY воркеров получает равную долю; рассылки ограничивает BROADCAST_RATE),
+# на чат в секунду с короткой серией; сколько раз повторять ответ после RetryAfter
+BOT_API_GLOBAL_RATE = float(os.getenv("BOT_API_GLOBAL_RATE", 30))
+BOT_API_CHAT_RATE = float(os.getenv("BOT_API_CHAT_RATE", 1))
+BOT_API_CHAT_BURST = int(os.getenv("BOT_API_CHAT_BURST", 3))
+BOT_API_RETRIES = int(os.getenv("BOT_API_RETRIES", 3))
 API_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
 CHANNEL_ID = "-1001324681912"
@@ -28,306 +139,431 @@ CHANNEL_LINK = "https://t.me/lebedevamariiatgm"
 
 # URL для webhook
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "https://gigtest-bot-new.onrender.com")
+WEBHOOK_ALLOWED_UPDATES = ["message", "callback_query"]
 
 # Проверка обязательных переменных
 if not API_TOKEN:
     logger.error("ОШИБКА: TELEGRAM_TOKEN не установлен в переменных окружения!")
     raise ValueError("TELEGRAM_TOKEN должен быть установлен в переменных окружения")
 
+# Метрики для /metrics (см. metrics.py); время SQLite-операций собирает Storage
+HTTP_REQUESTS = Counter('bot_http_requests_total', 'HTTP-запросы к приложению', ['route', 'status'])
+HTTP_REQUEST_SECONDS = Histogram('bot_http_request_seconds', 'Время обработки HTTP-запросов', ['route'])
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Время выполнения обработчиков диспетчера', ['handler'])
+BOT_API_REQUESTS = Counter('bot_api_requests_total', 'Запросы к Bot API', ['method', 'result'])
+BOT_API_SECONDS = Histogram('bot_api_request_seconds', 'Время запросов к Bot API', ['method', 'lane'])
+UPDATES_IN_FLIGHT = Gauge('bot_updates_in_flight', 'Обновления, обрабатываемые диспетчером прямо сейчас')
+loop_watchdog = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD)
+Gauge('bot_event_loop_lag_seconds', 'Последняя измеренная задержка event loop', function=lambda: loop_watchdog.lag)
+Gauge('bot_event_loop_lag_max_seconds', 'Максимальная задержка event loop с запуска',
+      function=lambda: loop_watchdog.max_lag)
+
+class InstrumentedBot(Bot):
+    """Bot, считающий запросы к Bot API и их время по методам.
+
+    Запросы идут через сессию полосы текущего контекста (см. api_session).
+    Отправка сообщений проходит через scheduler с приоритетом полосы;
+    после RetryAfter ответы пользователям повторяются, а рассылка
+    обрабатывает его сама (пауза общего ограничителя и повтор).
+    """
+
+    def __init__(self, *args, sessions, scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sessions = sessions
+        self.scheduler = scheduler
+
+    async def get_session(self):
+        return self.sessions.get(current_lane())
+
+    async def close(self):
+        await self.sessions.close()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        lane = current_lane()
+        limited = is_limited(method)
+        attempt = 0
+        while True:
+            if limited:
+                await self.scheduler.acquire(lane, data.get('chat_id') if data else None)
+            start = time.perf_counter()
+            result = 'ok'
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except RetryAfter as e:
+                result = type(e).__name__
+                self.scheduler.pause(e.timeout, lane)
+                attempt += 1
+                if lane == BULK or attempt > BOT_API_RETRIES:
+                    raise
+                logger.warning("BOT_API: RetryAfter %s сек для %s, повтор %s", e.timeout, method, attempt)
+            except Exception as e:
+                result = type(e).__name__
+                raise
+            finally:
+                BOT_API_SECONDS.labels(method, lane).observe(time.perf_counter() - start)
+                BOT_API_REQUESTS.labels(method, result).inc()
+
 # Инициализация бота
 logger.info("Инициализация бота @gigtestibot...")
 try:
-    storage = MemoryStorage()
-    bot = Bot(token=API_TOKEN)
+    request_scheduler = RequestScheduler(
+        [INTERACTIVE, BULK],
+        # Планировщик у каждого воркера свой: делим общий лимит, чтобы в сумме не превысить его.
+        # Рассылку ведёт один воркер, и её скорость на весь бот уже держит broadcast_bucket
+        global_rate=BOT_API_GLOBAL_RATE / WEB_CONCURRENCY,
+        chat_rate=BOT_API_CHAT_RATE,
+        chat_burst=BOT_API_CHAT_BURST,
+        unmetered=[BULK]
+    )
+    api_sessions = ApiSessions(
+        {INTERACTIVE: BOT_API_CONNECTIONS, BULK: BOT_API_BULK_CONNECTIONS},
+        keepalive=BOT_API_KEEPALIVE,
+        dns_ttl=BOT_API_DNS_TTL,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        total_timeout=BOT_API_TIMEOUT
+    )
+    if TELEGRAM_API_URL:
+        bot = InstrumentedBot(token=API_TOKEN, sessions=api_sessions, scheduler=request_scheduler,
+                              server=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        bot = InstrumentedBot(token=API_TOKEN, sessions=api_sessions, scheduler=request_scheduler)
     dp = Dispatcher(bot)
-    dp.storage = storage
     Bot.set_current(bot)
-    logger.info("Бот успешно инициализирован с storage")
+    logger.info("Бот успешно инициализирован")
 except Exception as e:
-    logger.error(f"ОШИБКА при инициализации бота: {e}")
-    logger.error(f"Тип ошибки: {type(e).__name__}")
-    logger.error(f"Трассировка: {traceback.format_exc()}")
+    logger.error("ОШИБКА при инициализации бота: %s", e)
+    logger.error("Тип ошибки: %s", type(e).__name__)
+    logger.error("Трассировка: %s", traceback.format_exc())
     raise
 
-# Функции для работы с БД (определяем ДО middleware)
-def init_db():
-    logger.info(f"Инициализация БД: {DB_PATH}")
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # Таблица пользователей
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                     (user_id INTEGER PRIMARY KEY,
-                      username TEXT,
-                      first_name TEXT,
-                      last_name TEXT,
-                      language_code TEXT,
-                      joined_at TIMESTAMP,
-                      last_activity TIMESTAMP,
-                      is_subscribed INTEGER DEFAULT 0)''')
-        
-        # Таблица статистики
-        c.execute('''CREATE TABLE IF NOT EXISTS stats
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      action TEXT,
-                      timestamp TIMESTAMP,
-                      FOREIGN KEY(user_id) REFERENCES users(user_id))''')
-        
-        conn.commit()
-        
-        # Проверяем количество пользователей после инициализации
-        c.execute('SELECT COUNT(*) FROM users')
-        count = c.fetchone()[0]
-        logger.info(f"БД инициализирована. Пользователей в БД: {count}")
-        
-        conn.close()
-    except Exception as e:
-        logger.error(f"Ошибка при инициализации БД: {e}")
-        raise
+# Хранилище: пул соединений SQLite (один писатель, N читателей), работает вне event loop.
+# Активность и stats пишутся отложенно пачками (см. Storage.flush)
+db = Storage(DB_PATH, readers=DB_READERS,
+             flush_interval=DB_FLUSH_INTERVAL_MS / 1000, flush_max_rows=DB_FLUSH_MAX_ROWS)
 
-def add_user(user_id, username, first_name, last_name, language_code):
-    try:
-        logger.info(f"ADD_USER: Добавление пользователя {user_id} ({first_name} {last_name})")
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # Проверяем, есть ли уже пользователь
-        c.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        exists = c.fetchone()
-        
-        if exists:
-            logger.info(f"ADD_USER: Пользователь {user_id} уже существует, обновляем активность")
-            c.execute('UPDATE users SET last_activity = ?, username = ?, first_name = ?, last_name = ? WHERE user_id = ?',
-                     (datetime.now(), username, first_name, last_name, user_id))
-        else:
-            logger.info(f"ADD_USER: Добавляем нового пользователя {user_id}")
-            c.execute('''INSERT INTO users 
-                         (user_id, username, first_name, last_name, language_code, joined_at, last_activity)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (user_id, username, first_name, last_name, language_code, datetime.now(), datetime.now()))
-        
-        conn.commit()
-        
-        # Проверяем, что пользователь добавлен
-        c.execute('SELECT COUNT(*) FROM users WHERE user_id = ?', (user_id,))
-        count = c.fetchone()[0]
-        logger.info(f"ADD_USER: Пользователь {user_id} {'найден' if count > 0 else 'НЕ НАЙДЕН'} в БД после добавления")
-        
-        # Проверяем общее количество пользователей
-        c.execute('SELECT COUNT(*) FROM users')
-        total = c.fetchone()[0]
-        logger.info(f"ADD_USER: Всего пользователей в БД: {total}")
-        
-        conn.close()
-    except Exception as e:
-        logger.error(f"ADD_USER: Ошибка при добавлении пользователя {user_id}: {e}")
-        logger.error(f"ADD_USER: Трассировка: {traceback.format_exc()}")
-        raise
+# Состояние, общее для всех процессов gunicorn: FSM диспетчера, ограничитель рассылок,
+# кэш подписок, дедупликация обновлений и блокировки «выполнить один раз»
+shared = RedisState(REDIS_URL) if REDIS_URL else db
+dp.storage = SharedFSMStorage(shared)
 
-def update_user_activity(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET last_activity = ? WHERE user_id = ?',
-              (datetime.now(), user_id))
-    conn.commit()
-    conn.close()
-
-def log_action(user_id, action):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO stats (user_id, action, timestamp) VALUES (?, ?, ?)',
-              (user_id, action, datetime.now()))
-    conn.commit()
-    conn.close()
-
-def get_user_stats():
-    try:
-        logger.info(f"Получение статистики из БД: {DB_PATH}")
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''SELECT COUNT(*) as total_users,
-                            COUNT(CASE WHEN is_subscribed = 1 THEN 1 END) as subscribed_users,
-                            COUNT(CASE WHEN last_activity > datetime('now', '-1 day') THEN 1 END) as active_today
-                     FROM users''')
-        stats = c.fetchone()
-        conn.close()
-        logger.info(f"Статистика получена: total={stats[0]}, subscribed={stats[1]}, active={stats[2]}")
-        return {
-            'total_users': stats[0],
-            'subscribed_users': stats[1],
-            'active_today': stats[2]
-        }
-    except Exception as e:
-        logger.error(f"Ошибка при получении статистики: {e}")
-        return {
-            'total_users': 0,
-            'subscribed_users': 0,
-            'active_today': 0
-        }
-
-def get_active_users(days):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''SELECT COUNT(*) FROM users 
-                 WHERE last_activity > datetime('now', ?)''', 
-              (f'-{days} days',))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+def worker_id():
+    """Идентификатор процесса-владельца блокировок (вычисляется после fork)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
 
 # Middleware для логирования
 class LoggingMiddleware(BaseMiddleware):
     async def on_process_message(self, message: Message, data: dict):
-        logger.info(f"MIDDLEWARE: Получено сообщение от {message.from_user.id}: {message.text}")
-        logger.info(f"MIDDLEWARE: Тип сообщения: {message.content_type}")
-        if message.entities:
+        logger.debug("MIDDLEWARE: Получено сообщение от %s: %s", message.from_user.id, message.text)
+        logger.debug("MIDDLEWARE: Тип сообщения: %s", message.content_type)
+        if message.entities and logger.isEnabledFor(logging.DEBUG):
             commands = [message.text[e.offset:e.offset+e.length] for e in message.entities if e.type == 'bot_command']
-            logger.info(f"MIDDLEWARE: Команды в сообщении: {commands}")
+            logger.debug("MIDDLEWARE: Команды в сообщении: %s", commands)
         try:
-            update_user_activity(message.from_user.id)
+            db.update_user_activity(message.from_user.id)
         except Exception as e:
-            logger.error(f"MIDDLEWARE: Ошибка обновления активности: {e}")
+            logger.error("MIDDLEWARE: Ошибка обновления активности: %s", e)
         return data
 
     async def on_process_callback_query(self, callback: CallbackQuery, data: dict):
-        logger.info(f"MIDDLEWARE: Получен callback от {callback.from_user.id}: {callback.data}")
+        logger.debug("MIDDLEWARE: Получен callback от %s: %s", callback.from_user.id, callback.data)
         try:
-            update_user_activity(callback.from_user.id)
+            db.update_user_activity(callback.from_user.id)
         except Exception as e:
-            logger.error(f"MIDDLEWARE: Ошибка обновления активности: {e}")
+            logger.error("MIDDLEWARE: Ошибка обновления активности: %s", e)
         return data
 
+# Middleware для метрик: время от выбора обработчика до его завершения
+class MetricsMiddleware(BaseMiddleware):
+    async def on_process_message(self, message: Message, data: dict):
+        self._start(data)
+
+    async def on_process_callback_query(self, callback: CallbackQuery, data: dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message: Message, results: list, data: dict):
+        self._observe(data)
+
+    async def on_post_process_callback_query(self, callback: CallbackQuery, results: list, data: dict):
+        # Все нажатия проходят через callback_router.dispatch: в метке — выбранный им маршрут
+        if ROUTE_KEY in data:
+            data['metrics_handler'] = data[ROUTE_KEY]
+        self._observe(data)
+
+    @staticmethod
+    def _start(data):
+        data['metrics_handler'] = current_handler.get().__name__
+        data['metrics_start'] = time.perf_counter()
+
+    @staticmethod
+    def _observe(data):
+        # Если ни один обработчик не подошёл, on_process не вызывался
+        start = data.get('metrics_start')
+        if start is not None:
+            HANDLER_SECONDS.labels(data['metrics_handler']).observe(time.perf_counter() - start)
+
 # Регистрируем middleware
+dp.middleware.setup(MetricsMiddleware())
 dp.middleware.setup(LoggingMiddleware())
 
+# Нажатия inline-кнопок: один обработчик aiogram, обработчик выбирается
+# по префиксу callback_data в словаре маршрутов (см. callbacks.py)
+callback_router = CallbackRouter(legacy=upgrade_legacy)
+dp.register_callback_query_handler(callback_router.dispatch)
+
+# Ограничитель скорости, общий для всех рассылок всех воркеров, и рассылки,
+# выполняемые этим воркером: job_id -> (Broadcast, Task)
+broadcast_bucket = SharedTokenBucket(shared, "broadcast", BROADCAST_RATE, batch=BROADCAST_TOKEN_BATCH)
+active_broadcasts = {}
+# Выгрузки /export, которые готовит и отправляет этот воркер
+active_exports = set()
+
+# Клавиатуры и тексты ответов. Клавиатуры собираются и сериализуются в JSON
+# один раз при импорте, тексты с подстановками — шаблоны Template
+BACK_BUTTON = InlineKeyboardButton(text="🔙 Назад", callback_data=ADMIN.pack(screen="back"))
+BACK_KEYBOARD = keyboard([BACK_BUTTON])
+ADMIN_MENU_KEYBOARD = keyboard(
+    [InlineKeyboardButton(text="📊 Статистика", callback_data=ADMIN.pack(screen="stats"))],
+    [InlineKeyboardButton(text="📨 Рассылка", callback_data=ADMIN.pack(screen="broadcast"))],
+    [InlineKeyboardButton(text="👥 Управление пользователями", callback_data=ADMIN.pack(screen="users"))],
+    [InlineKeyboardButton(text="⚙️ Настройки", callback_data=ADMIN.pack(screen="settings"))]
+)
+ADMIN_USERS_KEYBOARD = keyboard(
+    [InlineKeyboardButton(text="🔍 Поиск пользователя", callback_data=ADMIN.pack(screen="search_user"))],
+    [InlineKeyboardButton(text="📋 Список пользователей", callback_data=ADMIN.pack(screen="list_users"))],
+    [BACK_BUTTON]
+)
+ADMIN_STATS_KEYBOARD = keyboard(
+    [InlineKeyboardButton(text="🕐 По часам", callback_data=ADMIN.pack(screen="stats_hourly"))],
+    [BACK_BUTTON]
+)
+STATS_HOURLY_KEYBOARD = keyboard(
+    [InlineKeyboardButton(text="📊 К статистике", callback_data=ADMIN.pack(screen="stats"))],
+    [BACK_BUTTON]
+)
+ADMIN_SETTINGS_KEYBOARD = keyboard(
+    [InlineKeyboardButton(text="📢 Канал", callback_data=ADMIN.pack(screen="channel_settings"))],
+    [InlineKeyboardButton(text="📝 Приветственное сообщение", callback_data=ADMIN.pack(screen="welcome_settings"))],
+    [BACK_BUTTON]
+)
+START_KEYBOARD = keyboard(
+    [InlineKeyboardButton(text="Подписаться на канал 📢", url=CHANNEL_LINK)],
+    [InlineKeyboardButton(text="Проверить подписку ✅", callback_data=SUBSCRIPTION.pack())]
+)
+SUBSCRIBE_KEYBOARD = keyboard(
+    [InlineKeyboardButton(text="Подписаться на канал 📢", url=CHANNEL_LINK)]
+)
+
+START_TEXT = "👋 Привет! Чтобы получить ответы на Гигтесты, пожалуйста, подпишись на канал"
+SUBSCRIBED_TEXT = (
+    "🎉 Спасибо за подписку. Держи файл с ответами на тесты: "
+    "https://docs.google.com/document/d/1wRpzasug5kSagNZgtG2QlSRMyK-7PP3ZYvNcejoDkoo/edit?usp=sharing"
+)
+NOT_SUBSCRIBED_TEXT = "😔 Упс. Кажется, ты не подписался на канал. Подпишись!"
+# По началу этого текста сообщение администратора распознаётся как ответ для рассылки
+BROADCAST_PROMPT = "📨 Отправьте сообщение для рассылки:"
+BROADCAST_PROMPT_TEXT = (
+    f"{BROADCAST_PROMPT}\n\n"
+    "Поддерживаются следующие типы сообщений:\n"
+    "• Текст\n"
+    "• Фото с подписью\n"
+    "• Документ с подписью"
+)
+ADMIN_USERS_TEXT = "👥 Управление пользователями:\n\nВыберите действие:"
+ADMIN_SETTINGS_TEXT = "⚙️ Настройки бота:\n\nВыберите настройку:"
+ADMIN_MENU_TEXT = Template(
+    "👋 Добро пожаловать в админ-панель!\n\n"
+    "📈 Общая статистика:\n"
+    "👥 Всего пользователей: {total_users}\n"
+    "✅ Подписано: {subscribed_users}\n"
+    "🟢 Активных за сутки: {active_today}"
+)
+ADMIN_STATS_TEXT = Template(
+    "📊 Статистика бота:\n\n"
+    "👥 Всего пользователей: {total_users}\n"
+    "✅ Подписано: {subscribed_users}\n"
+    "🟢 Активных за сутки: {active_today}\n\n"
+    "📈 Детальная статистика:\n"
+    "📅 За последние 7 дней: {active_week}\n"
+    "📅 За последние 30 дней: {active_month}"
+)
+# Действия stats в сводках статистики: действие -> подпись
+ANALYTICS_ACTIONS = {
+    "start": "▶️ /start",
+    "check_subscription": "🔎 Проверки подписки",
+    "subscribed": "✅ Подписка подтверждена",
+}
+ADMIN_ANALYTICS_TEXT = Template(
+    "🕐 События за 24 ч / 7 дн / 30 дн:\n"
+    "{events}\n\n"
+    "🔻 Воронка новых пользователей за 7 дн / 30 дн:\n"
+    "👋 Пришли: {started_week} / {started_month}\n"
+    "🔎 Проверили подписку: {checked_week} / {checked_month}\n"
+    "✅ Подписались: {subscribed_week} / {subscribed_month}\n\n"
+    "🔄 Сводка {rollup_at}{pending}"
+)
+STATS_HOURLY_TEXT = Template(
+    "🕐 События по часам за сутки (UTC):\n"
+    "▶️ /start · 🔎 проверки · ✅ подписки\n\n"
+    "{rows}"
+)
+USERS_PAGE_TEXT = Template("👥 Пользователи, стр. {page} (всего {total}):\n\n{rows}")
+# По началу этого текста сообщение администратора распознаётся как поисковый запрос
+USER_SEARCH_PROMPT = "🔍 Поиск пользователя"
+USER_SEARCH_PROMPT_TEXT = (
+    f"{USER_SEARCH_PROMPT}\n\n"
+    "Ответьте на это сообщение началом имени, фамилии, username или ID.\n"
+    "Несколько слов ищутся вместе: «иван пет» найдёт Ивана Петрова."
+)
+USER_SEARCH_PAGE_TEXT = Template("🔍 «{query}», стр. {page}:\n\n{rows}")
+USER_SEARCH_EMPTY_TEXT = Template("🔍 По запросу «{query}» никого не нашлось")
+EXPORT_USAGE_TEXT = (
+    "📦 Выгрузка таблицы в gzip-архиве:\n\n"
+    "/export users — пользователи, CSV\n"
+    "/export stats jsonl — события, JSON Lines\n\n"
+    f"Таблицы: {', '.join(TABLES)}. Форматы: {', '.join(FORMATS)}"
+)
+EXPORT_STARTED_TEXT = Template("⏳ Готовлю выгрузку {table}.{fmt}.gz, файл придёт отдельным сообщением")
+EMPTY_USERS_TEXT = Template(
+    "👥 Список пользователей пуст\n\n"
+    "📊 Всего пользователей в БД: {total_count}\n\n"
+    "💡 Попробуйте:\n"
+    "• Отправить боту команду /start\n"
+    "• Проверить статистику через /stats_raw"
+)
+
 # Регистрируем обработчики
 def register_handlers(dp):
     """Регистрация всех обработчиков"""
     logger.info("Регистрация обработчиков...")
     
-    # Все обработчики зарегистрированы через декораторы @dp.message_handler и @dp.callback_query_handler
+    # Все обработчики зарегистрированы через декораторы @dp.message_handler и @callback_router.route
     logger.info("Обработчики успешно зарегистрированы")
 
 @dp.message_handler(commands=["start"])
 async def cmd_start(message: Message):
     try:
         user_id = message.from_user.id
-        logger.info(f"CMD_START: Обработка команды /start от {user_id}")
-        logger.info(f"CMD_START: Текст сообщения: {message.text}")
-        logger.info(f"CMD_START: Пользователь: {message.from_user.username} ({message.from_user.first_name})")
+        logger.debug("CMD_START: Обработка команды /start от %s", user_id)
+        logger.debug("CMD_START: Текст сообщения: %s", message.text)
+        logger.debug("CMD_START: Пользователь: %s (%s)", message.from_user.username, message.from_user.first_name)
         
-        add_user(user_id, message.from_user.username, message.from_user.first_name, 
-                message.from_user.last_name, message.from_user.language_code)
-        update_user_activity(user_id)
-        log_action(user_id, "start")
+        await db.add_user(user_id, message.from_user.username, message.from_user.first_name,
+                          message.from_user.last_name, message.from_user.language_code)
+        db.update_user_activity(user_id)
+        db.log_action(user_id, "start")
         
-        markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Подписаться на канал 📢", url=CHANNEL_LINK)],
-            [InlineKeyboardButton(text="Проверить подписку ✅", callback_data="check_subscription")]
-        ])
-        
-        logger.info(f"CMD_START: Отправка сообщения пользователю {user_id}")
-        logger.info(f"CMD_START: CHANNEL_LINK = {CHANNEL_LINK}")
+        logger.debug("CMD_START: Отправка сообщения пользователю %s", user_id)
+        logger.debug("CMD_START: CHANNEL_LINK = %s", CHANNEL_LINK)
         try:
-            result = await bot.send_message(
-                user_id,
-                "👋 Привет! Чтобы получить ответы на Гигтесты, пожалуйста, подпишись на канал",
-                reply_markup=markup
-            )
-            logger.info(f"CMD_START: Сообщение успешно отправлено пользователю {user_id}")
-            logger.info(f"CMD_START: Результат отправки: message_id={result.message_id}")
+            result = await bot.send_message(user_id, START_TEXT, reply_markup=START_KEYBOARD)
+            logger.debug("CMD_START: Сообщение успешно отправлено пользователю %s", user_id)
+            logger.debug("CMD_START: Результат отправки: message_id=%s", result.message_id)
         except Exception as send_error:
-            logger.error(f"CMD_START: ОШИБКА при отправке сообщения: {send_error}")
-            logger.error(f"CMD_START: Тип ошибки: {type(send_error).__name__}")
-            logger.error(f"CMD_START: Трассировка: {traceback.format_exc()}")
+            logger.error("CMD_START: ОШИБКА при отправке сообщения: %s", send_error)
+            logger.error("CMD_START: Тип ошибки: %s", type(send_error).__name__)
+            logger.error("CMD_START: Трассировка: %s", traceback.format_exc())
             # Пробуем отправить простое сообщение без markup
             try:
-                logger.info(f"CMD_START: Пробуем отправить простое сообщение без кнопок")
-                await bot.send_message(user_id, "👋 Привет! Чтобы получить ответы на Гигтесты, пожалуйста, подпишись на канал")
-                logger.info(f"CMD_START: Простое сообщение отправлено успешно")
+                logger.debug("CMD_START: Пробуем отправить простое сообщение без кнопок")
+                await bot.send_message(user_id, START_TEXT)
+                logger.debug("CMD_START: Простое сообщение отправлено успешно")
             except Exception as simple_error:
-                logger.error(f"CMD_START: Не удалось отправить даже простое сообщение: {simple_error}")
+                logger.error("CMD_START: Не удалось отправить даже простое сообщение: %s", simple_error)
             raise
     except Exception as e:
-        logger.error(f"Ошибка в обработчике /start: {str(e)}")
-        logger.error(f"Полный стек ошибки: {traceback.format_exc()}")
+        logger.error("Ошибка в обработчике /start: %s", str(e))
+        logger.error("Полный стек ошибки: %s", traceback.format_exc())
         try:
             await bot.send_message(user_id, "❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
         except:
             pass
 
-@dp.callback_query_handler(lambda c: c.data == "check_subscription")
+# Кэш статусов подписки на канал: user_id -> (статус участника, получен ли он из API).
+# Подписанных помним дольше, чтобы неподписанный после подписки быстро увидел результат
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+membership_cache = TTLCache(
+    maxsize=MEMBERSHIP_CACHE_SIZE,
+    ttl=MEMBERSHIP_CACHE_TTL,
+    negative_ttl=MEMBERSHIP_CACHE_NEGATIVE_TTL,
+    is_positive=lambda entry: entry[0] in SUBSCRIBED_STATUSES
+)
+
+async def fetch_member_status(user_id):
+    """(статус, from_api): from_api ложно, если статус взят из общего кэша воркеров"""
+    if not SHARED_STATE:
+        member = await bot.get_chat_member(CHANNEL_ID, user_id)
+        return member.status, True
+    # Второй уровень кэша — общий для воркеров, чтобы не спрашивать API повторно
+    key = f"member:{user_id}"
+    status = await shared.get_value(key)
+    if status is not None:
+        return status, False
+    member = await bot.get_chat_member(CHANNEL_ID, user_id)
+    ttl = MEMBERSHIP_CACHE_TTL if member.status in SUBSCRIBED_STATUSES else MEMBERSHIP_CACHE_NEGATIVE_TTL
+    await shared.set_value(key, member.status, ttl)
+    return member.status, True
+
+@callback_router.route(SUBSCRIPTION)
 async def process_subscription(callback: CallbackQuery):
     try:
         user_id = callback.from_user.id
-        logger.info(f"CHECK_SUB: Начало обработки callback от {user_id}")
-        logger.info(f"CHECK_SUB: callback.data = {callback.data}")
-        logger.info(f"CHECK_SUB: CHANNEL_ID = {CHANNEL_ID}")
+        logger.debug("CHECK_SUB: Начало обработки callback от %s", user_id)
+        logger.debug("CHECK_SUB: callback.data = %s", callback.data)
+        logger.debug("CHECK_SUB: CHANNEL_ID = %s", CHANNEL_ID)
         
         # Отвечаем на callback сразу, чтобы пользователь видел реакцию
         await callback.answer("⏳ Проверяю подписку...")
-        logger.info(f"CHECK_SUB: Ответ на callback отправлен")
+        logger.debug("CHECK_SUB: Ответ на callback отправлен")
         
-        update_user_activity(user_id)
-        log_action(user_id, "check_subscription")
+        db.update_user_activity(user_id)
+        db.log_action(user_id, "check_subscription")
         
-        logger.info(f"CHECK_SUB: Проверка статуса подписки для user_id={user_id} в канале {CHANNEL_ID}")
+        logger.debug("CHECK_SUB: Проверка статуса подписки для user_id=%s в канале %s", user_id, CHANNEL_ID)
         try:
-            member = await bot.get_chat_member(CHANNEL_ID, user_id)
-            logger.info(f"CHECK_SUB: Статус подписки получен: {member.status}")
+            (status, from_api), loaded = await membership_cache.get_or_load(user_id, lambda: fetch_member_status(user_id))
+            fresh = loaded and from_api
+            logger.debug("CHECK_SUB: Статус подписки получен: %s (%s)", status, 'API' if fresh else 'кэш')
             
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute('UPDATE users SET is_subscribed = ? WHERE user_id = ?',
-                      (1 if member.status in ["member", "administrator", "creator"] else 0, user_id))
-            conn.commit()
-            conn.close()
+            # В БД пишем только свежий результат из API: его уже записал тот воркер,
+            # что положил статус в общий кэш, а повторные нажатия БД не трогают
+            changed = fresh and await db.set_subscribed(user_id, status in SUBSCRIBED_STATUSES)
             
-            if member.status in ["member", "administrator", "creator"]:
-                logger.info(f"CHECK_SUB: Пользователь {user_id} подписан (статус: {member.status})")
+            if status in SUBSCRIBED_STATUSES:
+                logger.debug("CHECK_SUB: Пользователь %s подписан (статус: %s)", user_id, status)
+                # Последний этап воронки start → проверка → подписка: только переход
+                # «не подписан → подписан» по данным API, а не каждое нажатие
+                if changed:
+                    db.log_action(user_id, "subscribed")
                 try:
-                    result = await bot.send_message(
-                        user_id,
-                        "🎉 Спасибо за подписку. Держи файл с ответами на тесты: "
-                        "https://docs.google.com/document/d/1wRpzasug5kSagNZgtG2QlSRMyK-7PP3ZYvNcejoDkoo/edit?usp=sharing"
-                    )
-                    logger.info(f"CHECK_SUB: Сообщение о подписке отправлено, message_id={result.message_id}")
+                    result = await bot.send_message(user_id, SUBSCRIBED_TEXT)
+                    logger.debug("CHECK_SUB: Сообщение о подписке отправлено, message_id=%s", result.message_id)
                 except Exception as send_error:
-                    logger.error(f"CHECK_SUB: Ошибка при отправке сообщения о подписке: {send_error}")
+                    logger.error("CHECK_SUB: Ошибка при отправке сообщения о подписке: %s", send_error)
             else:
-                logger.info(f"CHECK_SUB: Пользователь {user_id} НЕ подписан (статус: {member.status})")
-                markup = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="Подписаться на канал 📢", url=CHANNEL_LINK)]
-                ])
+                logger.debug("CHECK_SUB: Пользователь %s НЕ подписан (статус: %s)", user_id, status)
                 try:
-                    result = await bot.send_message(
-                        user_id,
-                        "😔 Упс. Кажется, ты не подписался на канал. Подпишись!",
-                        reply_markup=markup
-                    )
-                    logger.info(f"CHECK_SUB: Сообщение о неподписке отправлено, message_id={result.message_id}")
+                    result = await bot.send_message(user_id, NOT_SUBSCRIBED_TEXT, reply_markup=SUBSCRIBE_KEYBOARD)
+                    logger.debug("CHECK_SUB: Сообщение о неподписке отправлено, message_id=%s", result.message_id)
                 except Exception as send_error:
-                    logger.error(f"CHECK_SUB: Ошибка при отправке сообщения о неподписке: {send_error}")
+                    logger.error("CHECK_SUB: Ошибка при отправке сообщения о неподписке: %s", send_error)
             
-            logger.info(f"CHECK_SUB: Обработка завершена успешно для {user_id}")
+            logger.debug("CHECK_SUB: Обработка завершена успешно для %s", user_id)
         except Exception as e:
-            logger.error(f"CHECK_SUB: Ошибка при проверке подписки: {str(e)}")
-            logger.error(f"CHECK_SUB: Тип ошибки: {type(e).__name__}")
-            logger.error(f"CHECK_SUB: Трассировка: {traceback.format_exc()}")
+            logger.error("CHECK_SUB: Ошибка при проверке подписки: %s", str(e))
+            logger.error("CHECK_SUB: Тип ошибки: %s", type(e).__name__)
+            logger.error("CHECK_SUB: Трассировка: %s", traceback.format_exc())
             try:
                 await callback.answer("❌ Произошла ошибка при проверке подписки. Попробуйте позже.", show_alert=True)
             except Exception as answer_error:
-                logger.error(f"CHECK_SUB: Не удалось отправить ответ об ошибке: {answer_error}")
+                logger.error("CHECK_SUB: Не удалось отправить ответ об ошибке: %s", answer_error)
     except Exception as e:
-        logger.error(f"CHECK_SUB: КРИТИЧЕСКАЯ ОШИБКА: {str(e)}")
-        logger.error(f"CHECK_SUB: Тип ошибки: {type(e).__name__}")
-        logger.error(f"CHECK_SUB: Полная трассировка: {traceback.format_exc()}")
+        logger.error("CHECK_SUB: КРИТИЧЕСКАЯ ОШИБКА: %s", str(e))
+        logger.error("CHECK_SUB: Тип ошибки: %s", type(e).__name__)
+        logger.error("CHECK_SUB: Полная трассировка: %s", traceback.format_exc())
         try:
             await callback.answer("❌ Произошла ошибка. Попробуйте позже.", show_alert=True)
         except Exception as answer_error:
-            logger.error(f"CHECK_SUB: Не удалось отправить ответ об ошибке: {answer_error}")
+            logger.error("CHECK_SUB: Не удалось отправить ответ об ошибке: %s", answer_error)
             # Пробуем отправить сообщение напрямую
             try:
                 await bot.send_message(callback.from_user.id, "❌ Произошла ошибка при проверке подписки. Попробуйте позже.")
@@ -342,24 +578,10 @@ async def cmd_admin(message: Message):
             await message.answer("⛔️ У вас нет доступа к админ-панели")
             return
         
-        stats = get_user_stats()
-        markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton(text="📨 Рассылка", callback_data="admin_broadcast")],
-            [InlineKeyboardButton(text="👥 Управление пользователями", callback_data="admin_users")],
-            [InlineKeyboardButton(text="⚙️ Настройки", callback_data="admin_settings")]
-        ])
-        
-        await message.answer(
-            f"👋 Добро пожаловать в админ-панель!\n\n"
-            f"📈 Общая статистика:\n"
-            f"👥 Всего пользователей: {stats['total_users']}\n"
-            f"✅ Подписано: {stats['subscribed_users']}\n"
-            f"🟢 Активных за сутки: {stats['active_today']}",
-            reply_markup=markup
-        )
+        stats = await db.get_user_stats()
+        await message.answer(ADMIN_MENU_TEXT.render(stats), reply_markup=ADMIN_MENU_KEYBOARD)
     except Exception as e:
-        logger.error(f"Ошибка в обработчике /admin: {e}")
+        logger.error("Ошибка в обработчике /admin: %s", e)
         try:
             await message.answer("❌ Произошла ошибка при открытии админ-панели")
         except:
@@ -372,455 +594,674 @@ async def cmd_stats_raw(message: Message):
         await message.answer("⛔️ У вас нет доступа")
         return
     try:
-        logger.info(f"STATS_RAW: Получен запрос от {user_id}")
-        logger.info(f"STATS_RAW: Подключение к БД {DB_PATH}")
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users")
-        total = c.fetchone()[0]
-        logger.info(f"STATS_RAW: Всего пользователей: {total}")
-        c.execute("SELECT COUNT(*) FROM users WHERE is_subscribed = 1")
-        subs = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE last_activity > datetime('now','-1 day')")
-        active = c.fetchone()[0]
-        c.execute("SELECT user_id, username, first_name, last_name, last_activity FROM users ORDER BY last_activity DESC LIMIT 10")
-        rows = c.fetchall()
-        conn.close()
-        logger.info(f"STATS_RAW: Получено строк для отображения: {len(rows)}")
-
-        rows_text = "\n".join([f"ID {r[0]} @{r[1] or '—'} {r[2] or ''} {r[3] or ''} | {r[4]}" for r in rows]) or "—"
+        logger.debug("STATS_RAW: Получен запрос от %s", user_id)
+        logger.debug("STATS_RAW: Подключение к БД %s", DB_PATH)
+        total, subs, active, rows = await db.get_raw_stats()
+        logger.debug("STATS_RAW: Всего пользователей: %s", total)
+        logger.debug("STATS_RAW: Получено строк для отображения: %s", len(rows))
+
+        rows_text = "\n".join([f"ID {r[0]} @{r[1] or '—'} {r[2] or ''} {r[3] or ''} | "
+                               f"{datetime.fromtimestamp(r[4]).strftime('%d.%m.%Y %H:%M') if r[4] else '—'}"
+                               for r in rows]) or "—"
         response = (
             f"DB: {DB_PATH}\n"
             f"Всего: {total}\nПодписано: {subs}\nАктивны 24ч: {active}\n\nПоследние 10:\n{rows_text}"
         )
-        logger.info(f"STATS_RAW: Отправка ответа длиной {len(response)} символов")
+        logger.debug("STATS_RAW: Отправка ответа длиной %s символов", len(response))
         await message.answer(response)
-        logger.info(f"STATS_RAW: Ответ отправлен успешно")
+        logger.debug("STATS_RAW: Ответ отправлен успешно")
     except Exception as e:
-        logger.error(f"STATS_RAW: Ошибка: {e}")
-        logger.error(f"STATS_RAW: Трассировка: {traceback.format_exc()}")
+        logger.error("STATS_RAW: Ошибка: %s", e)
+        logger.error("STATS_RAW: Трассировка: %s", traceback.format_exc())
         await message.answer(f"❌ Ошибка stats_raw: {str(e)[:200]}")
 
-# ВАЖНО: Специфичные обработчики должны быть ПЕРЕД общим обработчиком
-# чтобы они имели приоритет при обработке callback запросов
+@dp.message_handler(commands=["slow"])
+async def cmd_slow(message: Message):
+    """Худшие блокировки event loop по обработчикам; /slow N — стек N-го нарушителя"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔️ У вас нет доступа")
+        return
+    try:
+        offenders = loop_watchdog.report()
+        arg = message.get_args()
+        if arg.isdigit() and 1 <= int(arg) <= len(offenders):
+            offender = offenders[int(arg) - 1]
+            await message.answer(
+                f"🐢 {offender['handler']} — {offender['location']}\n"
+                f"Блокировок: {offender['count']}, максимум {offender['max']:.3f} сек\n\n"
+                f"{offender['stack'][-3500:] or 'Стек не снят'}"
+            )
+            return
+
+        lines = [
+            f"🐢 Блокировки event loop (порог {LOOP_STALL_THRESHOLD:.3f} сек)\n",
+            f"Задержка сейчас: {loop_watchdog.lag:.3f} сек, максимум: {loop_watchdog.max_lag:.3f} сек",
+            f"Всего блокировок: {loop_watchdog.stalls}\n"
+        ]
+        for idx, offender in enumerate(offenders, 1):
+            lines.append(f"{idx}. {offender['handler']} — {offender['location']}\n"
+                         f"   {offender['count']} раз, всего {offender['total']:.3f} сек, "
+                         f"максимум {offender['max']:.3f} сек")
+        if offenders:
+            lines.append("\nСтек нарушителя: /slow N")
+        else:
+            lines.append("Блокировок не было")
+        await message.answer("\n".join(lines)[:4000])
+    except Exception as e:
+        logger.error("SLOW: Ошибка: %s", e)
+        await message.answer(f"❌ Ошибка slow: {str(e)[:200]}")
+
+@dp.message_handler(commands=["export"])
+async def cmd_export(message: Message):
+    """/export users|stats [csv|jsonl] — таблица целиком в gzip-архиве документом"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔️ У вас нет доступа")
+        return
+    args = message.get_args().lower().split()
+    table = args[0] if args else None
+    fmt = args[1] if len(args) > 1 else FORMATS[0]
+    if table not in TABLES or fmt not in FORMATS or len(args) > 2:
+        await message.answer(EXPORT_USAGE_TEXT)
+        return
+    # Выгрузка и загрузка файла идут в фоне: обновление подтверждается сразу
+    await message.answer(EXPORT_STARTED_TEXT.render({"table": table, "fmt": fmt}))
+    task = asyncio.create_task(send_export(message.chat.id, message.from_user.id, table, fmt))
+    active_exports.add(task)
+    task.add_done_callback(active_exports.discard)
 
-@dp.callback_query_handler(lambda c: c.data == "admin_list_users")
-async def process_list_users(callback: CallbackQuery):
+async def send_export(chat_id, user_id, table, fmt):
     try:
-        user_id = callback.from_user.id
-        logger.info("=" * 50)
-        logger.info(f"LIST_USERS: ====== НАЧАЛО ОБРАБОТКИ ======")
-        logger.info(f"LIST_USERS: Пользователь: {user_id}")
-        logger.info(f"LIST_USERS: callback.data: {callback.data}")
-        logger.info(f"LIST_USERS: callback.id: {callback.id}")
-        logger.info(f"LIST_USERS: callback.from_user: {callback.from_user}")
-        logger.info(f"LIST_USERS: ADMIN_IDS: {ADMIN_IDS}")
-        logger.info(f"LIST_USERS: Пользователь в ADMIN_IDS: {user_id in ADMIN_IDS}")
-        logger.info("=" * 50)
+        await bot.send_chat_action(chat_id, types.ChatActions.UPLOAD_DOCUMENT)
+        start = time.perf_counter()
+        spool, rows = await db.export_table(table, fmt, EXPORT_CHUNK_ROWS, EXPORT_SPOOL_SIZE)
+        with spool:
+            size = spool.seek(0, os.SEEK_END)
+            spool.seek(0)
+            logger.info("EXPORT: %s.%s: %s строк, %s байт за %.1f сек для %s",
+                        table, fmt, rows, size, time.perf_counter() - start, user_id)
+            if size > EXPORT_MAX_BYTES:
+                await bot.send_message(chat_id, f"❌ Архив {size / 2 ** 20:.1f} МБ больше предела Telegram "
+                                                f"{EXPORT_MAX_MB:g} МБ")
+                return
+            filename = f"{table}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{fmt}.gz"
+            size_text = f"{size / 2 ** 20:.1f} МБ" if size >= 2 ** 20 else f"{size / 2 ** 10:.1f} КБ"
+            await bot.send_document(chat_id, InputFile(spool, filename=filename),
+                                    caption=f"📦 {table}: {rows} строк, {size_text}")
+    except asyncio.CancelledError:
+        logger.warning("EXPORT: Выгрузка %s.%s для %s прервана остановкой воркера", table, fmt, user_id)
+        raise
+    except Exception as e:
+        logger.error("EXPORT: Ошибка выгрузки %s.%s: %s", table, fmt, e)
+        logger.error("EXPORT: Трассировка: %s", traceback.format_exc())
+        try:
+            await bot.send_message(chat_id, f"❌ Ошибка export: {str(e)[:200]}")
+        except:
+            pass
+
+def format_user_rows(rows, first_index):
+    """Строки списка пользователей с нумерацией от first_index"""
+    text = ""
+    for idx, user in enumerate(rows, first_index):
+        user_id_val, username, first_name, last_name, is_subscribed, last_activity = user
+        # Форматируем имя безопасно
+        name = f"{first_name or ''} {last_name or ''}".strip() or "Без имени"
+        username_display = f"@{username}" if username else "нет"
         
-        if user_id not in ADMIN_IDS:
-            logger.warning(f"LIST_USERS: Нет доступа для {user_id}")
+        text += f"{idx}. {name} ({username_display})\n"
+        text += f"   🆔 ID: {user_id_val}\n"
+        text += f"   ✅ Подписка: {'Да' if is_subscribed else 'Нет'}\n"
+        if last_activity:
+            # Форматируем дату для читаемости
+            try:
+                activity_time = datetime.fromtimestamp(last_activity)
+                activity_str = activity_time.strftime("%d.%m.%Y %H:%M")
+            except:
+                activity_str = str(last_activity)
+            text += f"   🕒 Активность: {activity_str}\n"
+        text += "\n"
+    # Лимит Telegram - 4096 символов; при разумном USERS_PAGE_SIZE не срабатывает
+    if len(text) > 4000:
+        text = text[:4000] + "\n\n... (текст обрезан)"
+    return text
+
+def users_page_keyboard(codec, page, rows, has_prev, has_next, cursor):
+    """Кнопки соседних страниц и «Назад»; cursor(row) — поля курсора codec для крайней строки"""
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            text=f"⬅️ {page - 1}", callback_data=codec.pack(direction="prev", page=page - 1, **cursor(rows[0]))))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            text=f"{page + 1} ➡️", callback_data=codec.pack(direction="next", page=page + 1, **cursor(rows[-1]))))
+    return keyboard(*([buttons] if buttons else []), [BACK_BUTTON])
+
+def list_cursor(row):
+    return {'last_activity': row[5], 'user_id': row[0]}
+
+def search_cursor(row):
+    return {'user_id': row[0]}
+
+async def load_page(load, page, cursor, backward):
+    """Страница через load(cursor, backward) -> (rows, more): (rows, page, has_prev, has_next)"""
+    rows, more = await load(cursor, backward)
+    if backward and len(rows) < USERS_PAGE_SIZE:
+        # Листали назад и упёрлись в начало: показываем первую страницу целиком
+        rows, more = await load(None, False)
+        return rows, 1, False, more
+    if backward:
+        return rows, page, more, True
+    return rows, page, cursor is not None, more
+
+async def show_users_page(callback: CallbackQuery, page=1, cursor=None, backward=False):
+    user_id = callback.from_user.id
+    # Отвечаем на callback сразу, чтобы пользователь видел реакцию
+    await callback.answer("⏳ Загрузка...")
+    
+    total_count = await db.count_users()
+    rows, page, has_prev, has_next = await load_page(
+        lambda cursor, backward: db.page_users(USERS_PAGE_SIZE, cursor, backward), page, cursor, backward)
+    logger.debug("LIST_USERS: Страница %s для %s: %s строк", page, user_id, len(rows))
+    
+    if rows:
+        text = USERS_PAGE_TEXT.render({'page': page, 'total': total_count,
+                                       'rows': format_user_rows(rows, (page - 1) * USERS_PAGE_SIZE + 1)})
+        markup = users_page_keyboard(USERS_PAGE, page, rows, has_prev, has_next, list_cursor)
+    else:
+        logger.warning("LIST_USERS: Список пуст! Всего в БД: %s", total_count)
+        text = EMPTY_USERS_TEXT.render({'total_count': total_count})
+        markup = BACK_KEYBOARD
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=markup)
+    except Exception as edit_error:
+        logger.error("LIST_USERS: Ошибка при редактировании сообщения: %s", edit_error)
+        # Если не удалось отредактировать, отправляем новое сообщение
+        await bot.send_message(user_id, text, reply_markup=markup)
+        logger.debug("LIST_USERS: Список отправлен новым сообщением для %s", user_id)
+
+@callback_router.route(USERS_PAGE)
+async def process_users_page(callback: CallbackQuery, direction: str, page: int, last_activity: int, user_id: int):
+    """Листание списка пользователей: курсор — крайняя строка соседней страницы"""
+    try:
+        if callback.from_user.id not in ADMIN_IDS:
             await callback.answer("⛔️ У вас нет доступа", show_alert=True)
             return
-        
-        # Отвечаем на callback сразу, чтобы пользователь видел реакцию
-        await callback.answer("⏳ Загрузка...")
-        
-        logger.info(f"LIST_USERS: Подключение к БД {DB_PATH}")
+        await show_users_page(callback, page, (last_activity, user_id), direction == "prev")
+    except Exception as e:
+        logger.error("LIST_USERS: Ошибка при листании: %s: %s", type(e).__name__, e)
+        logger.error("LIST_USERS: Трассировка: %s", traceback.format_exc())
         try:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # Сначала проверяем общее количество пользователей
-            c.execute('SELECT COUNT(*) FROM users')
-            total_count = c.fetchone()[0]
-            logger.info(f"LIST_USERS: Всего пользователей в БД: {total_count}")
-            
-            # Получаем список пользователей
-            c.execute('SELECT user_id, username, first_name, last_name, is_subscribed, last_activity FROM users ORDER BY last_activity DESC LIMIT 10')
-            users = c.fetchall()
-            conn.close()
-            logger.info(f"LIST_USERS: Найдено пользователей в выборке: {len(users)}")
-            
-            # Логируем детали каждого пользователя
-            if users:
-                logger.info(f"LIST_USERS: Детали пользователей:")
-                for idx, user in enumerate(users, 1):
-                    logger.info(f"LIST_USERS:   {idx}. ID={user[0]}, username={user[1]}, name={user[2]} {user[3]}")
-            else:
-                logger.warning(f"LIST_USERS: В БД нет пользователей, хотя total_count={total_count}")
-        except Exception as db_error:
-            logger.error(f"LIST_USERS: Ошибка БД: {db_error}")
-            await callback.message.edit_text(
-                f"❌ Ошибка при подключении к базе данных:\n{str(db_error)[:200]}",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-                ])
-            )
+            await callback.answer("❌ Ошибка при загрузке списка", show_alert=True)
+        except:
+            pass
+
+async def render_search_page(query, page=1, cursor=None, backward=False):
+    """Текст и клавиатура страницы результатов поиска"""
+    rows, page, has_prev, has_next = await load_page(
+        lambda cursor, backward: db.search_users(query, USERS_PAGE_SIZE, cursor, backward), page, cursor, backward)
+    if not rows:
+        return USER_SEARCH_EMPTY_TEXT.render({'query': query}), BACK_KEYBOARD
+    text = USER_SEARCH_PAGE_TEXT.render({'query': query, 'page': page,
+                                         'rows': format_user_rows(rows, (page - 1) * USERS_PAGE_SIZE + 1)})
+    return text, users_page_keyboard(USER_SEARCH_PAGE, page, rows, has_prev, has_next, search_cursor)
+
+async def show_user_search(callback: CallbackQuery):
+    await callback.answer()
+    await callback.message.edit_text(USER_SEARCH_PROMPT_TEXT, reply_markup=BACK_KEYBOARD)
+
+@dp.message_handler(lambda message: message.from_user.id in ADMIN_IDS and message.reply_to_message and (message.reply_to_message.text or "").startswith(USER_SEARCH_PROMPT))
+async def process_user_search(message: Message):
+    try:
+        query = (message.text or "").strip()[:100]
+        logger.debug("USER_SEARCH: Запрос '%s' от %s", query, message.from_user.id)
+        text, markup = await render_search_page(query)
+        result = await message.answer(text, reply_markup=markup)
+        # Кнопки листания ссылаются на запрос по сообщению с результатами
+        await shared.set_value(f"user_search:{result.chat.id}:{result.message_id}", query, USER_SEARCH_TTL)
+    except Exception as e:
+        logger.error("USER_SEARCH: Ошибка поиска: %s: %s", type(e).__name__, e)
+        logger.error("USER_SEARCH: Трассировка: %s", traceback.format_exc())
+        try:
+            await message.answer("❌ Произошла ошибка при поиске")
+        except:
+            pass
+
+@callback_router.route(USER_SEARCH_PAGE)
+async def process_user_search_page(callback: CallbackQuery, direction: str, page: int, user_id: int):
+    """Листание результатов поиска: запрос хранится в общем состоянии по сообщению"""
+    try:
+        if callback.from_user.id not in ADMIN_IDS:
+            await callback.answer("⛔️ У вас нет доступа", show_alert=True)
             return
-        
-        if not users:
-            logger.warning(f"LIST_USERS: Список пуст! Всего в БД: {total_count}, но выборка вернула 0")
-            markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-            ])
-            message_text = (
-                f"👥 Список пользователей пуст\n\n"
-                f"📊 Всего пользователей в БД: {total_count}\n\n"
-                f"💡 Попробуйте:\n"
-                f"• Отправить боту команду /start\n"
-                f"• Проверить статистику через /stats_raw"
-            )
-            try:
-                await callback.message.edit_text(message_text, reply_markup=markup)
-                logger.info("LIST_USERS: Сообщение о пустом списке отправлено")
-            except Exception as edit_error:
-                logger.error(f"LIST_USERS: Не удалось отредактировать сообщение: {edit_error}")
-                try:
-                    await bot.send_message(user_id, message_text, reply_markup=markup)
-                    logger.info("LIST_USERS: Сообщение о пустом списке отправлено новым сообщением")
-                except Exception as send_error:
-                    logger.error(f"LIST_USERS: Не удалось отправить новое сообщение: {send_error}")
-                    await callback.answer("❌ Список пуст", show_alert=True)
+        query = await shared.get_value(f"user_search:{callback.message.chat.id}:{callback.message.message_id}")
+        if query is None:
+            await callback.answer("⌛️ Результаты поиска устарели, повторите поиск", show_alert=True)
             return
-        
-        text = "👥 Список пользователей:\n\n"
-        for idx, user in enumerate(users, 1):
-            user_id_val, username, first_name, last_name, is_subscribed, last_activity = user
-            # Форматируем имя безопасно
-            name = f"{first_name or ''} {last_name or ''}".strip() or "Без имени"
-            username_display = f"@{username}" if username else "нет"
-            
-            text += f"{idx}. {name} ({username_display})\n"
-            text += f"   🆔 ID: {user_id_val}\n"
-            text += f"   ✅ Подписка: {'Да' if is_subscribed else 'Нет'}\n"
-            if last_activity:
-                # Форматируем дату для читаемости
-                try:
-                    activity_time = datetime.fromisoformat(last_activity) if isinstance(last_activity, str) else last_activity
-                    activity_str = activity_time.strftime("%d.%m.%Y %H:%M")
-                except:
-                    activity_str = str(last_activity)
-                text += f"   🕒 Активность: {activity_str}\n"
-            text += "\n"
-        
-        # Проверяем длину текста (лимит Telegram - 4096 символов)
-        if len(text) > 4000:
-            text = text[:4000] + "\n\n... (текст обрезан)"
-        
-        markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ])
-        
-        logger.info(f"LIST_USERS: Отправка списка длиной {len(text)} символов")
-        logger.info(f"LIST_USERS: Тип callback.message: {type(callback.message)}")
-        logger.info(f"LIST_USERS: callback.message.message_id: {callback.message.message_id if hasattr(callback.message, 'message_id') else 'N/A'}")
-        
-        try:
-            # Пробуем отредактировать сообщение
-            if hasattr(callback.message, 'edit_text'):
-                logger.info("LIST_USERS: Пробуем edit_text")
-                await callback.message.edit_text(text, reply_markup=markup)
-                logger.info(f"LIST_USERS: Успешно отредактировано для {user_id}")
-            else:
-                logger.warning("LIST_USERS: callback.message не имеет метода edit_text, отправляем новое сообщение")
-                raise AttributeError("Message object has no edit_text method")
-        except Exception as edit_error:
-            logger.error(f"LIST_USERS: Ошибка при редактировании сообщения: {edit_error}")
-            logger.error(f"LIST_USERS: Тип ошибки: {type(edit_error).__name__}")
-            logger.error(f"LIST_USERS: Трассировка: {traceback.format_exc()}")
-            
-            # Если не удалось отредактировать, отправляем новое сообщение
-            try:
-                logger.info(f"LIST_USERS: Пробуем отправить новое сообщение пользователю {user_id}")
-                await bot.send_message(
-                    user_id, 
-                    text, 
-                    reply_markup=markup
-                )
-                logger.info(f"LIST_USERS: Список отправлен новым сообщением для {user_id}")
-                # Отвечаем на callback, чтобы убрать индикатор загрузки
-                try:
-                    await callback.answer("✅ Список отправлен", show_alert=False)
-                except:
-                    pass
-            except Exception as send_error:
-                logger.error(f"LIST_USERS: Не удалось отправить новое сообщение: {send_error}")
-                logger.error(f"LIST_USERS: Тип ошибки отправки: {type(send_error).__name__}")
-                logger.error(f"LIST_USERS: Трассировка отправки: {traceback.format_exc()}")
-                try:
-                    await callback.answer("❌ Ошибка при отправке списка", show_alert=True)
-                except:
-                    pass
+        await callback.answer("⏳ Загрузка...")
+        text, markup = await render_search_page(query, page, user_id, direction == "prev")
+        await callback.message.edit_text(text, reply_markup=markup)
     except Exception as e:
-        logger.error(f"LIST_USERS: КРИТИЧЕСКАЯ ОШИБКА - {type(e).__name__}: {e}")
-        logger.error(f"LIST_USERS: Полная трассировка: {traceback.format_exc()}")
+        logger.error("USER_SEARCH: Ошибка при листании: %s: %s", type(e).__name__, e)
+        logger.error("USER_SEARCH: Трассировка: %s", traceback.format_exc())
         try:
-            await callback.answer(f"❌ Ошибка: {str(e)[:100]}", show_alert=True)
-        except Exception as answer_error:
-            logger.error(f"LIST_USERS: Не удалось отправить ответ об ошибке: {answer_error}")
-            # Попробуем отправить сообщение напрямую
-            try:
-                await bot.send_message(user_id, f"❌ Произошла ошибка при получении списка пользователей:\n{str(e)[:200]}")
-            except:
-                pass
+            await callback.answer("❌ Ошибка при загрузке результатов", show_alert=True)
+        except:
+            pass
 
-@dp.callback_query_handler(lambda c: c.data == "admin_broadcast")
 async def process_broadcast_callback(callback: CallbackQuery):
     try:
         user_id = callback.from_user.id
-        logger.info(f"Обработка callback admin_broadcast от {user_id}")
+        logger.debug("Обработка callback admin_broadcast от %s", user_id)
         
         if user_id not in ADMIN_IDS:
-            logger.warning(f"Попытка доступа к рассылке от неавторизованного пользователя {user_id}")
+            logger.warning("Попытка доступа к рассылке от неавторизованного пользователя %s", user_id)
             await callback.answer("⛔️ У вас нет доступа")
             return
         
-        logger.info(f"Обработка действия broadcast для пользователя {user_id}")
+        logger.debug("Обработка действия broadcast для пользователя %s", user_id)
         
-        markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ])
-        
-        await callback.message.edit_text(
-            "📨 Отправьте сообщение для рассылки:\n\n"
-            "Поддерживаются следующие типы сообщений:\n"
-            "• Текст\n"
-            "• Фото с подписью\n"
-            "• Документ с подписью",
-            reply_markup=markup
-        )
+        await callback.message.edit_text(BROADCAST_PROMPT_TEXT, reply_markup=BACK_KEYBOARD)
         
         await callback.answer()
-        logger.info(f"Обработка callback admin_broadcast завершена успешно")
+        logger.debug("Обработка callback admin_broadcast завершена успешно")
     except Exception as e:
-        logger.error(f"Ошибка при обработке рассылки: {type(e).__name__}: {e}")
+        logger.error("Ошибка при обработке рассылки: %s: %s", type(e).__name__, e)
         try:
             await callback.answer("❌ Произошла ошибка")
         except:
             pass
 
-# Общий обработчик для админ-кнопок (должен быть ПОСЛЕ специфичных)
-@dp.callback_query_handler(lambda c: c.data.startswith("admin_") and c.data not in ["admin_list_users", "admin_broadcast"])
-async def process_admin_callback(callback: CallbackQuery):
+def share(part, whole):
+    """Число и его доля от whole в процентах"""
+    return f"{part} ({part * 100 // whole}%)" if whole else str(part)
+
+def format_analytics(analytics):
+    """Раздел событий и воронки для экрана статистики"""
+    events = "\n".join(
+        f"{label}: {analytics['events_day'].get(action, 0)} / {analytics['events_week'].get(action, 0)} / "
+        f"{analytics['events_month'].get(action, 0)}"
+        for action, label in ANALYTICS_ACTIONS.items()
+    )
+    week, month = analytics['funnel_week'], analytics['funnel_month']
+    pending = analytics['pending']
+    return ADMIN_ANALYTICS_TEXT.render({
+        'events': events,
+        'started_week': week['started'],
+        'started_month': month['started'],
+        'checked_week': share(week['checked'], week['started']),
+        'checked_month': share(month['checked'], month['started']),
+        'subscribed_week': share(week['subscribed'], week['started']),
+        'subscribed_month': share(month['subscribed'], month['started']),
+        'rollup_at': datetime.utcfromtimestamp(analytics['rollup_at']).strftime('на %d.%m %H:%M UTC')
+                     if analytics['rollup_at'] else "ещё не составлялась",
+        'pending': f"\n⏳ Ещё не учтено событий: {pending}" if pending > 0 else "",
+    })
+
+async def show_admin_stats(callback: CallbackQuery):
+    await callback.answer()
+    # Только материализованные счётчики и сводки: сырые строки stats не читаются
+    stats, analytics = await asyncio.gather(db.get_user_stats(), db.get_analytics())
+    text = f"{ADMIN_STATS_TEXT.render(stats)}\n\n{format_analytics(analytics)}"
+    await callback.message.edit_text(text, reply_markup=ADMIN_STATS_KEYBOARD)
+
+async def show_stats_hourly(callback: CallbackQuery):
+    await callback.answer()
+    counts = {}
+    for hour, action, events in await db.get_hourly_events(24):
+        counts.setdefault(hour, {})[action] = events
+    # Все 24 часа, включая пустые, чтобы провалы были видны
+    current = int(time.time()) // 3600
+    rows = "\n".join(
+        f"{datetime.utcfromtimestamp(hour * 3600).strftime('%H:00')}  "
+        + " · ".join(str(counts.get(hour, {}).get(action, 0)) for action in ANALYTICS_ACTIONS)
+        for hour in range(current - 23, current + 1)
+    )
+    await callback.message.edit_text(STATS_HOURLY_TEXT.render({'rows': rows}), reply_markup=STATS_HOURLY_KEYBOARD)
+
+async def show_admin_users(callback: CallbackQuery):
+    await callback.answer()
+    user_id = callback.from_user.id
+    try:
+        logger.debug("PROCESS_ADMIN: Попытка edit_text для action='users'")
+        await callback.message.edit_text(ADMIN_USERS_TEXT, reply_markup=ADMIN_USERS_KEYBOARD)
+        logger.debug("PROCESS_ADMIN: edit_text успешно выполнен для action='users'")
+    except Exception as edit_error:
+        logger.error("PROCESS_ADMIN: Ошибка edit_text для action='users': %s", edit_error)
+        logger.error("PROCESS_ADMIN: Тип ошибки: %s", type(edit_error).__name__)
+        logger.error("PROCESS_ADMIN: Трассировка: %s", traceback.format_exc())
+        # Пробуем отправить новое сообщение
+        await bot.send_message(user_id, ADMIN_USERS_TEXT, reply_markup=ADMIN_USERS_KEYBOARD)
+        logger.debug("PROCESS_ADMIN: Новое сообщение отправлено для action='users'")
+
+async def show_admin_settings(callback: CallbackQuery):
+    await callback.answer()
+    await callback.message.edit_text(ADMIN_SETTINGS_TEXT, reply_markup=ADMIN_SETTINGS_KEYBOARD)
+
+async def show_admin_menu(callback: CallbackQuery):
+    await callback.answer()
+    stats = await db.get_user_stats()
+    await callback.message.edit_text(ADMIN_MENU_TEXT.render(stats), reply_markup=ADMIN_MENU_KEYBOARD)
+
+# Разделы админ-панели: screen из callback_data -> обработчик.
+# Разделов настроек канала и приветствия пока нет:
+# их кнопки получают явный ответ, а не остаются без реакции
+ADMIN_SCREENS = {
+    "stats": show_admin_stats,
+    "stats_hourly": show_stats_hourly,
+    "broadcast": process_broadcast_callback,
+    "users": show_admin_users,
+    "list_users": show_users_page,
+    "search_user": show_user_search,
+    "settings": show_admin_settings,
+    "back": show_admin_menu,
+}
+
+@callback_router.route(ADMIN)
+async def process_admin_callback(callback: CallbackQuery, screen: str):
     try:
         user_id = callback.from_user.id
-        logger.info("=" * 50)
-        logger.info(f"PROCESS_ADMIN: ====== НАЧАЛО ОБРАБОТКИ ======")
-        logger.info(f"PROCESS_ADMIN: callback.data = {callback.data}")
-        logger.info(f"PROCESS_ADMIN: Пользователь: {user_id}")
-        logger.info(f"PROCESS_ADMIN: ADMIN_IDS: {ADMIN_IDS}")
-        logger.info(f"PROCESS_ADMIN: Проверка исключений: admin_list_users={callback.data == 'admin_list_users'}, admin_broadcast={callback.data == 'admin_broadcast'}")
+        logger.debug("PROCESS_ADMIN: Раздел '%s', пользователь %s", screen, user_id)
         
         if user_id not in ADMIN_IDS:
-            logger.warning(f"PROCESS_ADMIN: Нет доступа для {user_id}")
+            logger.warning("PROCESS_ADMIN: Нет доступа для %s", user_id)
             await callback.answer("⛔️ У вас нет доступа", show_alert=True)
             return
         
-        # Отвечаем на callback сразу, чтобы пользователь видел реакцию
-        try:
-            await callback.answer()
-            logger.info(f"PROCESS_ADMIN: callback.answer() выполнен")
-        except Exception as answer_error:
-            logger.error(f"PROCESS_ADMIN: Ошибка при callback.answer(): {answer_error}")
-        
-        action = callback.data.split("_")[1]
-        logger.info(f"PROCESS_ADMIN: Обработка действия action='{action}' для пользователя {user_id}")
+        show_screen = ADMIN_SCREENS.get(screen)
+        if show_screen is None:
+            logger.warning("PROCESS_ADMIN: Раздел '%s' не реализован (от %s)", screen, user_id)
+            await callback.answer("🚧 Этот раздел пока недоступен", show_alert=True)
+            return
         
-        try:
-            if action == "stats":
-                stats = get_user_stats()
-                markup = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-                ])
-                await callback.message.edit_text(
-                    f"📊 Статистика бота:\n\n"
-                    f"👥 Всего пользователей: {stats['total_users']}\n"
-                    f"✅ Подписано: {stats['subscribed_users']}\n"
-                    f"🟢 Активных за сутки: {stats['active_today']}\n\n"
-                    f"📈 Детальная статистика:\n"
-                    f"📅 За последние 7 дней: {get_active_users(7)}\n"
-                    f"📅 За последние 30 дней: {get_active_users(30)}",
-                    reply_markup=markup
-                )
-            elif action == "broadcast":
-                markup = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-                ])
-                await callback.message.edit_text(
-                    "📨 Отправьте сообщение для рассылки:\n\n"
-                    "Поддерживаются следующие типы сообщений:\n"
-                    "• Текст\n"
-                    "• Фото с подписью\n"
-                    "• Документ с подписью",
-                    reply_markup=markup
-                )
-            elif action == "users":
-                logger.info(f"PROCESS_ADMIN: Обработка action='users' для {user_id}")
-                markup = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔍 Поиск пользователя", callback_data="admin_search_user")],
-                    [InlineKeyboardButton(text="📋 Список пользователей", callback_data="admin_list_users")],
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-                ])
-                try:
-                    logger.info(f"PROCESS_ADMIN: Попытка edit_text для action='users'")
-                    await callback.message.edit_text(
-                        "👥 Управление пользователями:\n\n"
-                        "Выберите действие:",
-                        reply_markup=markup
-                    )
-                    logger.info(f"PROCESS_ADMIN: edit_text успешно выполнен для action='users'")
-                except Exception as edit_error:
-                    logger.error(f"PROCESS_ADMIN: Ошибка edit_text для action='users': {edit_error}")
-                    logger.error(f"PROCESS_ADMIN: Тип ошибки: {type(edit_error).__name__}")
-                    logger.error(f"PROCESS_ADMIN: Трассировка: {traceback.format_exc()}")
-                    # Пробуем отправить новое сообщение
-                    try:
-                        await bot.send_message(
-                            user_id,
-                            "👥 Управление пользователями:\n\n"
-                            "Выберите действие:",
-                            reply_markup=markup
-                        )
-                        logger.info(f"PROCESS_ADMIN: Новое сообщение отправлено для action='users'")
-                    except Exception as send_error:
-                        logger.error(f"PROCESS_ADMIN: Ошибка отправки нового сообщения: {send_error}")
-                        raise
-            elif action == "settings":
-                markup = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="📢 Канал", callback_data="admin_channel_settings")],
-                    [InlineKeyboardButton(text="📝 Приветственное сообщение", callback_data="admin_welcome_settings")],
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-                ])
-                await callback.message.edit_text(
-                    "⚙️ Настройки бота:\n\n"
-                    "Выберите настройку:",
-                    reply_markup=markup
-                )
-            elif action == "back":
-                stats = get_user_stats()
-                markup = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-                    [InlineKeyboardButton(text="📨 Рассылка", callback_data="admin_broadcast")],
-                    [InlineKeyboardButton(text="👥 Управление пользователями", callback_data="admin_users")],
-                    [InlineKeyboardButton(text="⚙️ Настройки", callback_data="admin_settings")]
-                ])
-                await callback.message.edit_text(
-                    f"👋 Добро пожаловать в админ-панель!\n\n"
-                    f"📈 Общая статистика:\n"
-                    f"👥 Всего пользователей: {stats['total_users']}\n"
-                    f"✅ Подписано: {stats['subscribed_users']}\n"
-                    f"🟢 Активных за сутки: {stats['active_today']}",
-                    reply_markup=markup
-                )
-            
-            # callback.answer() уже вызван в начале функции
-            logger.info(f"PROCESS_ADMIN: Обработка action='{action}' завершена успешно")
-        except Exception as e:
-            logger.error(f"PROCESS_ADMIN: Ошибка при обработке действия {action}: {type(e).__name__}: {e}")
-            logger.error(f"PROCESS_ADMIN: Трассировка: {traceback.format_exc()}")
-            try:
-                await callback.answer("❌ Произошла ошибка при обработке запроса", show_alert=True)
-            except:
-                pass
+        # Каждый раздел сам отвечает на callback, как только это возможно
+        await show_screen(callback)
+        logger.debug("PROCESS_ADMIN: Обработка раздела '%s' завершена успешно", screen)
     except Exception as e:
-        logger.error(f"PROCESS_ADMIN: КРИТИЧЕСКАЯ ОШИБКА при обработке callback {callback.data}: {type(e).__name__}: {e}")
-        logger.error(f"PROCESS_ADMIN: Полная трассировка: {traceback.format_exc()}")
+        logger.error("PROCESS_ADMIN: Ошибка при обработке раздела %s: %s: %s", screen, type(e).__name__, e)
+        logger.error("PROCESS_ADMIN: Трассировка: %s", traceback.format_exc())
         try:
-            await callback.answer("❌ Произошла ошибка", show_alert=True)
+            await callback.answer("❌ Произошла ошибка при обработке запроса", show_alert=True)
         except:
             pass
-        logger.info("=" * 50)
 
-@dp.message_handler(lambda message: message.from_user.id in ADMIN_IDS and message.reply_to_message and message.reply_to_message.text.startswith("📨 Отправьте сообщение для рассылки:"))
+@dp.message_handler(lambda message: message.from_user.id in ADMIN_IDS and message.reply_to_message and message.reply_to_message.text.startswith(BROADCAST_PROMPT))
 async def process_broadcast_message(message: Message):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT user_id FROM users')
-        users = c.fetchall()
-        conn.close()
-        
-        success = 0
-        failed = 0
-        
-        for user in users:
-            try:
-                await message.copy_to(user[0])
-                success += 1
-            except Exception as e:
-                failed += 1
-                logger.error(f"Не удалось отправить сообщение пользователю {user[0]}: {e}")
-        
-        await message.answer(
-            f"✅ Рассылка завершена!\n\n"
-            f"📊 Результаты:\n"
-            f"• Успешно отправлено: {success}\n"
-            f"• Не удалось отправить: {failed}"
-        )
+        progress = await message.answer("📨 Рассылка запущена...")
+        job = await db.create_broadcast_job(message.chat.id, message.message_id,
+                                            progress.chat.id, progress.message_id)
+        # Рассылка идёт в фоне, чтобы не держать обработчик и webhook
+        if await claim_broadcast(job['id']):
+            start_broadcast(job)
     except Exception as e:
-        logger.error(f"Ошибка при рассылке: {e}")
+        logger.error("Ошибка при рассылке: %s", e)
         try:
             await message.answer("❌ Произошла ошибка при рассылке")
         except:
             pass
 
+@callback_router.route(BROADCAST_CONTROL)
+async def process_broadcast_control(callback: CallbackQuery, action: str, job_id: int):
+    """Кнопки паузы, продолжения и отмены под сообщением о ходе рассылки"""
+    try:
+        user_id = callback.from_user.id
+        if user_id not in ADMIN_IDS:
+            await callback.answer("⛔️ У вас нет доступа", show_alert=True)
+            return
+
+        job = await db.get_broadcast_job(job_id)
+        if not job:
+            await callback.answer("❌ Рассылка не найдена", show_alert=True)
+            return
+        logger.info("BROADCAST: Команда %s для рассылки #%s (статус %s) от %s", action, job['id'], job['status'], user_id)
+
+        active = active_broadcasts.get(job['id'])
+        if action == "pause":
+            if active:
+                active[0].stop('paused')
+            elif job['status'] in ('running', 'interrupted'):
+                await stop_broadcast_elsewhere(job, 'paused')
+            await callback.answer("⏸ Рассылка ставится на паузу")
+        elif action == "resume":
+            if active:
+                await callback.answer("⏳ Рассылка ещё выполняется или останавливается")
+            elif job['status'] == 'paused' and await claim_broadcast(job['id']):
+                await db.set_broadcast_status(job['id'], 'running')
+                start_broadcast(job)
+                await callback.answer("▶️ Рассылка продолжена")
+            elif job['status'] == 'paused':
+                await callback.answer("⏳ Рассылка ещё выполняется или останавливается")
+            else:
+                await callback.answer("❌ Эту рассылку нельзя продолжить", show_alert=True)
+        elif action == "cancel":
+            if active:
+                active[0].stop('cancelled')
+            elif job['status'] not in ('done', 'cancelled'):
+                if await stop_broadcast_elsewhere(job, 'cancelled'):
+                    job['status'] = 'cancelled'
+                    await make_broadcast(job).show_result()
+            await callback.answer("⛔️ Рассылка отменена")
+        else:
+            await callback.answer("❌ Неизвестная команда", show_alert=True)
+    except Exception as e:
+        logger.error("BROADCAST: Ошибка при управлении рассылкой: %s: %s", type(e).__name__, e)
+        try:
+            await callback.answer("❌ Произошла ошибка", show_alert=True)
+        except:
+            pass
+
+def make_broadcast(job):
+    return Broadcast(
+        bot, db, job, broadcast_bucket,
+        concurrency=BROADCAST_CONCURRENCY,
+        page_size=BROADCAST_PAGE_SIZE,
+        progress_interval=BROADCAST_PROGRESS_INTERVAL
+    )
+
+async def claim_broadcast(job_id):
+    """Закрепляет рассылку за этим воркером; False, если её уже выполняет другой"""
+    return await shared.acquire_lock(f"broadcast:{job_id}", worker_id(), BROADCAST_LEASE_TTL)
+
+async def stop_broadcast_elsewhere(job, status):
+    """Пауза или отмена рассылки, которую этот воркер не выполняет.
+
+    Если рассылка ничья, статус меняется сразу (True). Иначе владельцу
+    передаётся команда через общее состояние, и он остановится сам (False).
+    """
+    if await claim_broadcast(job['id']):
+        try:
+            await db.set_broadcast_status(job['id'], status)
+        finally:
+            await shared.release_lock(f"broadcast:{job['id']}", worker_id())
+        return True
+    await shared.set_value(f"broadcast:{job['id']}:stop", status, BROADCAST_LEASE_TTL)
+    return False
+
+def start_broadcast(job):
+    """Запускает (или продолжает) рассылку по заданию в фоновой задаче.
+
+    Блокировка рассылки уже должна быть взята через claim_broadcast
+    """
+    broadcast = make_broadcast(job)
+    task = asyncio.create_task(run_broadcast(broadcast))
+    active_broadcasts[job['id']] = (broadcast, task)
+    task.add_done_callback(lambda _: active_broadcasts.pop(job['id'], None))
+    return broadcast
+
+async def hold_broadcast_lease(broadcast):
+    """Продлевает блокировку рассылки и принимает команды остановки от других воркеров"""
+    name, owner = f"broadcast:{broadcast.job_id}", worker_id()
+    stop_key = f"{name}:stop"
+    await shared.delete_value(stop_key)
+    loop = asyncio.get_running_loop()
+    renew_at = loop.time() + BROADCAST_LEASE_TTL / 3
+    while True:
+        await asyncio.sleep(BROADCAST_CONTROL_POLL)
+        status = await shared.get_value(stop_key)
+        if status:
+            await shared.delete_value(stop_key)
+            broadcast.stop(status)
+        if loop.time() >= renew_at:
+            renew_at = loop.time() + BROADCAST_LEASE_TTL / 3
+            if not await shared.acquire_lock(name, owner, BROADCAST_LEASE_TTL):
+                # Блокировку забрал другой воркер (например, этот долго не отвечал)
+                logger.error("BROADCAST: Рассылка #%s потеряла блокировку, останавливаем", broadcast.job_id)
+                broadcast.stop('interrupted')
+                return
+
+async def run_broadcast(broadcast):
+    lease = asyncio.create_task(hold_broadcast_lease(broadcast))
+    try:
+        # Отдельный пул соединений: рассылка не отнимает сокеты у ответов пользователям
+        with bulk_requests():
+            await broadcast.run()
+    except asyncio.CancelledError:
+        logger.warning("BROADCAST: Рассылка #%s прервана: sent=%s, failed=%s", broadcast.job_id, broadcast.sent, broadcast.failed)
+        raise
+    except Exception as e:
+        logger.error("Ошибка при рассылке #%s: %s", broadcast.job_id, e)
+        logger.error("Трассировка: %s", traceback.format_exc())
+        try:
+            await bot.send_message(broadcast.progress_chat_id, "❌ Произошла ошибка при рассылке")
+        except:
+            pass
+    finally:
+        lease.cancel()
+        try:
+            await shared.release_lock(f"broadcast:{broadcast.job_id}", worker_id())
+        except Exception as e:
+            logger.error("BROADCAST: Не удалось снять блокировку рассылки #%s: %s", broadcast.job_id, e)
+
+async def resume_broadcasts():
+    """Продолжает рассылки, прерванные перезапуском или падением процесса.
+
+    Рассылку берёт тот воркер, который первым получил её блокировку; задания
+    с живой блокировкой выполняются другим воркером и пропускаются.
+    """
+    for job in await db.get_broadcast_jobs('running', 'interrupted'):
+        if job['id'] in active_broadcasts or not await claim_broadcast(job['id']):
+            continue
+        # Статус мог измениться, пока блокировку держал другой воркер
+        job = await db.get_broadcast_job(job['id'])
+        if job['status'] not in ('running', 'interrupted'):
+            await shared.release_lock(f"broadcast:{job['id']}", worker_id())
+            continue
+        if job['status'] == 'running':
+            # Процесс упал: для взятых в работу получателей результат неизвестен
+            unknown = await db.recover_broadcast(job['id'])
+            job = await db.get_broadcast_job(job['id'])
+            logger.warning("BROADCAST: Рассылка #%s прервана аварийно, %s получателей без подтверждения пропущены",
+                           job['id'], unknown)
+        else:
+            await db.set_broadcast_status(job['id'], 'running')
+        logger.info("BROADCAST: Продолжаем рассылку #%s с user_id > %s", job['id'], job['cursor'])
+        start_broadcast(job)
+
+async def supervise_broadcasts():
+    """Подхватывает рассылки воркеров, которые упали и не продлили блокировку"""
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE_TTL)
+        try:
+            await resume_broadcasts()
+        except Exception as e:
+            logger.error("BROADCAST: Ошибка при проверке рассылок: %s", e)
+
+# Очередь входящих обновлений (только в режиме WEBHOOK_INGEST=queue)
+async def process_update(update):
+    UPDATES_IN_FLIGHT.inc()
+    try:
+        await dp.process_update(update)
+    finally:
+        UPDATES_IN_FLIGHT.dec()
+
+async def process_queued_update(update):
+    begin_update(update.update_id)
+    await process_update(update)
+
+async def process_polled_update(data):
+    begin_update(data.get('update_id'))
+    await process_update(types.Update(**data))
+
+# Опрос getUpdates (только в режиме BOT_MODE=polling), создаётся в on_startup
+update_poller = None
+
+update_queue = UpdateQueue(process_queued_update, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE) \
+    if WEBHOOK_INGEST == "queue" else None
+
+Gauge('bot_update_queue_depth', 'Обновления, ожидающие обработки в очереди webhook',
+      function=lambda: update_queue.depth if update_queue is not None else 0)
+
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_WINDOW)
+
 # Обработчик webhook
 async def handle_webhook(request):
     try:
-        # Логируем входящий запрос
-        logger.info("=" * 50)
-        logger.info(f"WEBHOOK: ====== НОВЫЙ ЗАПРОС ======")
-        logger.info(f"WEBHOOK: Получен HTTP запрос: {request.method} {request.path_qs}")
-        logger.info(f"WEBHOOK: URL: {request.url}")
-        logger.info(f"WEBHOOK: Headers: {dict(request.headers)}")
-        
         # Проверяем, есть ли данные
         try:
             data = await request.json()
-            logger.info(f"WEBHOOK: Получено обновление: {data.get('update_id', 'unknown')}")
         except Exception as json_error:
-            logger.error(f"WEBHOOK: Ошибка при чтении JSON: {json_error}")
+            logger.error("WEBHOOK: Ошибка при чтении JSON: %s", json_error)
             # Пробуем прочитать как текст для диагностики
             try:
                 text_data = await request.text()
-                logger.error(f"WEBHOOK: Полученные данные (текст): {text_data[:500]}")
+                logger.error("WEBHOOK: Полученные данные (текст): %s", text_data[:500])
             except:
                 pass
             return web.Response(text="Bad Request: Invalid JSON", status=400)
-        
-        # Логируем тип обновления
-        if 'message' in data:
-            logger.info(f"WEBHOOK: Сообщение от {data['message'].get('from', {}).get('id', 'unknown')}: {data['message'].get('text', '')}")
-        elif 'callback_query' in data:
-            logger.info(f"WEBHOOK: Callback от {data['callback_query'].get('from', {}).get('id', 'unknown')}: {data['callback_query'].get('data', '')}")
-        
+
+        # Все записи обновления получают его update_id; debug-строки пишутся для доли обновлений
+        update_id = data.get('update_id')
+        begin_update(update_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            if 'message' in data:
+                logger.debug("WEBHOOK: Сообщение от %s: %s", data['message'].get('from', {}).get('id', 'unknown'),
+                             data['message'].get('text', ''))
+            elif 'callback_query' in data:
+                logger.debug("WEBHOOK: Callback от %s: %s", data['callback_query'].get('from', {}).get('id', 'unknown'),
+                             data['callback_query'].get('data', ''))
+
+        # Повторная доставка того же update_id: подтверждаем без обработки. Повтор мог
+        # прийти на другой воркер, поэтому после локального окна проверяем общее состояние
+        if update_id is not None:
+            duplicate = update_dedup.is_duplicate(update_id)
+            if not duplicate and SHARED_STATE:
+                try:
+                    duplicate = not await shared.add_value(f"update:{update_id}", "1", UPDATE_DEDUP_TTL)
+                except Exception:
+                    # Ответим ошибкой, и Telegram повторит доставку: повтор нельзя считать дубликатом
+                    update_dedup.forget(update_id)
+                    raise
+                if duplicate:
+                    update_dedup.shared_duplicate(update_id)
+            if duplicate:
+                logger.debug("WEBHOOK: Дубликат update_id=%s, пропускаем", update_id)
+                return web.Response(text="OK")
+
         try:
             update = types.Update(**data)
-            logger.info(f"WEBHOOK: Создан объект Update, обработка...")
-            logger.info(f"WEBHOOK: Тип обновления: {update.message and 'message' or update.callback_query and 'callback_query' or 'unknown'}")
-            
-            # Обрабатываем обновление
-            logger.info(f"WEBHOOK: Вызов dp.process_update для update_id={data.get('update_id', 'unknown')}")
-            await dp.process_update(update)
-            logger.info(f"WEBHOOK: ✅ Обновление {data.get('update_id', 'unknown')} обработано успешно")
+
+            if update_queue is not None:
+                # Режим очереди: подтверждаем Telegram сразу, обработка идёт в воркерах
+                if not update_queue.submit(chat_key(data), update):
+                    update_dedup.forget(update_id)
+                    if SHARED_STATE:
+                        await shared.delete_value(f"update:{update_id}")
+                    logger.warning("WEBHOOK: Очередь заполнена (%s), отклоняем update_id=%s",
+                                   update_queue.depth, update_id)
+                    return web.Response(text="Service Unavailable: queue is full", status=503)
+                logger.debug("WEBHOOK: Обновление поставлено в очередь")
+            else:
+                await process_update(update)
+                logger.debug("WEBHOOK: Обновление обработано")
         except Exception as process_error:
-            logger.error(f"WEBHOOK: ❌ Ошибка при process_update: {process_error}")
-            logger.error(f"WEBHOOK: Тип ошибки process_update: {type(process_error).__name__}")
-            logger.error(f"WEBHOOK: Трассировка process_update: {traceback.format_exc()}")
             # НЕ поднимаем исключение, чтобы вернуть ответ Telegram
             # Telegram будет повторять отправку, если не вернем 200 OK
-            pass
-        
-        logger.info(f"WEBHOOK: Отправка ответа 'OK'")
-        logger.info("=" * 50)
+            logger.exception("WEBHOOK: ❌ Ошибка при process_update: %s: %s",
+                             type(process_error).__name__, process_error)
+
         return web.Response(text="OK")
     except Exception as e:
-        logger.error("=" * 50)
-        logger.error(f"WEBHOOK: ❌❌❌ КРИТИЧЕСКАЯ ОШИБКА при обработке webhook: {str(e)}")
-        logger.error(f"WEBHOOK: Тип ошибки: {type(e).__name__}")
-        logger.error(f"WEBHOOK: Трассировка: {traceback.format_exc()}")
-        logger.error("=" * 50)
+        logger.exception("WEBHOOK: ❌❌❌ КРИТИЧЕСКАЯ ОШИБКА при обработке webhook: %s: %s", type(e).__name__, e)
         return web.Response(text="Error", status=500)
 
 # Health check endpoint для мониторинга
@@ -829,12 +1270,9 @@ async def health_check_handler(request):
     try:
         # Проверяем подключение к базе данных
         try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM users")
-                cursor.fetchone()
+            await db.count_users()
         except Exception as db_error:
-            logger.warning(f"Проблема с БД при health check: {db_error}")
+            logger.warning("Проблема с БД при health check: %s", db_error)
         
         # Возвращаем простой текст для максимальной совместимости с мониторами
         response_text = "OK"
@@ -843,95 +1281,215 @@ async def health_check_handler(request):
             return web.json_response({
                 "status": "ok", 
                 "message": "Бот работает нормально",
-                "timestamp": datetime.now().isoformat()
+                "timestamp": datetime.now().isoformat(),
+                "membership_cache": membership_cache.stats(),
+                "update_queue": update_queue.stats() if update_queue is not None else None,
+                "update_poller": update_poller.stats() if update_poller is not None else None,
+                "bot_api_pool": api_sessions.stats(),
+                "bot_api_scheduler": request_scheduler.stats(),
+                "update_dedup": update_dedup.stats()
             }, status=200)
         
         # Простой текстовый ответ для большинства мониторов
         return web.Response(text=response_text, status=200, content_type='text/plain')
     except Exception as e:
-        logger.error(f"Ошибка при проверке состояния: {str(e)}")
+        logger.error("Ошибка при проверке состояния: %s", str(e))
         return web.Response(text="ERROR", status=500)
 
+# Метрики в формате Prometheus
+async def metrics_handler(request):
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+# Число запросов и время обработки по маршрутам (имя маршрута вместо пути: в пути webhook токен)
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = request.match_info.route.name or 'other'
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUEST_SECONDS.labels(route).observe(time.perf_counter() - start)
+        HTTP_REQUESTS.labels(route, status).inc()
+
 # Инициализация приложения
 def init_app():
-    app = web.Application()
+    app = web.Application(middlewares=[metrics_middleware])
     
     # Webhook endpoint - Telegram отправляет обновления сюда
     webhook_path = f'/webhook/{API_TOKEN}'
-    app.router.add_post(webhook_path, handle_webhook)
-    logger.info(f"ROUTER: Зарегистрирован POST endpoint: {webhook_path}")
+    app.router.add_post(webhook_path, handle_webhook, name='webhook')
+    logger.info("ROUTER: Зарегистрирован POST endpoint: %s", webhook_path)
     
     # Health check endpoints
-    app.router.add_get('/health', health_check_handler)
-    app.router.add_get('/', health_check_handler)
+    app.router.add_get('/health', health_check_handler, name='health')
+    app.router.add_get('/', health_check_handler, name='root')
     logger.info("ROUTER: Зарегистрированы GET endpoints: /health, /")
+
+    app.router.add_get('/metrics', metrics_handler, name='metrics')
+    logger.info("ROUTER: Зарегистрирован GET endpoint: /metrics")
     
     return app
 
+# Фоновые задачи воркера и признак того, что этот воркер — лидер
+background_tasks = []
+is_leader = False
+
+async def reconcile_webhook():
+    """Приводит webhook к нужному URL и allowed_updates, не трогая его без изменений.
+
+    Без drop_pending_updates: накопленные Telegram обновления доставляются
+    после перезапуска, а не теряются. В режиме polling webhook снимается,
+    иначе getUpdates недоступен.
+    """
+    webhook_path = f"{WEBHOOK_URL}/webhook/{API_TOKEN}"
+    info = await bot.get_webhook_info()
+    if info.last_error_message:
+        logger.warning("WEBHOOK: Последняя ошибка доставки: %s", info.last_error_message)
+    if BOT_MODE == "polling":
+        if info.url:
+            logger.info("WEBHOOK: Снимаем webhook %s для режима polling", info.url)
+            await bot.delete_webhook()
+            return True
+        return False
+    if info.url == webhook_path and sorted(info.allowed_updates or []) == sorted(WEBHOOK_ALLOWED_UPDATES):
+        logger.info("WEBHOOK: Webhook уже настроен, ожидают доставки: %s", info.pending_update_count)
+        return False
+    logger.info("WEBHOOK: Устанавливаем webhook (был %s, allowed_updates=%s)",
+                info.url or "не задан", info.allowed_updates)
+    await bot.set_webhook(url=webhook_path, allowed_updates=WEBHOOK_ALLOWED_UPDATES)
+    logger.info("WEBHOOK: Webhook установлен, ожидают доставки: %s", info.pending_update_count)
+    return True
+
+async def elect_leader():
+    """Берёт или продлевает аренду лидерства; при смене лидера сверяет webhook"""
+    global is_leader
+    was_leader = is_leader
+    is_leader = await shared.acquire_lock('leader', worker_id(), LEADER_LEASE_TTL)
+    if is_leader and not was_leader:
+        logger.info("LEADER: Воркер %s стал лидером", worker_id())
+        await reconcile_webhook()
+    elif was_leader and not is_leader:
+        logger.warning("LEADER: Воркер %s потерял лидерство", worker_id())
+
+async def hold_leadership():
+    global is_leader
+    while True:
+        await asyncio.sleep(LEADER_LEASE_TTL / 3)
+        try:
+            await elect_leader()
+        except Exception as e:
+            # Сверка повторится при следующей попытке стать лидером
+            logger.error("LEADER: Ошибка при продлении лидерства: %s", e)
+            await shared.release_lock('leader', worker_id())
+            is_leader = False
+
 # Обработчики lifecycle
 async def on_startup(app):
     """Настройка при запуске"""
-    logger.info("STARTUP: Настройка webhook...")
+    global update_poller
+    loop_watchdog.start()
+    # Периодическая сверка материализованных счётчиков админ-панели
+    db.start_reconciler(COUNTERS_RECONCILE_INTERVAL)
+    # Сводки stats для статистики админ-панели; историю догоняют сразу после запуска
+    db.start_rollup(STATS_ROLLUP_INTERVAL, STATS_ROLLUP_BATCH)
+    await resume_broadcasts()
+    background_tasks.append(asyncio.create_task(supervise_broadcasts()))
+
+    # Webhook сверяет только лидер; остальные воркеры сразу начинают обслуживать запросы
     try:
-        # Проверяем текущий webhook
-        webhook_info_before = await bot.get_webhook_info()
-        logger.info(f"STARTUP: Webhook до удаления: {webhook_info_before}")
-        
-        await bot.delete_webhook(drop_pending_updates=True)
-        logger.info("STARTUP: Старый webhook удален")
-        
-        webhook_path = f"{WEBHOOK_URL}/webhook/{API_TOKEN}"
-        logger.info(f"STARTUP: Устанавливаем webhook: {webhook_path}")
-        
-        result = await bot.set_webhook(
-            url=webhook_path, 
-            allowed_updates=["message", "callback_query"],
-            drop_pending_updates=True
-        )
-        logger.info(f"STARTUP: Результат установки webhook: {result}")
-        logger.info(f"STARTUP: Webhook установлен: {webhook_path}")
-        
-        # Проверяем webhook после установки
-        webhook_info = await bot.get_webhook_info()
-        logger.info(f"STARTUP: Информация о webhook после установки: {webhook_info}")
-        logger.info(f"STARTUP: URL webhook: {webhook_info.url}")
-        logger.info(f"STARTUP: Pending updates: {webhook_info.pending_update_count}")
-        
-        me = await bot.get_me()
-        logger.info(f"STARTUP: Информация о боте: {me}")
-        
-        # Проверяем, что обработчики зарегистрированы
-        logger.info("STARTUP: Проверка обработчиков...")
-        logger.info(f"STARTUP: Бот готов к работе. Ожидаем обновления на {webhook_path}")
+        await elect_leader()
     except Exception as e:
-        logger.error(f"Ошибка при настройке webhook: {e}")
+        logger.error("Ошибка при настройке webhook: %s", e)
         raise
+    background_tasks.append(asyncio.create_task(hold_leadership()))
+    if not is_leader:
+        logger.info("STARTUP: Webhook сверяет другой воркер")
+
+    if BOT_MODE == "polling":
+        # getUpdates допускает одного клиента, поэтому опрашивает только лидер
+        update_poller = UpdatePoller(bot, process_polled_update, limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT,
+                                     allowed_updates=WEBHOOK_ALLOWED_UPDATES, active=lambda: is_leader)
+        update_poller.start()
+    logger.info("STARTUP: Бот готов к работе (режим %s)", BOT_MODE)
 
 async def on_shutdown(app):
     logger.info("Shutting down...")
+    loop_watchdog.stop()
+    for task in background_tasks:
+        task.cancel()
+    # Дорабатываем уже принятые обновления, пока БД и сессия бота ещё открыты
+    if update_poller is not None:
+        await update_poller.stop()
+    if update_queue is not None:
+        await update_queue.close()
+    # Останавливаем рассылки так, чтобы после перезапуска они продолжились без дублей
+    if active_broadcasts:
+        for broadcast, _ in list(active_broadcasts.values()):
+            broadcast.stop('interrupted')
+        _, pending = await asyncio.wait([task for _, task in active_broadcasts.values()],
+                                        timeout=BROADCAST_SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+    # Незаконченные выгрузки не ждём: администратор повторит /export
+    for task in list(active_exports):
+        task.cancel()
+    # Отдаём лидерство сразу, не дожидаясь истечения аренды
+    if is_leader:
+        try:
+            await shared.release_lock('leader', worker_id())
+        except Exception as e:
+            logger.error("Ошибка при снятии лидерства: %s", e)
+    # Сначала сбрасываем отложенные записи в БД, чтобы ошибки сети их не потеряли
     try:
-        await bot.delete_webhook()
+        await db.close()
+    except Exception as e:
+        logger.error("Ошибка при закрытии БД: %s", e)
+    try:
+        # Webhook не снимаем: при плавном перезапуске его уже обслуживает новый процесс
+        if shared is not db:
+            await shared.close()
         await dp.storage.close()
         await dp.storage.wait_closed()
-        await bot.session.close()
+        await bot.close()
     except Exception as e:
-        logger.error(f"Ошибка при завершении работы: {e}")
+        logger.error("Ошибка при завершении работы: %s", e)
+
+async def create_app():
+    """Фабрика приложения для gunicorn (bot:create_app), вызывается в каждом воркере"""
+    # Миграции безопасны при одновременном старте воркеров: каждая в своей транзакции
+    db.init_db()
+    app = init_app()
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Telegram-бот @gigtestibot")
+    parser.add_argument("--mode", choices=["webhook", "polling"], default=BOT_MODE,
+                        help="источник обновлений (по умолчанию BOT_MODE или webhook)")
+    BOT_MODE = parser.parse_args().mode
     try:
         logger.info("=" * 50)
         logger.info("Запуск бота...")
-        logger.info(f"TELEGRAM_TOKEN: {'Установлен' if API_TOKEN else 'НЕ УСТАНОВЛЕН!'}")
-        logger.info(f"ADMIN_IDS: {ADMIN_IDS}")
-        logger.info(f"WEBHOOK_URL: {WEBHOOK_URL}")
-        logger.info(f"DB_PATH: {DB_PATH}")
+        logger.info("TELEGRAM_TOKEN: %s", 'Установлен' if API_TOKEN else 'НЕ УСТАНОВЛЕН!')
+        logger.info("ADMIN_IDS: %s", ADMIN_IDS)
+        logger.info("BOT_MODE: %s", BOT_MODE)
+        logger.info("WEBHOOK_URL: %s", WEBHOOK_URL)
+        logger.info("WEBHOOK_INGEST: %s", WEBHOOK_INGEST)
+        logger.info("DB_PATH: %s", DB_PATH)
         logger.info("=" * 50)
         
         # Инициализация базы данных
-        init_db()
+        db.init_db()
         logger.info("База данных инициализирована")
         
-        # Обработчики уже зарегистрированы через декораторы @dp.message_handler и @dp.callback_query_handler
+        # Обработчики уже зарегистрированы через декораторы @dp.message_handler и @callback_router.route
         logger.info("Обработчики проверены")
         
         # Создание приложения
@@ -943,15 +1501,15 @@ if __name__ == "__main__":
         
         # Запуск приложения
         port = int(os.getenv("PORT", 10000))
-        logger.info(f"Запуск сервера на порту {port}")
+        logger.info("Запуск сервера на порту %s", port)
         logger.info("=" * 50)
         logger.info("Сервер запущен и готов принимать запросы")
         
         web.run_app(app, port=port, host='0.0.0.0')
     except Exception as e:
         logger.error("=" * 50)
-        logger.error(f"КРИТИЧЕСКАЯ ОШИБКА при запуске: {e}")
-        logger.error(f"Тип ошибки: {type(e).__name__}")
-        logger.error(f"Трассировка: {traceback.format_exc()}")
+        logger.error("КРИТИЧЕСКАЯ ОШИБКА при запуске: %s", e)
+        logger.error("Тип ошибки: %s", type(e).__name__)
+        logger.error("Трассировка: %s", traceback.format_exc())
         logger.error("=" * 50)
         raise
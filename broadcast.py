@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import time
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.exceptions import (BotBlocked, BotKicked, CantInitiateConversation, CantTalkWithBots,
+                                      ChatNotFound, MessageNotModified, RetryAfter, UserDeactivated)
+
+from callbacks import BROADCAST_CONTROL
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых писать пользователю бессмысленно, и причина для users.unreachable_reason
+PERMANENT_ERRORS = (
+    (BotBlocked, 'blocked'),
+    (UserDeactivated, 'deactivated'),
+    (ChatNotFound, 'chat_not_found'),
+    (CantInitiateConversation, 'cant_initiate'),
+    (BotKicked, 'kicked'),
+    (CantTalkWithBots, 'bot'),
+)
+
+
+def classify_send_error(error):
+    """Причина постоянной недоступности получателя или None для временной ошибки"""
+    for error_type, reason in PERMANENT_ERRORS:
+        if isinstance(error, error_type):
+            return reason
+    return None
+
+
+class SharedTokenBucket:
+    """Ограничитель скорости, общий для всех воркеров: состояние в Storage или RedisState.
+
+    rate токенов в секунду, запас burst. Токены берутся из общего хранилища
+    пачками по batch (одна транзакция SQLite на пачку, а не на получателя)
+    и расходуются локально с той же скоростью rate. pause() останавливает
+    выдачу токенов всем воркерам, например на время RetryAfter от Telegram.
+    """
+
+    def __init__(self, state, name, rate, burst=1, batch=1):
+        self.state = state
+        self.name = name
+        self.rate = rate
+        self.batch = batch
+        self.burst = max(burst, batch)
+        self._reserved = 0
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def pause(self, seconds):
+        # Взятые до RetryAfter токены больше не действительны
+        self._reserved = 0
+        await self.state.pause_bucket(self.name, seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while not self._reserved:
+                wait = await self.state.take_token(self.name, self.rate, self.burst, self.batch)
+                if wait <= 0:
+                    self._reserved = self.batch
+                    break
+                await asyncio.sleep(wait)
+            now = time.monotonic()
+            if now < self._next:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + 1 / self.rate
+            self._reserved -= 1
+
+
+class Broadcast:
+    """Рассылка одного сообщения (copyMessage) по заданию из broadcast_jobs.
+
+    Получатели берутся из БД страницами по page_size: страница помечается в
+    broadcast_deliveries как pending и курсор задания сдвигается одной
+    транзакцией, после чего user_id передаются concurrency воркерам через
+    ограниченную очередь. Результаты отправок копятся в памяти и
+    записываются пачками раз в checkpoint_interval секунд или
+    checkpoint_rows результатов.
+
+    Все отправки проходят через общий для воркеров ограничитель
+    (SharedTokenBucket), RetryAfter приостанавливает его и повторяет
+    отправку. Прогресс периодически пишется в progress-сообщение
+    администратора вместе с кнопками паузы и отмены.
+    """
+
+    max_retries = 5
+
+    def __init__(self, bot, db, job, bucket, concurrency=10, page_size=500, progress_interval=5,
+                 checkpoint_interval=2, checkpoint_rows=200):
+        self.bot = bot
+        self.db = db
+        self.job_id = job['id']
+        self.from_chat_id = job['from_chat_id']
+        self.message_id = job['message_id']
+        self.progress_chat_id = job['progress_chat_id']
+        self.progress_message_id = job['progress_message_id']
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_rows = checkpoint_rows
+        self.total = job['total']
+        self.sent = job['sent']
+        self.failed = job['failed']
+        self.unreachable = job['unreachable']
+        self.status = job['status']
+        self.stop_status = None
+        self.started = None
+        self.finished = None
+        self._done_at_start = self.done
+        self._outcomes = []
+        self._checkpoint_event = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.sent + self.failed
+
+    @property
+    def rate(self):
+        elapsed = (self.finished or time.monotonic()) - self.started if self.started else 0
+        return (self.done - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        rate = self.rate
+        return max(self.total - self.done, 0) / rate if rate > 0 else None
+
+    def stop(self, status):
+        """Останавливает рассылку после текущих отправок; status — paused, cancelled или interrupted"""
+        self.stop_status = status
+
+    def format_progress(self):
+        eta = self.eta
+        eta_text = f"{int(eta // 60)} мин {int(eta % 60)} сек" if eta is not None else "—"
+        return (
+            f"📨 Рассылка #{self.job_id} идёт...\n\n"
+            f"📊 Прогресс: {self.done} из {self.total}\n"
+            f"• Успешно отправлено: {self.sent}\n"
+            f"• Не удалось отправить: {self.failed} (недоступны: {self.unreachable})\n"
+            f"• Скорость: {self.rate:.1f} сообщ./сек\n"
+            f"• Осталось: {eta_text}"
+        )
+
+    def format_result(self):
+        if self.status == 'paused':
+            title = f"⏸ Рассылка #{self.job_id} на паузе"
+        elif self.status == 'cancelled':
+            title = f"⛔️ Рассылка #{self.job_id} отменена"
+        elif self.status == 'interrupted':
+            title = f"🔄 Рассылка #{self.job_id} прервана перезапуском и продолжится автоматически"
+        else:
+            title = "✅ Рассылка завершена!"
+        return (
+            f"{title}\n\n"
+            f"📊 Результаты:\n"
+            f"• Успешно отправлено: {self.sent}\n"
+            f"• Не удалось отправить: {self.failed}\n"
+            f"• Из них заблокировали бота или недоступны: {self.unreachable}"
+        )
+
+    def control_markup(self):
+        if self.status == 'running':
+            buttons = [InlineKeyboardButton(text="⏸ Пауза", callback_data=BROADCAST_CONTROL.pack(action="pause", job_id=self.job_id))]
+        elif self.status == 'paused':
+            buttons = [InlineKeyboardButton(text="▶️ Продолжить", callback_data=BROADCAST_CONTROL.pack(action="resume", job_id=self.job_id))]
+        else:
+            return None
+        buttons.append(InlineKeyboardButton(text="⛔️ Отменить", callback_data=BROADCAST_CONTROL.pack(action="cancel", job_id=self.job_id)))
+        return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+    async def _put(self, queue, page):
+        for user_id in page:
+            if self.stop_status:
+                return False
+            await queue.put(user_id)
+        return True
+
+    async def _produce(self, queue):
+        # Сначала получатели, взятые в работу до паузы или перезапуска, но не обработанные
+        after = 0
+        while not self.stop_status:
+            page = await self.db.get_pending_deliveries(self.job_id, after, self.page_size)
+            if not page or not await self._put(queue, page):
+                break
+            after = page[-1]
+        while not self.stop_status:
+            page = await self.db.claim_broadcast_page(self.job_id, self.page_size)
+            if not page or not await self._put(queue, page):
+                break
+        for _ in range(self.concurrency):
+            await queue.put(None)
+
+    async def _send(self, user_id):
+        """Возвращает (status, reason): sent, failed или unreachable с причиной"""
+        for attempt in range(self.max_retries):
+            await self.bucket.acquire()
+            try:
+                await self.bot.copy_message(user_id, self.from_chat_id, self.message_id)
+                return 'sent', None
+            except RetryAfter as e:
+                logger.warning("BROADCAST: RetryAfter %s сек на пользователе %s", e.timeout, user_id)
+                await self.bucket.pause(e.timeout)
+            except Exception as e:
+                reason = classify_send_error(e)
+                if reason:
+                    logger.info("BROADCAST: Пользователь %s недоступен (%s), исключаем из рассылок", user_id, reason)
+                    return 'unreachable', reason
+                logger.error("Не удалось отправить сообщение пользователю %s: %s", user_id, e)
+                return 'failed', None
+        return 'failed', None
+
+    async def _work(self, queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            # После остановки дочитываем очередь без отправки: получатели останутся pending
+            if self.stop_status:
+                continue
+            status, reason = await self._send(user_id)
+            if status == 'sent':
+                self.sent += 1
+            else:
+                self.failed += 1
+                if status == 'unreachable':
+                    self.unreachable += 1
+            self._outcomes.append((user_id, status, reason))
+            if len(self._outcomes) >= self.checkpoint_rows:
+                self._checkpoint_event.set()
+
+    async def _checkpoint(self):
+        if not self._outcomes:
+            return
+        outcomes, self._outcomes = self._outcomes, []
+        try:
+            await self.db.checkpoint_broadcast(self.job_id, outcomes)
+        except Exception:
+            # Транзакция откатилась: без результатов получатели остались бы pending
+            # и после паузы получили бы сообщение повторно. Вернём их в начало очереди
+            self._outcomes[:0] = outcomes
+            raise
+
+    async def _checkpoint_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._checkpoint_event.wait(), self.checkpoint_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._checkpoint_event.clear()
+            try:
+                await self._checkpoint()
+            except Exception as e:
+                logger.error("BROADCAST: Ошибка записи прогресса рассылки #%s: %s", self.job_id, e)
+
+    async def _edit_progress(self, text):
+        if not self.progress_message_id:
+            return
+        try:
+            await self.bot.edit_message_text(text, self.progress_chat_id, self.progress_message_id,
+                                             reply_markup=self.control_markup())
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.warning("BROADCAST: Не удалось обновить прогресс: %s", e)
+
+    async def show_result(self):
+        """Показывает итог (или текущее состояние) в progress-сообщении"""
+        await self._edit_progress(self.format_result())
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._edit_progress(self.format_progress())
+
+    async def run(self):
+        """Выполняет (или продолжает) рассылку до конца либо до stop()"""
+        self.started = time.monotonic()
+        self.status = 'running'
+        logger.info("BROADCAST: Старт рассылки #%s: %s из %s уже обработано", self.job_id, self.done, self.total)
+
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        tasks = [asyncio.ensure_future(self._produce(queue))]
+        tasks += [asyncio.ensure_future(self._work(queue)) for _ in range(self.concurrency)]
+        helpers = [asyncio.ensure_future(self._checkpoint_loop()), asyncio.ensure_future(self._report())]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks + helpers:
+                task.cancel()
+            self.finished = time.monotonic()
+            # Результаты, полученные до остановки или отмены задачи, не теряем. Если
+            # запись так и не удалась, статус остаётся running: при восстановлении
+            # pending-получатели станут unknown, а не получат сообщение повторно
+            for attempt in range(self.max_retries):
+                try:
+                    await self._checkpoint()
+                    break
+                except Exception as e:
+                    logger.error("BROADCAST: Ошибка записи прогресса рассылки #%s: %s", self.job_id, e)
+                    if attempt == self.max_retries - 1:
+                        raise
+                    await asyncio.sleep(self.checkpoint_interval)
+
+        self.status = self.stop_status or 'done'
+        await self.db.set_broadcast_status(self.job_id, self.status)
+        logger.info("BROADCAST: Рассылка #%s остановлена со статусом %s: sent=%s, failed=%s, rate=%.1f/сек",
+                    self.job_id, self.status, self.sent, self.failed, self.rate)
+        await self.show_result()
+        return self
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей для асинхронных загрузок.
+
+    Положительные значения (is_positive(value) истинно) живут ttl секунд,
+    остальные — negative_ttl. Одновременные get_or_load по одному ключу
+    разделяют одну загрузку. Счётчики hits/misses/coalesced доступны через
+    stats().
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, negative_ttl=None, is_positive=bool):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.is_positive = is_positive
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._data = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        ttl = self.ttl if self.is_positive(value) else self.negative_ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    async def get_or_load(self, key, loader):
+        """Возвращает (value, loaded): loaded истинно только у вызова, который сам выполнил loader()"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value, False
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), False
+
+        self.misses += 1
+        task = asyncio.ensure_future(loader())
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._loaded(key, t))
+        return await asyncio.shield(task), True
+
+    def _loaded(self, key, task):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,138 @@
+import logging
+
+from aiogram.dispatcher.handler import ctx_data
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_QUERIES = Counter('bot_callback_queries_total', 'Нажатия inline-кнопок по маршрутам', ['route'])
+
+SEPARATOR = ':'
+# Ключ в данных обработчика aiogram, под которым dispatch() оставляет имя выбранного маршрута
+ROUTE_KEY = 'callback_route'
+# Telegram принимает callback_data не длиннее 64 байт
+MAX_LENGTH = 64
+
+
+class CallbackCodec:
+    """Формат callback_data одной группы кнопок: prefix:версия:поле:поле...
+
+    fields — имена полей и их типы по порядку, например {'action': str, 'job_id': int}.
+    Данные другой версии или с другим числом полей не разбираются (ValueError):
+    так кнопки под старыми сообщениями не попадут в обработчик с чужими полями.
+    """
+
+    def __init__(self, prefix, fields=None, version=1):
+        if SEPARATOR in prefix:
+            raise ValueError(f"Префикс {prefix!r} не может содержать '{SEPARATOR}'")
+        self.prefix = prefix
+        self.fields = dict(fields or {})
+        self.version = str(version)
+        self._head = f"{prefix}{SEPARATOR}{self.version}"
+
+    def pack(self, **values):
+        parts = [self._head]
+        for name in self.fields:
+            value = str(values[name])
+            if SEPARATOR in value:
+                raise ValueError(f"Поле {name}={value!r} не может содержать '{SEPARATOR}'")
+            parts.append(value)
+        data = SEPARATOR.join(parts)
+        if len(data.encode()) > MAX_LENGTH:
+            raise ValueError(f"callback_data длиннее {MAX_LENGTH} байт: {data!r}")
+        return data
+
+    def unpack(self, data):
+        """Поля из callback_data в виде словаря"""
+        parts = data.split(SEPARATOR)
+        if parts[0] != self.prefix or len(parts) < 2 or parts[1] != self.version:
+            raise ValueError(f"{data!r} не относится к {self._head}")
+        if len(parts) - 2 != len(self.fields):
+            raise ValueError(f"{data!r}: ожидается полей {len(self.fields)}")
+        return {name: cast(value) for (name, cast), value in zip(self.fields.items(), parts[2:])}
+
+
+# Кнопки бота
+SUBSCRIPTION = CallbackCodec('sub')
+ADMIN = CallbackCodec('adm', {'screen': str})
+BROADCAST_CONTROL = CallbackCodec('bc', {'action': str, 'job_id': int})
+# Листание списка и результатов поиска: направление, номер страницы и курсор keyset
+USERS_PAGE = CallbackCodec('usr', {'direction': str, 'page': int, 'last_activity': int, 'user_id': int})
+USER_SEARCH_PAGE = CallbackCodec('usq', {'direction': str, 'page': int, 'user_id': int})
+
+
+def upgrade_legacy(data):
+    """callback_data кнопок, отправленных до появления кодеков, в текущем формате.
+
+    Старые сообщения с кнопками остаются в чатах пользователей, поэтому их
+    нажатия переводятся в новый формат; None — данные не из старого формата.
+    """
+    if data == 'check_subscription':
+        return SUBSCRIPTION.pack()
+    kind, _, rest = data.partition('_')
+    if kind == 'admin' and rest:
+        return ADMIN.pack(screen=rest)
+    if kind == 'bcast':
+        action, _, job_id = rest.partition('_')
+        return BROADCAST_CONTROL.pack(action=action, job_id=job_id)
+    return None
+
+
+class CallbackRouter:
+    """Выбор обработчика нажатия по префиксу callback_data через словарь.
+
+    Вместо цепочки фильтров, каждый из которых проверяется для каждого
+    нажатия, один обработчик aiogram вызывает dispatch(): префикс — ключ
+    словаря маршрутов, поля разбираются кодеком и передаются обработчику
+    именованными аргументами. Имя выбранного обработчика (или 'unknown')
+    dispatch() кладёт в данные обработчика aiogram под ROUTE_KEY, откуда
+    его берут middleware, не разбирая callback_data повторно.
+    """
+
+    def __init__(self, legacy=None):
+        self.legacy = legacy
+        self._routes = {}
+
+    def route(self, codec):
+        """Декоратор: обработчик нажатий кнопок с данными codec"""
+        def register(handler):
+            if codec.prefix in self._routes:
+                raise ValueError(f"Маршрут {codec.prefix!r} уже зарегистрирован")
+            self._routes[codec.prefix] = (codec, handler)
+            return handler
+        return register
+
+    def resolve(self, data):
+        """(обработчик, поля) для callback_data; None — кнопка неизвестна или устарела"""
+        if not data:
+            return None
+        route = self._routes.get(data.partition(SEPARATOR)[0])
+        if route is None and self.legacy is not None:
+            upgraded = self.legacy(data)
+            if upgraded is not None:
+                data = upgraded
+                route = self._routes.get(data.partition(SEPARATOR)[0])
+        if route is None:
+            return None
+        codec, handler = route
+        try:
+            return handler, codec.unpack(data)
+        except ValueError:
+            return None
+
+    async def dispatch(self, callback):
+        resolved = self.resolve(callback.data)
+        data = ctx_data.get(None)
+        if resolved is None:
+            if data is not None:
+                data[ROUTE_KEY] = 'unknown'
+            CALLBACK_QUERIES.labels('unknown').inc()
+            logger.warning("CALLBACK: Неизвестная или устаревшая кнопка %r от %s", callback.data, callback.from_user.id)
+            await callback.answer("⌛️ Кнопка устарела, откройте меню заново", show_alert=True)
+            return
+        handler, values = resolved
+        if data is not None:
+            data[ROUTE_KEY] = handler.__name__
+        CALLBACK_QUERIES.labels(handler.__name__).inc()
+        await handler(callback, **values)
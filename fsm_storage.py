@@ -0,0 +1,71 @@
+import json
+
+from aiogram.dispatcher.storage import BaseStorage
+
+
+class SharedFSMStorage(BaseStorage):
+    """Хранилище состояний FSM aiogram поверх общего состояния воркеров.
+
+    state — Storage (SQLite) или RedisState: состояние, данные и bucket
+    пользователя лежат под ключами fsm:<chat>:<user>:<часть>, поэтому
+    любой воркер видит изменения, сделанные другими.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def _key(self, chat, user, part):
+        chat, user = self.check_address(chat=chat, user=user)
+        return f"fsm:{chat}:{user}:{part}"
+
+    async def _get_json(self, key, default):
+        value = await self.state.get_value(key)
+        return json.loads(value) if value is not None else dict(default or {})
+
+    async def _set_json(self, key, value):
+        if value:
+            await self.state.set_value(key, json.dumps(value, ensure_ascii=False))
+        else:
+            await self.state.delete_value(key)
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        value = await self.state.get_value(self._key(chat, user, 'state'))
+        return value if value is not None else self.resolve_state(default)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user, 'state')
+        if state is None:
+            await self.state.delete_value(key)
+        else:
+            await self.state.set_value(key, self.resolve_state(state))
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        return await self._get_json(self._key(chat, user, 'data'), default)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self._set_json(self._key(chat, user, 'data'), data)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=current)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        return await self._get_json(self._key(chat, user, 'bucket'), default)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await self._set_json(self._key(chat, user, 'bucket'), bucket)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        current = await self.get_bucket(chat=chat, user=user)
+        current.update(bucket or {}, **kwargs)
+        await self.set_bucket(chat=chat, user=user, bucket=current)
@@ -1,5 +1,10 @@
+import os
+
+# Запуск: gunicorn -c gunicorn_config.py. Состояние FSM, ограничители и блокировки
+# общие для воркеров (SQLite или REDIS_URL), поэтому воркеров может быть несколько
+wsgi_app = "bot:create_app"
 bind = "0.0.0.0:10000"
-workers = 1
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
 worker_class = "aiohttp.worker.GunicornWebWorker"
 timeout = 120
 keepalive = 5
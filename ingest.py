@@ -0,0 +1,151 @@
+import asyncio
+import logging
+from collections import deque
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+UPDATE_DUPLICATES = Counter('bot_update_duplicates_total', 'Повторные доставки обновлений, подтверждённые без обработки',
+                            ['source'])
+
+
+def chat_key(data):
+    """Ключ упорядочивания для сырого обновления: id чата или пользователя"""
+    callback = data.get('callback_query')
+    if callback:
+        return callback.get('from', {}).get('id')
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = data.get(kind)
+        if message:
+            return message.get('chat', {}).get('id')
+    return data.get('update_id')
+
+
+class UpdateDeduplicator:
+    """Скользящее окно последних window update_id: кольцевой буфер и словарь.
+
+    Telegram повторяет доставку, если webhook ответил ошибкой или не успел,
+    поэтому повторный update_id подтверждаем без обработки. Все операции O(1).
+    duplicates — повторы, пойманные окном этого воркера, shared_duplicates —
+    пойманные общим состоянием (повтор пришёл на другой воркер).
+    """
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.duplicates = 0
+        self.shared_duplicates = 0
+        self._ring = deque()
+        self._seen = {}
+        self._seq = 0
+
+    def is_duplicate(self, update_id):
+        """Проверяет update_id и запоминает его, если он встретился впервые"""
+        if update_id in self._seen:
+            self.duplicates += 1
+            UPDATE_DUPLICATES.labels('local').inc()
+            return True
+        self._seq += 1
+        self._seen[update_id] = self._seq
+        self._ring.append((update_id, self._seq))
+        if len(self._ring) > self.window:
+            old_id, old_seq = self._ring.popleft()
+            if self._seen.get(old_id) == old_seq:
+                del self._seen[old_id]
+        return False
+
+    def shared_duplicate(self, update_id):
+        """Учитывает повтор, который окно пропустило, а общее состояние поймало"""
+        self.shared_duplicates += 1
+        UPDATE_DUPLICATES.labels('shared').inc()
+
+    def forget(self, update_id):
+        """Убирает update_id из окна, чтобы повторная доставка была обработана"""
+        self._seen.pop(update_id, None)
+
+    def stats(self):
+        return {
+            'window': self.window,
+            'tracked': len(self._seen),
+            'duplicates': self.duplicates,
+            'shared_duplicates': self.shared_duplicates
+        }
+
+
+class UpdateQueue:
+    """Ограниченная очередь входящих обновлений с пулом воркеров.
+
+    Обновления раскладываются по workers шардам по ключу чата, каждый шард
+    обрабатывается одним воркером, поэтому порядок внутри чата сохраняется,
+    а разные чаты обрабатываются параллельно. Если шард заполнен, submit()
+    возвращает False — webhook отвечает 503 и Telegram повторит доставку.
+    """
+
+    def __init__(self, handler, workers=8, maxsize=1000):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self._queues = None
+        self._tasks = []
+
+    def _start(self):
+        shard_size = max(1, self.maxsize // self.workers)
+        self._queues = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._work(queue)) for queue in self._queues]
+        logger.info("INGEST: Запущено %s воркеров, ёмкость очереди %s", self.workers, shard_size * self.workers)
+
+    def submit(self, key, update):
+        """Ставит обновление в очередь без ожидания; False, если очередь заполнена"""
+        if self._queues is None:
+            self._start()
+        queue = self._queues[hash(key) % self.workers]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def _work(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.handler(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("INGEST: Ошибка при обработке обновления %s: %s: %s", update.update_id, type(e).__name__, e)
+            finally:
+                queue.task_done()
+
+    @property
+    def depth(self):
+        return sum(queue.qsize() for queue in self._queues) if self._queues else 0
+
+    async def close(self, timeout=10):
+        """Дожидается обработки уже принятых обновлений (не дольше timeout) и останавливает воркеров"""
+        if self._queues is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("INGEST: Не дождались обработки %s обновлений при остановке", self.depth)
+        for task in self._tasks:
+            task.cancel()
+        self._queues = None
+        self._tasks = []
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed
+        }
@@ -0,0 +1,159 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+# Текущее обновление и решение о сэмплировании его debug-строк
+_update_id = contextvars.ContextVar('update_id', default=None)
+_sampled = contextvars.ContextVar('sampled', default=None)
+
+# Атрибуты LogRecord, которые не считаются дополнительными полями
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'update_id'}
+
+
+def begin_update(update_id, sample_rate=None):
+    """Отмечает начало обработки обновления в текущем контексте.
+
+    Все записи до следующего вызова получат поле update_id, а debug-строки
+    этого обновления будут либо выведены все, либо отброшены все.
+    """
+    _update_id.set(update_id)
+    rate = _DEBUG_SAMPLE_RATE if sample_rate is None else sample_rate
+    _sampled.set(random.random() < rate)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает DEBUG-записи только для сэмплированных обновлений и дописывает update_id.
+
+    Работает в потоке, который пишет лог (до постановки в очередь), поэтому
+    отброшенные записи почти ничего не стоят.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG:
+            sampled = _sampled.get()
+            if sampled is None:
+                sampled = random.random() < self.rate
+            if not sampled:
+                return False
+        record.update_id = _update_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и extra-поля"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        update_id = getattr(record, 'update_id', None)
+        if update_id is not None:
+            entry['update_id'] = update_id
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    # Подстановка msg % args выполняется здесь, в вызывающем потоке: аргументы
+    # (словари, объекты aiogram) event loop может изменить раньше, чем до записи
+    # дойдёт поток QueueListener. prepare() вызывается только для записей, прошедших
+    # SamplingFilter, поэтому отброшенные debug-строки не форматируются. Сборка JSON
+    # и запись в stderr остаются потоку QueueListener. Трассировка превращается в
+    # текст сразу, потому что объекты traceback нельзя безопасно передавать дальше
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_DEBUG_SAMPLE_RATE = 1.0
+_listener = None
+
+
+def setup_logging():
+    """Настраивает корневой логгер по переменным окружения.
+
+    LOG_LEVEL — общий уровень (INFO), LOG_LEVELS — уровни подсистем вида
+    "storage=WARNING,broadcast=DEBUG", LOG_FORMAT — json или text,
+    LOG_DEBUG_SAMPLE_RATE — доля обновлений, для которых пишутся DEBUG-строки.
+    Запись в stderr выполняет отдельный поток QueueListener.
+    """
+    global _DEBUG_SAMPLE_RATE, _listener
+    if _listener is not None:
+        return _listener
+
+    _DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.01))
+
+    # Поля потока и процесса не выводятся, не собираем их для каждой записи
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    stream = logging.StreamHandler(sys.stderr)
+    if os.getenv("LOG_FORMAT", "json") == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        formatter.converter = time.gmtime
+        stream.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    handler = _LazyQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(_DEBUG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    for item in os.getenv("LOG_LEVELS", "aiogram=WARNING,aiohttp.access=WARNING").split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def _restart_after_fork():
+    # Поток QueueListener не переживает fork (gunicorn с preload_app):
+    # в дочернем процессе запускаем его заново на той же очереди
+    if _listener is not None:
+        _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def stop_logging():
+    """Дописывает записи из очереди и останавливает поток QueueListener"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+LOOP_STALLS = Counter('bot_event_loop_stalls_total', 'Блокировки event loop дольше порога', ['handler'])
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+_AIOGRAM_HANDLER = os.path.join('aiogram', 'dispatcher', 'handler.py')
+_CALLBACK_ROUTER = os.path.join(_PROJECT_DIR, 'callbacks.py')
+
+
+def _dispatches(code):
+    """Кадр диспетчера, который вызывает обработчик бота: aiogram или CallbackRouter"""
+    if code.co_name == 'notify':
+        return code.co_filename.endswith(_AIOGRAM_HANDLER)
+    return code.co_name == 'dispatch' and code.co_filename == _CALLBACK_ROUTER
+
+
+def _describe(frame, limit=20):
+    """(handler, location, stack) для стека потока event loop.
+
+    handler — функция, которую вызвал самый внутренний диспетчер (aiogram или
+    CallbackRouter для нажатий кнопок), иначе самая внутренняя функция проекта; location — самый внутренний
+    кадр, то есть место, где поток стоит.
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+
+    handler = None
+    for outer, inner in zip(frames, frames[1:]):
+        if _dispatches(outer.f_code):
+            handler = inner.f_code.co_name
+    if handler is None:
+        for candidate in reversed(frames):
+            if candidate.f_code.co_filename.startswith(_PROJECT_DIR):
+                handler = candidate.f_code.co_name
+                break
+
+    innermost = frames[-1]
+    location = (f"{os.path.basename(innermost.f_code.co_filename)}:{innermost.f_lineno} "
+                f"{innermost.f_code.co_name}")
+    stack = ''.join(traceback.format_stack(frames[-1], limit=limit))
+    return handler or 'unknown', location, stack
+
+
+class LoopWatchdog:
+    """Сторож event loop: замеряет задержку и ловит код, который его блокирует.
+
+    Задача в loop раз в interval секунд отмечает «пульс» и считает задержку
+    пробуждения. Отдельный поток проверяет пульс; если loop не отвечает
+    дольше threshold, поток снимает стек потока loop (sys._current_frames)
+    — это и есть блокирующий код. Когда loop оживает, блокировка
+    записывается в сводку по (обработчик, место), которую показывает report().
+    interval должен быть заметно меньше threshold: блокировка видна, только
+    если на неё пришёлся очередной пульс.
+    """
+
+    def __init__(self, interval=0.05, threshold=0.1, keep=50):
+        self.interval = interval
+        self.threshold = threshold
+        self.keep = keep
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.offenders = {}
+        self._beat = None
+        self._sample = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.ensure_future(self._run())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._stop.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            beat = self._beat
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, self.lag)
+            self._beat = time.monotonic()
+            if self.lag >= self.threshold:
+                sample = self._sample
+                self._record(self.lag, sample[1] if sample and sample[0] == beat else None)
+
+    def _watch(self):
+        # Проверяем пульс чаще порога, чтобы застать loop внутри блокировки
+        period = min(self.interval, self.threshold) / 2
+        while not self._stop.wait(period):
+            beat = self._beat
+            if time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            if self._sample is not None and self._sample[0] == beat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._sample = (beat, _describe(frame))
+
+    def _record(self, lag, sample):
+        # Блокировка короче периода проверки могла закончиться до снятия стека
+        handler, location, stack = sample or ('unknown', 'не успели снять стек', '')
+        self.stalls += 1
+        LOOP_STALLS.labels(handler).inc()
+        logger.warning("WATCHDOG: Event loop был заблокирован %.3f сек: %s (%s)", lag, handler, location)
+
+        entry = self.offenders.get((handler, location))
+        if entry is None:
+            if len(self.offenders) >= self.keep:
+                # Вытесняем наименее значимого нарушителя
+                del self.offenders[min(self.offenders, key=lambda key: self.offenders[key]['total'])]
+            entry = self.offenders[(handler, location)] = {'count': 0, 'total': 0.0, 'max': 0.0, 'stack': ''}
+        entry['count'] += 1
+        entry['total'] += lag
+        if lag >= entry['max']:
+            entry['max'] = lag
+            entry['stack'] = stack or entry['stack']
+
+    def report(self, limit=10):
+        """Худшие нарушители по суммарному времени блокировки"""
+        worst = sorted(self.offenders.items(), key=lambda item: item[1]['total'], reverse=True)[:limit]
+        return [dict(handler=handler, location=location, **entry) for (handler, location), entry in worst]
@@ -0,0 +1,439 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Упорядоченный список миграций: (версия, название, функция(cursor))
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Регистрирует функцию как миграцию схемы с номером version"""
+    def decorator(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def apply_migrations(conn):
+    """Применяет к соединению все миграции новее текущей версии схемы.
+
+    Каждая миграция выполняется в своей транзакции BEGIN IMMEDIATE, поэтому
+    при одновременном старте нескольких процессов схему обновит только один.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     name TEXT,
+                     applied_at INTEGER)''')
+    conn.commit()
+    current = 0
+    for version, name, migrate in MIGRATIONS:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+            if version <= current:
+                conn.rollback()
+                continue
+            logger.info("MIGRATE: Применяем миграцию %s: %s", version, name)
+            migrate(conn.cursor())
+            conn.execute('INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                         (version, name, int(time.time())))
+            conn.commit()
+            current = version
+        except Exception as e:
+            conn.rollback()
+            logger.error("MIGRATE: Ошибка в миграции %s (%s): %s", version, name, e)
+            raise
+    logger.info("MIGRATE: Версия схемы БД: %s", current)
+    return current
+
+
+def _create_users_total_triggers(c):
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_total_insert AFTER INSERT ON users
+                 BEGIN
+                     UPDATE counters SET value = value + 1 WHERE name = 'users_total';
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_total_delete AFTER DELETE ON users
+                 BEGIN
+                     UPDATE counters SET value = value - 1 WHERE name = 'users_total';
+                 END''')
+
+
+@migration(1, "initial schema")
+def _initial_schema(c):
+    # Таблица пользователей
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (user_id INTEGER PRIMARY KEY,
+                  username TEXT,
+                  first_name TEXT,
+                  last_name TEXT,
+                  language_code TEXT,
+                  joined_at TIMESTAMP,
+                  last_activity TIMESTAMP,
+                  is_subscribed INTEGER DEFAULT 0)''')
+
+    # Таблица статистики
+    c.execute('''CREATE TABLE IF NOT EXISTS stats
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  action TEXT,
+                  timestamp TIMESTAMP,
+                  FOREIGN KEY(user_id) REFERENCES users(user_id))''')
+
+    # Счётчики, которые поддерживаются инкрементально вместо COUNT(*)
+    c.execute('''CREATE TABLE IF NOT EXISTS counters
+                 (name TEXT PRIMARY KEY,
+                  value INTEGER NOT NULL DEFAULT 0)''')
+    c.execute("SELECT 1 FROM counters WHERE name = 'users_total'")
+    if not c.fetchone():
+        c.execute("INSERT INTO counters (name, value) SELECT 'users_total', COUNT(*) FROM users")
+    _create_users_total_triggers(c)
+
+
+@migration(2, "integer epoch timestamps")
+def _epoch_timestamps(c):
+    # Раньше время писалось как локальный datetime в тексте и сравнивалось
+    # с datetime('now', ...) в UTC. Переводим в секунды Unix: модификатор
+    # 'utc' трактует старое значение как локальное время
+    c.execute('''CREATE TABLE users_new
+                 (user_id INTEGER PRIMARY KEY,
+                  username TEXT,
+                  first_name TEXT,
+                  last_name TEXT,
+                  language_code TEXT,
+                  joined_at INTEGER,
+                  last_activity INTEGER,
+                  is_subscribed INTEGER DEFAULT 0)''')
+    c.execute('''INSERT INTO users_new
+                 SELECT user_id, username, first_name, last_name, language_code,
+                        CAST(strftime('%s', joined_at, 'utc') AS INTEGER),
+                        CAST(strftime('%s', last_activity, 'utc') AS INTEGER),
+                        is_subscribed
+                 FROM users''')
+    c.execute('DROP TABLE users')
+    c.execute('ALTER TABLE users_new RENAME TO users')
+    _create_users_total_triggers(c)
+
+    c.execute('''CREATE TABLE stats_new
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  action TEXT,
+                  timestamp INTEGER,
+                  FOREIGN KEY(user_id) REFERENCES users(user_id))''')
+    c.execute('''INSERT INTO stats_new
+                 SELECT id, user_id, action, CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                 FROM stats''')
+    c.execute('DROP TABLE stats')
+    c.execute('ALTER TABLE stats_new RENAME TO stats')
+
+
+@migration(3, "indexes for activity, subscription and stats lookups")
+def _indexes(c):
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_is_subscribed ON users(is_subscribed)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stats_user_ts ON stats(user_id, timestamp)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stats_action_ts ON stats(action, timestamp)')
+
+
+@migration(4, "materialized dashboard counters")
+def _dashboard_counters(c):
+    # Количество подписанных пользователей
+    c.execute("INSERT OR IGNORE INTO counters (name, value) "
+              "SELECT 'users_subscribed', COUNT(*) FROM users WHERE is_subscribed = 1")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_subscribed_insert AFTER INSERT ON users
+                 WHEN NEW.is_subscribed = 1
+                 BEGIN
+                     UPDATE counters SET value = value + 1 WHERE name = 'users_subscribed';
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_subscribed_update AFTER UPDATE OF is_subscribed ON users
+                 WHEN (OLD.is_subscribed = 1) != (NEW.is_subscribed = 1)
+                 BEGIN
+                     UPDATE counters SET value = value + (NEW.is_subscribed = 1) - (OLD.is_subscribed = 1)
+                     WHERE name = 'users_subscribed';
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS users_subscribed_delete AFTER DELETE ON users
+                 WHEN OLD.is_subscribed = 1
+                 BEGIN
+                     UPDATE counters SET value = value - 1 WHERE name = 'users_subscribed';
+                 END''')
+
+    # Пользователи по дню последней активности (день = last_activity / 86400, UTC).
+    # Активные за N дней — сумма последних N корзин
+    c.execute('''CREATE TABLE IF NOT EXISTS activity_buckets
+                 (day INTEGER PRIMARY KEY,
+                  users INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''INSERT OR REPLACE INTO activity_buckets (day, users)
+                 SELECT last_activity / 86400, COUNT(*) FROM users
+                 WHERE last_activity IS NOT NULL GROUP BY last_activity / 86400''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS activity_buckets_insert AFTER INSERT ON users
+                 WHEN NEW.last_activity IS NOT NULL
+                 BEGIN
+                     INSERT INTO activity_buckets (day, users) VALUES (NEW.last_activity / 86400, 1)
+                     ON CONFLICT(day) DO UPDATE SET users = users + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS activity_buckets_update AFTER UPDATE OF last_activity ON users
+                 WHEN OLD.last_activity / 86400 IS NOT NEW.last_activity / 86400
+                 BEGIN
+                     UPDATE activity_buckets SET users = users - 1
+                     WHERE OLD.last_activity IS NOT NULL AND day = OLD.last_activity / 86400;
+                     INSERT INTO activity_buckets (day, users)
+                     SELECT NEW.last_activity / 86400, 1 WHERE NEW.last_activity IS NOT NULL
+                     ON CONFLICT(day) DO UPDATE SET users = users + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS activity_buckets_delete AFTER DELETE ON users
+                 WHEN OLD.last_activity IS NOT NULL
+                 BEGIN
+                     UPDATE activity_buckets SET users = users - 1 WHERE day = OLD.last_activity / 86400;
+                 END''')
+
+
+@migration(5, "persistent broadcast jobs")
+def _broadcast_jobs(c):
+    # cursor — наибольший user_id, уже взятый в работу; получатели выдаются страницами по возрастанию
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  from_chat_id INTEGER NOT NULL,
+                  message_id INTEGER NOT NULL,
+                  progress_chat_id INTEGER,
+                  progress_message_id INTEGER,
+                  status TEXT NOT NULL,
+                  cursor INTEGER NOT NULL DEFAULT 0,
+                  total INTEGER NOT NULL DEFAULT 0,
+                  sent INTEGER NOT NULL DEFAULT 0,
+                  failed INTEGER NOT NULL DEFAULT 0,
+                  created_at INTEGER,
+                  updated_at INTEGER)''')
+    # Статус по каждому получателю: pending (взят, результат не записан), sent, failed,
+    # unknown (процесс упал до записи результата — повторно не отправляем), skipped (отмена)
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries
+                 (job_id INTEGER NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  status TEXT NOT NULL,
+                  PRIMARY KEY (job_id, user_id)) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status '
+              'ON broadcast_deliveries(job_id, status, user_id)')
+
+
+@migration(6, "unreachable users excluded from counters and broadcasts")
+def _unreachable_users(c):
+    # unreachable = 1: пользователь заблокировал бота, удалил аккаунт и т.п.
+    # Сбрасывается, когда пользователь снова пишет боту
+    c.execute('ALTER TABLE users ADD COLUMN unreachable INTEGER NOT NULL DEFAULT 0')
+    c.execute('ALTER TABLE users ADD COLUMN unreachable_reason TEXT')
+    c.execute('ALTER TABLE broadcast_jobs ADD COLUMN unreachable INTEGER NOT NULL DEFAULT 0')
+
+    # Счётчики учитывают только доступных пользователей: пересоздаём триггеры с этим условием
+    for name in ('users_total_insert', 'users_total_delete', 'users_subscribed_insert', 'users_subscribed_update',
+                 'users_subscribed_delete', 'activity_buckets_insert', 'activity_buckets_update',
+                 'activity_buckets_delete'):
+        c.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    c.execute('''CREATE TRIGGER users_total_insert AFTER INSERT ON users
+                 WHEN NEW.unreachable = 0
+                 BEGIN
+                     UPDATE counters SET value = value + 1 WHERE name = 'users_total';
+                 END''')
+    c.execute('''CREATE TRIGGER users_total_update AFTER UPDATE OF unreachable ON users
+                 WHEN (OLD.unreachable = 0) != (NEW.unreachable = 0)
+                 BEGIN
+                     UPDATE counters SET value = value + (NEW.unreachable = 0) - (OLD.unreachable = 0)
+                     WHERE name = 'users_total';
+                 END''')
+    c.execute('''CREATE TRIGGER users_total_delete AFTER DELETE ON users
+                 WHEN OLD.unreachable = 0
+                 BEGIN
+                     UPDATE counters SET value = value - 1 WHERE name = 'users_total';
+                 END''')
+
+    c.execute('''CREATE TRIGGER users_subscribed_insert AFTER INSERT ON users
+                 WHEN NEW.is_subscribed = 1 AND NEW.unreachable = 0
+                 BEGIN
+                     UPDATE counters SET value = value + 1 WHERE name = 'users_subscribed';
+                 END''')
+    c.execute('''CREATE TRIGGER users_subscribed_update AFTER UPDATE OF is_subscribed, unreachable ON users
+                 WHEN (OLD.is_subscribed = 1 AND OLD.unreachable = 0) != (NEW.is_subscribed = 1 AND NEW.unreachable = 0)
+                 BEGIN
+                     UPDATE counters
+                     SET value = value + (NEW.is_subscribed = 1 AND NEW.unreachable = 0)
+                                       - (OLD.is_subscribed = 1 AND OLD.unreachable = 0)
+                     WHERE name = 'users_subscribed';
+                 END''')
+    c.execute('''CREATE TRIGGER users_subscribed_delete AFTER DELETE ON users
+                 WHEN OLD.is_subscribed = 1 AND OLD.unreachable = 0
+                 BEGIN
+                     UPDATE counters SET value = value - 1 WHERE name = 'users_subscribed';
+                 END''')
+
+    # Корзина пользователя: день последней активности, если он доступен, иначе NULL
+    c.execute('''CREATE TRIGGER activity_buckets_insert AFTER INSERT ON users
+                 WHEN NEW.last_activity IS NOT NULL AND NEW.unreachable = 0
+                 BEGIN
+                     INSERT INTO activity_buckets (day, users) VALUES (NEW.last_activity / 86400, 1)
+                     ON CONFLICT(day) DO UPDATE SET users = users + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER activity_buckets_update AFTER UPDATE OF last_activity, unreachable ON users
+                 WHEN CASE WHEN OLD.unreachable = 0 THEN OLD.last_activity / 86400 END
+                      IS NOT CASE WHEN NEW.unreachable = 0 THEN NEW.last_activity / 86400 END
+                 BEGIN
+                     UPDATE activity_buckets SET users = users - 1
+                     WHERE day = CASE WHEN OLD.unreachable = 0 THEN OLD.last_activity / 86400 END;
+                     INSERT INTO activity_buckets (day, users)
+                     SELECT NEW.last_activity / 86400, 1 WHERE NEW.last_activity IS NOT NULL AND NEW.unreachable = 0
+                     ON CONFLICT(day) DO UPDATE SET users = users + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER activity_buckets_delete AFTER DELETE ON users
+                 WHEN OLD.last_activity IS NOT NULL AND OLD.unreachable = 0
+                 BEGIN
+                     UPDATE activity_buckets SET users = users - 1 WHERE day = OLD.last_activity / 86400;
+                 END''')
+
+
+@migration(7, "state shared between worker processes")
+def _shared_state(c):
+    # Ключ-значение с необязательным временем истечения: кэши, дедупликация, блокировки, FSM
+    c.execute('''CREATE TABLE shared_state
+                 (key TEXT PRIMARY KEY,
+                  value TEXT NOT NULL,
+                  expires_at REAL) WITHOUT ROWID''')
+    c.execute('CREATE INDEX idx_shared_state_expires ON shared_state(expires_at) WHERE expires_at IS NOT NULL')
+    # Ограничители скорости (token bucket), общие для всех воркеров
+    c.execute('''CREATE TABLE rate_buckets
+                 (name TEXT PRIMARY KEY,
+                  tokens REAL NOT NULL,
+                  updated_at REAL NOT NULL,
+                  paused_until REAL NOT NULL DEFAULT 0) WITHOUT ROWID''')
+
+
+@migration(8, "user browser: keyset pagination and full-text search")
+def _user_browser(c):
+    # Страницы списка идут по (last_activity, user_id): idx_users_last_activity уже
+    # упорядочен по этой паре (rowid — последний столбец индекса). NULL сломал бы
+    # сравнение курсоров, поэтому у старых записей без активности берём время регистрации
+    c.execute('UPDATE users SET last_activity = COALESCE(joined_at, 0) WHERE last_activity IS NULL')
+
+    # Поиск по префиксам имени, username и ID. Таблица с внешним содержимым: текст
+    # хранится только в users, FTS держит индекс и обновляется триггерами.
+    # Префиксы до 4 символов индексируются отдельно: короткий запрос вроде «ив»
+    # не собирает совпадения со всех слов, начинающихся с него
+    c.execute('''CREATE VIRTUAL TABLE users_fts USING fts5
+                 (username, first_name, last_name, user_id,
+                  content='users', content_rowid='user_id', prefix='1 2 3 4')''')
+    c.execute('''CREATE TRIGGER users_fts_insert AFTER INSERT ON users
+                 BEGIN
+                     INSERT INTO users_fts (rowid, username, first_name, last_name, user_id)
+                     VALUES (NEW.user_id, NEW.username, NEW.first_name, NEW.last_name, NEW.user_id);
+                 END''')
+    c.execute('''CREATE TRIGGER users_fts_delete AFTER DELETE ON users
+                 BEGIN
+                     INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, user_id)
+                     VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name, OLD.last_name, OLD.user_id);
+                 END''')
+    # /start перезаписывает имя при каждом вызове: индекс трогаем, только если оно изменилось
+    c.execute('''CREATE TRIGGER users_fts_update AFTER UPDATE OF username, first_name, last_name ON users
+                 WHEN OLD.username IS NOT NEW.username
+                      OR OLD.first_name IS NOT NEW.first_name
+                      OR OLD.last_name IS NOT NEW.last_name
+                 BEGIN
+                     INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, user_id)
+                     VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name, OLD.last_name, OLD.user_id);
+                     INSERT INTO users_fts (rowid, username, first_name, last_name, user_id)
+                     VALUES (NEW.user_id, NEW.username, NEW.first_name, NEW.last_name, NEW.user_id);
+                 END''')
+    c.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+
+@migration(9, "stats rollups: hourly and daily events, subscription funnel")
+def _stats_rollups(c):
+    # События stats по часам и дням (UTC) для каждого действия. Заполняются
+    # Storage.rollup_stats порциями по id, сырые строки больше не сканируются
+    c.execute('''CREATE TABLE stats_hourly
+                 (hour INTEGER NOT NULL,
+                  action TEXT NOT NULL,
+                  events INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (hour, action)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE stats_daily
+                 (day INTEGER NOT NULL,
+                  action TEXT NOT NULL,
+                  events INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (day, action)) WITHOUT ROWID''')
+
+    # Воронка start → проверка подписки → подписка по когортам: день первого
+    # события пользователя. Каждый пользователь учитывается на каждом этапе
+    # один раз, поэтому когорты за любой период просто складываются
+    c.execute('''CREATE TABLE funnel_users
+                 (user_id INTEGER PRIMARY KEY,
+                  cohort_day INTEGER NOT NULL,
+                  checked INTEGER NOT NULL DEFAULT 0,
+                  subscribed INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''CREATE TABLE funnel_daily
+                 (day INTEGER PRIMARY KEY,
+                  started INTEGER NOT NULL DEFAULT 0,
+                  checked INTEGER NOT NULL DEFAULT 0,
+                  subscribed INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''CREATE TRIGGER funnel_users_insert AFTER INSERT ON funnel_users
+                 BEGIN
+                     INSERT INTO funnel_daily (day, started, checked, subscribed)
+                     VALUES (NEW.cohort_day, 1, NEW.checked, NEW.subscribed)
+                     ON CONFLICT(day) DO UPDATE SET started = started + 1,
+                                                    checked = checked + NEW.checked,
+                                                    subscribed = subscribed + NEW.subscribed;
+                 END''')
+    c.execute('''CREATE TRIGGER funnel_users_update AFTER UPDATE OF checked, subscribed ON funnel_users
+                 WHEN OLD.checked != NEW.checked OR OLD.subscribed != NEW.subscribed
+                 BEGIN
+                     UPDATE funnel_daily SET checked = checked + NEW.checked - OLD.checked,
+                                             subscribed = subscribed + NEW.subscribed - OLD.subscribed
+                     WHERE day = NEW.cohort_day;
+                 END''')
+
+    # Наибольший id stats, уже учтённый в сводках, и время последнего прохода.
+    # Историю сводки догоняют в фоне после запуска, а не внутри миграции
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('stats_rollup_id', 0)")
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('stats_rollup_at', 0)")
+
+
+@migration(10, "hourly activity buckets for rolling 24h / 7d / 30d windows")
+def _hourly_activity(c):
+    # Дневные корзины давали «с начала суток UTC»: сразу после полуночи активных
+    # за сутки было около нуля. Корзины по часу последней активности (час =
+    # last_activity / 3600) дают скользящие окна: сутки — последние 24 корзины
+    for name in ('activity_buckets_insert', 'activity_buckets_update', 'activity_buckets_delete'):
+        c.execute(f'DROP TRIGGER IF EXISTS {name}')
+    c.execute('DROP TABLE IF EXISTS activity_buckets')
+
+    c.execute('''CREATE TABLE activity_hours
+                 (hour INTEGER PRIMARY KEY,
+                  users INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''INSERT INTO activity_hours (hour, users)
+                 SELECT last_activity / 3600, COUNT(*) FROM users
+                 WHERE last_activity IS NOT NULL AND unreachable = 0 GROUP BY last_activity / 3600''')
+    c.execute('''CREATE TRIGGER activity_hours_insert AFTER INSERT ON users
+                 WHEN NEW.last_activity IS NOT NULL AND NEW.unreachable = 0
+                 BEGIN
+                     INSERT INTO activity_hours (hour, users) VALUES (NEW.last_activity / 3600, 1)
+                     ON CONFLICT(hour) DO UPDATE SET users = users + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER activity_hours_update AFTER UPDATE OF last_activity, unreachable ON users
+                 WHEN CASE WHEN OLD.unreachable = 0 THEN OLD.last_activity / 3600 END
+                      IS NOT CASE WHEN NEW.unreachable = 0 THEN NEW.last_activity / 3600 END
+                 BEGIN
+                     UPDATE activity_hours SET users = users - 1
+                     WHERE hour = CASE WHEN OLD.unreachable = 0 THEN OLD.last_activity / 3600 END;
+                     INSERT INTO activity_hours (hour, users)
+                     SELECT NEW.last_activity / 3600, 1 WHERE NEW.last_activity IS NOT NULL AND NEW.unreachable = 0
+                     ON CONFLICT(hour) DO UPDATE SET users = users + 1;
+                 END''')
+    c.execute('''CREATE TRIGGER activity_hours_delete AFTER DELETE ON users
+                 WHEN OLD.last_activity IS NOT NULL AND OLD.unreachable = 0
+                 BEGIN
+                     UPDATE activity_hours SET users = users - 1 WHERE hour = OLD.last_activity / 3600;
+                 END''')
+
+
+@migration(11, "user browser pages over reachable users")
+def _reachable_users_index(c):
+    # Список пользователей в админ-панели показывает тех же пользователей, что
+    # счётчик users_total, — без недоступных. Частичный индекс держит keyset-страницы
+    # обходом индекса без пропуска недоступных строк
+    c.execute('CREATE INDEX idx_users_reachable_activity ON users(last_activity) WHERE unreachable = 0')
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from aiogram.bot import api
+from aiogram.utils.exceptions import TerminatedByOtherGetUpdates
+
+from ingest import chat_key
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+POLLING_BATCH_SIZE = Histogram('bot_polling_batch_size', 'Размер пачки обновлений getUpdates',
+                               buckets=(1, 5, 10, 25, 50, 100))
+POLLING_BATCH_SECONDS = Histogram('bot_polling_batch_seconds', 'Время обработки пачки обновлений')
+POLLING_ERRORS = Counter('bot_polling_errors_total', 'Ошибки запросов getUpdates')
+
+
+class UpdatePoller:
+    """Получение обновлений через getUpdates вместо webhook.
+
+    Пачка до limit обновлений обрабатывается конкурентно: разные чаты
+    параллельно, обновления одного чата по порядку (как в UpdateQueue).
+    Offset, подтверждающий пачку, передаётся в следующий getUpdates только
+    после её обработки, поэтому при падении процесса пачка придёт заново.
+    active() — можно ли сейчас опрашивать (getUpdates допускает одного клиента).
+    """
+
+    def __init__(self, bot, process, limit=100, timeout=25, allowed_updates=None, active=None, idle_delay=1):
+        self.bot = bot
+        self.process = process
+        self.limit = limit
+        self.timeout = timeout
+        self.allowed_updates = allowed_updates
+        self.active = active
+        self.idle_delay = idle_delay
+        self.offset = None
+        self.batches = 0
+        self.updates = 0
+        self._task = None
+        self._stopping = False
+        self._processing = False
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        """Останавливает опрос: начатая пачка дорабатывается и подтверждается"""
+        self._stopping = True
+        if self._task is None:
+            return
+        # Ожидание getUpdates прерываем сразу, обработку пачки — нет
+        if not self._processing:
+            self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self.offset is not None:
+            # Telegram подтверждает пачку только следующим запросом с offset;
+            # полученное им обновление (не больше одного) останется неподтверждённым
+            try:
+                await self.bot.request(api.Methods.GET_UPDATES, {'offset': self.offset, 'limit': 1, 'timeout': 0})
+            except Exception as e:
+                logger.warning("POLLING: Не удалось подтвердить offset %s: %s", self.offset, e)
+
+    async def _get_updates(self):
+        payload = {'limit': self.limit, 'timeout': self.timeout}
+        if self.offset is not None:
+            payload['offset'] = self.offset
+        if self.allowed_updates is not None:
+            payload['allowed_updates'] = self.allowed_updates
+        # Сырые словари, как в webhook: ключ чата берётся без разбора в объекты aiogram
+        return await self.bot.request(api.Methods.GET_UPDATES, payload)
+
+    async def _process_chat(self, updates):
+        for data in updates:
+            try:
+                await self.process(data)
+            except Exception as e:
+                logger.exception("POLLING: Ошибка при обработке update_id=%s: %s: %s",
+                                 data.get('update_id'), type(e).__name__, e)
+
+    async def process_batch(self, batch):
+        by_chat = defaultdict(list)
+        for data in batch:
+            by_chat[chat_key(data)].append(data)
+        with POLLING_BATCH_SECONDS.time():
+            await asyncio.gather(*(self._process_chat(updates) for updates in by_chat.values()))
+
+    async def run(self):
+        logger.info("POLLING: Запуск getUpdates (limit=%s, timeout=%s)", self.limit, self.timeout)
+        delay = self.idle_delay
+        while not self._stopping:
+            if self.active is not None and not self.active():
+                await asyncio.sleep(self.idle_delay)
+                continue
+            try:
+                batch = await self._get_updates()
+            except TerminatedByOtherGetUpdates:
+                POLLING_ERRORS.inc()
+                logger.warning("POLLING: getUpdates уже вызывает другой процесс, повтор через %s сек", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            except Exception as e:
+                POLLING_ERRORS.inc()
+                logger.error("POLLING: Ошибка getUpdates: %s: %s, повтор через %s сек", type(e).__name__, e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = self.idle_delay
+            if not batch:
+                continue
+            POLLING_BATCH_SIZE.observe(len(batch))
+            self._processing = True
+            try:
+                await self.process_batch(batch)
+            finally:
+                self._processing = False
+            # Подтверждаем пачку только теперь: следующий getUpdates начнётся после неё
+            self.offset = batch[-1]['update_id'] + 1
+            self.batches += 1
+            self.updates += len(batch)
+
+    def stats(self):
+        return {
+            'offset': self.offset,
+            'batches': self.batches,
+            'updates': self.updates
+        }
@@ -0,0 +1,116 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Продлить блокировку, если она наша, или взять свободную
+_ACQUIRE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Token bucket в хэше: tokens, updated, paused (секунды по часам сервера Redis).
+# Возвращает время ожидания в секундах строкой (Lua-числа в ответе Redis усекаются до целых)
+_TAKE_TOKEN = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'paused')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+local paused = tonumber(state[3]) or 0
+if now < paused then
+    return tostring(paused - now)
+end
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= count then
+    tokens = tokens - count
+else
+    wait = (count - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+return tostring(wait)
+"""
+
+_PAUSE_BUCKET = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local paused = tonumber(redis.call('HGET', KEYS[1], 'paused')) or 0
+redis.call('HSET', KEYS[1], 'tokens', '0', 'updated', tostring(now),
+           'paused', tostring(math.max(paused, now + tonumber(ARGV[1]))))
+return 1
+"""
+
+
+class RedisState:
+    """Общее состояние воркеров в Redis (или совместимом сервере: KeyDB, Valkey и т.п.).
+
+    Тот же интерфейс, что у SQLite-реализации в Storage: значения с TTL,
+    блокировки с владельцем и общие token bucket. Блокировки и ограничители
+    выполняются Lua-скриптами, то есть атомарно на сервере.
+    """
+
+    def __init__(self, url, prefix="bot:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("Для REDIS_URL нужен пакет redis (pip install redis)")
+        self.prefix = prefix
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._acquire_lock = self._redis.register_script(_ACQUIRE_LOCK)
+        self._release_lock = self._redis.register_script(_RELEASE_LOCK)
+        self._take_token = self._redis.register_script(_TAKE_TOKEN)
+        self._pause_bucket = self._redis.register_script(_PAUSE_BUCKET)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    async def get_value(self, key):
+        return await self._redis.get(self._key(key))
+
+    async def set_value(self, key, value, ttl=None):
+        await self._redis.set(self._key(key), value, px=int(ttl * 1000) if ttl else None)
+
+    async def delete_value(self, key):
+        await self._redis.delete(self._key(key))
+
+    async def add_value(self, key, value, ttl=None):
+        """Записывает значение, только если ключа нет; True, если записали"""
+        return bool(await self._redis.set(self._key(key), value, nx=True, px=int(ttl * 1000) if ttl else None))
+
+    async def acquire_lock(self, name, owner, ttl):
+        """Берёт или продлевает блокировку name на ttl секунд; True, если она у owner"""
+        return bool(await self._acquire_lock(keys=[self._key(f"lock:{name}")], args=[owner, int(ttl * 1000)]))
+
+    async def release_lock(self, name, owner):
+        await self._release_lock(keys=[self._key(f"lock:{name}")], args=[owner])
+
+    async def take_token(self, name, rate, burst=1, count=1):
+        """Берёт count токенов из общего ограничителя name; 0, если взяли, иначе сколько секунд ждать"""
+        return float(await self._take_token(keys=[self._key(f"bucket:{name}")], args=[rate, burst, count]))
+
+    async def pause_bucket(self, name, seconds):
+        """Останавливает выдачу токенов name на seconds секунд (например, RetryAfter)"""
+        await self._pause_bucket(keys=[self._key(f"bucket:{name}")], args=[seconds])
+
+    async def purge_expired(self):
+        # Истёкшие ключи Redis удаляет сам
+        return 0
+
+    async def close(self):
+        await self._redis.aclose()
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_QUEUE_DEPTH = Gauge('bot_api_queue_depth', 'Запросы к Bot API, ожидающие отправки', ['priority'])
+SCHEDULER_WAIT_SECONDS = Histogram('bot_api_queue_wait_seconds', 'Ожидание отправки запроса к Bot API', ['priority'])
+SCHEDULER_RETRY_AFTER = Counter('bot_api_retry_after_total', 'Ответы RetryAfter от Bot API', ['priority'])
+
+# Методы, на которые распространяются лимиты Telegram на сообщения
+_LIMITED_PREFIXES = ('send', 'copy', 'forward', 'editMessage')
+
+
+def is_limited(method):
+    return method.startswith(_LIMITED_PREFIXES) and method != 'sendChatAction'
+
+
+class RequestScheduler:
+    """Очередь исходящих сообщений с приоритетами и лимитами Telegram.
+
+    priorities — классы от высшего к низшему. Запрос ждёт токен общего
+    ограничителя (global_rate в секунду) и токен своего чата (chat_rate в
+    секунду, допускается короткая серия до chat_burst). Первым отправляется
+    самый приоритетный запрос, чат которого готов; младшие классы получают
+    то, что осталось. После RetryAfter выдача останавливается целиком.
+
+    global_rate — доля этого процесса в общем лимите бота: у каждого воркера
+    gunicorn свой планировщик, и в сумме доли не должны превышать лимит
+    Telegram. Классы из unmetered не тратят токены global_rate: их общий
+    лимит на все воркеры держит собственный ограничитель (рассылки идут
+    через SharedTokenBucket), здесь они ждут только лимиты чата и RetryAfter.
+    """
+
+    def __init__(self, priorities, global_rate=30, chat_rate=1, chat_burst=3, max_chats=10000, unmetered=()):
+        self.priorities = list(priorities)
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.unmetered = frozenset(unmetered)
+        self._queues = {priority: deque() for priority in self.priorities}
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._chats = {}  # chat_id -> (tokens, updated)
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def acquire(self, priority, chat_id=None):
+        """Ждёт, пока запрос в чат chat_id можно отправить"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues[priority]
+        queue.append((chat_id, future))
+        SCHEDULER_QUEUE_DEPTH.labels(priority).set(len(queue))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        start = time.monotonic()
+        try:
+            await future
+        finally:
+            if not future.done() or future.cancelled():
+                # Отменённый запрос не должен занимать место в очереди
+                try:
+                    queue.remove((chat_id, future))
+                except ValueError:
+                    pass
+                SCHEDULER_QUEUE_DEPTH.labels(priority).set(len(queue))
+        SCHEDULER_WAIT_SECONDS.labels(priority).observe(time.monotonic() - start)
+
+    def pause(self, seconds, priority=None):
+        """Останавливает выдачу на seconds секунд (ответ RetryAfter)"""
+        if priority is not None:
+            SCHEDULER_RETRY_AFTER.labels(priority).inc()
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._wakeup.set()
+
+    def _chat_wait(self, chat_id, now):
+        """Сколько ждать токена чата (0 — можно отправлять)"""
+        if chat_id is None:
+            return 0.0
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.chat_rate
+
+    def _take_chat(self, chat_id, now):
+        if chat_id is None:
+            return
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        self._chats[chat_id] = (tokens - 1, now)
+        if len(self._chats) > self.max_chats:
+            # Чаты с полностью восстановленной серией ничем не отличаются от новых
+            full = self.chat_burst / self.chat_rate
+            self._chats = {chat: state for chat, state in self._chats.items() if now - state[1] < full}
+
+    def _pick(self, now, metered):
+        """Первый запрос наивысшего класса, чат которого готов; иначе время до готовности.
+
+        metered — есть ли токен общего ограничителя; без него выбираются
+        только классы из unmetered.
+        """
+        wait = None
+        for priority in self.priorities:
+            if not metered and priority not in self.unmetered:
+                continue
+            queue = self._queues[priority]
+            for item in queue:
+                chat_id, future = item
+                if future.done():
+                    continue
+                chat_wait = self._chat_wait(chat_id, now)
+                if chat_wait == 0:
+                    queue.remove(item)
+                    SCHEDULER_QUEUE_DEPTH.labels(priority).set(len(queue))
+                    return item, priority, None
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, None, wait
+
+    async def _run(self):
+        while self.depth:
+            self._wakeup.clear()
+            now = time.monotonic()
+            if now < self._paused_until:
+                await self._sleep(self._paused_until - now)
+                continue
+            self._tokens = min(1.0, self._tokens + (now - self._updated) * self.global_rate)
+            self._updated = now
+            token_wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.global_rate
+            item, priority, wait = self._pick(now, token_wait == 0)
+            if item is None:
+                # Все ожидающие упираются в лимиты своих чатов или в общий токен
+                if token_wait and any(self._queues[p] for p in self.priorities if p not in self.unmetered):
+                    wait = token_wait if wait is None else min(wait, token_wait)
+                await self._sleep(wait)
+                continue
+            chat_id, future = item
+            if priority not in self.unmetered:
+                self._tokens -= 1
+            self._take_chat(chat_id, now)
+            future.set_result(None)
+
+    async def _sleep(self, timeout):
+        """Спит timeout секунд или до нового запроса в очереди"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self):
+        return {
+            'depth': {priority: len(queue) for priority, queue in self._queues.items()},
+            'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 3),
+            'chats': len(self._chats)
+        }
@@ -0,0 +1,828 @@
+import asyncio
+import logging
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from export import dump_table
+from metrics import Counter, Histogram
+from migrations import apply_migrations
+
+logger = logging.getLogger(__name__)
+
+DB_OPERATION_SECONDS = Histogram('bot_db_operation_seconds',
+                                 'Время операций SQLite, включая ожидание пула потоков', ['operation'])
+DB_ERRORS = Counter('bot_db_errors_total', 'Операции SQLite, завершившиеся ошибкой', ['operation'])
+DB_COMMITS = Counter('bot_db_commits_total', 'Транзакции, зафиксированные соединением писателя', ['operation'])
+
+
+USER_COLUMNS = ('users.user_id, users.username, users.first_name, users.last_name, '
+                'users.is_subscribed, users.last_activity')
+# Больше любого user_id и времени: курсор первой страницы
+MAX_INT = 2 ** 63 - 1
+
+
+def fts_prefix_query(text):
+    """Запрос FTS5 «каждое слово — начало слова в записи» или None, если слов нет.
+
+    Слова берутся как последовательности букв и цифр (так же делит текст
+    токенизатор unicode61) и заключаются в кавычки, поэтому символы
+    синтаксиса FTS5 в запросе администратора ничего не значат.
+    """
+    words = re.findall(r'[^\W_]+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class Storage:
+    """Асинхронный доступ к SQLite: один писатель и N читателей в режиме WAL.
+
+    Все запросы выполняются в отдельных пулах потоков, поэтому event loop
+    aiohttp не блокируется на sqlite3. Соединения долгоживущие и
+    переиспользуются между вызовами.
+
+    Обновления last_activity и строки stats пишутся отложенно: они копятся
+    в памяти и сбрасываются одной транзакцией раз в flush_interval секунд
+    или при накоплении flush_max_rows записей.
+    """
+
+    def __init__(self, db_path, readers=4, flush_interval=0.2, flush_max_rows=500):
+        self.db_path = db_path
+        self.readers = readers
+        self.flush_interval = flush_interval
+        self.flush_max_rows = flush_max_rows
+        self._pending_activity = {}
+        self._pending_stats = []
+        self._flush_event = None
+        self._flush_task = None
+        self._reconcile_task = None
+        self._rollup_task = None
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._local = threading.local()
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+        self._write_executor = None
+        self._read_executor = None
+        self._export_executor = None
+        self._export_conns = set()
+
+    # --- Соединения и пулы потоков ---
+
+    def _connect(self, readonly=False):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        if readonly:
+            conn.execute('PRAGMA query_only=1')
+        return conn
+
+    def _writer_conn(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            return self._writer
+
+    def _reader_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(readonly=True)
+            self._local.conn = conn
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _executors(self):
+        if self._write_executor is None:
+            self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+            self._read_executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+        return self._write_executor, self._read_executor
+
+    def _call_write(self, fn, args):
+        conn = self._writer_conn()
+        with conn:
+            return fn(conn.cursor(), *args)
+
+    def _call_read(self, fn, args):
+        return fn(self._reader_conn().cursor(), *args)
+
+    def _call_export(self, fn, args):
+        # Своё соединение на время выгрузки: долгое чтение не занимает соединения читателей
+        conn = self._connect(readonly=True)
+        with self._reader_lock:
+            self._export_conns.add(conn)
+        try:
+            return fn(conn.cursor(), *args)
+        finally:
+            with self._reader_lock:
+                self._export_conns.discard(conn)
+            conn.close()
+
+    async def _run(self, executor, call, fn, args):
+        # Время и ошибки учитываются в корутине, то есть в потоке event loop
+        operation = fn.__name__.lstrip('_')
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, call, fn, args)
+        except Exception:
+            DB_ERRORS.labels(operation).inc()
+            raise
+        finally:
+            DB_OPERATION_SECONDS.labels(operation).observe(time.perf_counter() - start)
+
+    async def _write(self, fn, *args):
+        """Выполняет fn(cursor, *args) в транзакции на соединении писателя"""
+        write_executor, _ = self._executors()
+        result = await self._run(write_executor, self._call_write, fn, args)
+        DB_COMMITS.labels(fn.__name__.lstrip('_')).inc()
+        return result
+
+    async def _read(self, fn, *args):
+        """Выполняет fn(cursor, *args) на одном из соединений читателей"""
+        _, read_executor = self._executors()
+        return await self._run(read_executor, self._call_read, fn, args)
+
+    async def _export(self, fn, *args):
+        """Выполняет fn(cursor, *args) в потоке выгрузок на отдельном соединении для чтения.
+
+        Поток один: выгрузки идут по очереди и не занимают пул читателей,
+        которым отвечают обработчики обновлений.
+        """
+        if self._export_executor is None:
+            self._export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-export")
+        return await self._run(self._export_executor, self._call_export, fn, args)
+
+    # --- Жизненный цикл ---
+
+    def init_db(self):
+        """Применение миграций схемы. Вызывается синхронно до запуска event loop"""
+        logger.info("Инициализация БД: %s", self.db_path)
+        try:
+            conn = self._writer_conn()
+            apply_migrations(conn)
+
+            # Проверяем количество пользователей после инициализации
+            count = conn.execute("SELECT value FROM counters WHERE name = 'users_total'").fetchone()[0]
+            logger.info("БД инициализирована. Пользователей в БД: %s", count)
+        except Exception as e:
+            logger.error("Ошибка при инициализации БД: %s", e)
+            raise
+
+    async def close(self):
+        """Сбрасывает отложенные записи, останавливает пулы потоков и закрывает соединения"""
+        if self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+            try:
+                await self._reconcile_task
+            except asyncio.CancelledError:
+                pass
+            self._reconcile_task = None
+        if self._rollup_task is not None:
+            self._rollup_task.cancel()
+            try:
+                await self._rollup_task
+            except asyncio.CancelledError:
+                pass
+            self._rollup_task = None
+        await self.stop_flusher()
+        if self._write_executor is not None:
+            self._write_executor.shutdown(wait=True)
+            self._read_executor.shutdown(wait=True)
+            self._write_executor = None
+            self._read_executor = None
+        if self._export_executor is not None:
+            # Незаконченная выгрузка прерывается на ближайшей порции, а не держит остановку
+            with self._reader_lock:
+                for conn in self._export_conns:
+                    conn.interrupt()
+            self._export_executor.shutdown(wait=True)
+            self._export_executor = None
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns = []
+        self._local = threading.local()
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    # --- Пользователи ---
+
+    @staticmethod
+    def _add_user(c, user_id, username, first_name, last_name, language_code):
+        # Один запрос: вставка нового пользователя или обновление существующего.
+        # Счётчик users_total поддерживает триггер, поэтому COUNT(*) не нужен.
+        # Пользователь снова пишет боту — значит, он снова доступен для рассылок
+        now = int(time.time())
+        c.execute('''INSERT INTO users
+                     (user_id, username, first_name, last_name, language_code, joined_at, last_activity)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT(user_id) DO UPDATE SET
+                         last_activity = excluded.last_activity,
+                         username = excluded.username,
+                         first_name = excluded.first_name,
+                         last_name = excluded.last_name,
+                         unreachable = 0,
+                         unreachable_reason = NULL''',
+                  (user_id, username, first_name, last_name, language_code, now, now))
+
+    async def add_user(self, user_id, username, first_name, last_name, language_code):
+        logger.debug("ADD_USER: Добавление пользователя %s (%s %s)", user_id, first_name, last_name)
+        await self._write(self._add_user, user_id, username, first_name, last_name, language_code)
+
+    def update_user_activity(self, user_id):
+        """Ставит обновление last_activity в очередь; повторы по user_id схлопываются"""
+        self._pending_activity[user_id] = int(time.time())
+        self._schedule_flush()
+
+    @staticmethod
+    def _set_subscribed(c, user_id, is_subscribed):
+        value = 1 if is_subscribed else 0
+        c.execute('UPDATE users SET is_subscribed = ? WHERE user_id = ? AND is_subscribed IS NOT ?',
+                  (value, user_id, value))
+        return c.rowcount > 0
+
+    async def set_subscribed(self, user_id, is_subscribed):
+        """Записывает статус подписки; True, если он изменился"""
+        return await self._write(self._set_subscribed, user_id, is_subscribed)
+
+    def log_action(self, user_id, action):
+        """Ставит строку stats в очередь на запись"""
+        self._pending_stats.append((user_id, action, int(time.time())))
+        self._schedule_flush()
+
+    # --- Отложенная запись ---
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_event = asyncio.Event()
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+        if len(self._pending_activity) + len(self._pending_stats) >= self.flush_max_rows:
+            self._flush_event.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    @staticmethod
+    def _flush_batch(c, activity, stats):
+        if activity:
+            # Активность пользователя означает, что он снова доступен для рассылок
+            c.executemany('UPDATE users SET last_activity = ?, unreachable = 0, unreachable_reason = NULL '
+                          'WHERE user_id = ?',
+                          [(ts, user_id) for user_id, ts in activity.items()])
+        if stats:
+            c.executemany('INSERT INTO stats (user_id, action, timestamp) VALUES (?, ?, ?)', stats)
+
+    async def flush(self):
+        """Записывает накопленные обновления одной транзакцией"""
+        if not self._pending_activity and not self._pending_stats:
+            return
+        activity, self._pending_activity = self._pending_activity, {}
+        stats, self._pending_stats = self._pending_stats, []
+        try:
+            await self._write(self._flush_batch, activity, stats)
+        except Exception as e:
+            logger.error("FLUSH: Ошибка при записи %s обновлений активности и %s строк stats: %s",
+                         len(activity), len(stats), e)
+            # Транзакция откатилась целиком, возвращаем записи в очередь (новые значения важнее)
+            for user_id, ts in activity.items():
+                self._pending_activity.setdefault(user_id, ts)
+            self._pending_stats[:0] = stats
+
+    async def stop_flusher(self):
+        """Останавливает фоновый сброс и гарантированно записывает остаток"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+            self._flush_event = None
+        await self.flush()
+
+    # --- Чтение ---
+
+    @staticmethod
+    def _get_user_stats(c):
+        # Только материализованные счётчики: две строки counters и до 720 часовых корзин активности
+        hour = int(time.time()) // 3600
+        c.execute('''SELECT (SELECT value FROM counters WHERE name = 'users_total'),
+                            (SELECT value FROM counters WHERE name = 'users_subscribed'),
+                            (SELECT COALESCE(SUM(users), 0) FROM activity_hours WHERE hour >= ?),
+                            (SELECT COALESCE(SUM(users), 0) FROM activity_hours WHERE hour >= ?),
+                            (SELECT COALESCE(SUM(users), 0) FROM activity_hours WHERE hour >= ?)''',
+                  (hour - 24, hour - 7 * 24, hour - 30 * 24))
+        return c.fetchone()
+
+    async def get_user_stats(self):
+        """Счётчики для админ-панели.
+
+        Активность считается по часовым корзинам: active_today, active_week и
+        active_month — за последние 24 часа, 7 и 30 суток (с точностью до часа).
+        """
+        try:
+            logger.debug("Получение статистики из БД: %s", self.db_path)
+            stats = await self._read(self._get_user_stats)
+            logger.debug("Статистика получена: total=%s, subscribed=%s, active=%s", stats[0], stats[1], stats[2])
+            return {
+                'total_users': stats[0],
+                'subscribed_users': stats[1],
+                'active_today': stats[2],
+                'active_week': stats[3],
+                'active_month': stats[4]
+            }
+        except Exception as e:
+            logger.error("Ошибка при получении статистики: %s", e)
+            return {
+                'total_users': 0,
+                'subscribed_users': 0,
+                'active_today': 0,
+                'active_week': 0,
+                'active_month': 0
+            }
+
+    # --- Сверка счётчиков ---
+
+    @staticmethod
+    def _reconcile_counters(c):
+        # Пересчитываем всё с нуля внутри транзакции писателя и сравниваем с сохранённым
+        drift = {}
+        for name, query in (('users_total', 'SELECT COUNT(*) FROM users WHERE unreachable = 0'),
+                            ('users_subscribed', 'SELECT COUNT(*) FROM users WHERE is_subscribed = 1 AND unreachable = 0')):
+            actual = c.execute(query).fetchone()[0]
+            stored = c.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+            stored = stored[0] if stored else None
+            if stored != actual:
+                drift[name] = (stored, actual)
+                c.execute('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)', (name, actual))
+
+        actual = dict(c.execute('SELECT last_activity / 3600, COUNT(*) FROM users '
+                                'WHERE last_activity IS NOT NULL AND unreachable = 0 '
+                                'GROUP BY last_activity / 3600').fetchall())
+        stored = dict(c.execute('SELECT hour, users FROM activity_hours WHERE users != 0').fetchall())
+        if actual != stored:
+            hours = [hour for hour in set(actual) | set(stored) if actual.get(hour, 0) != stored.get(hour, 0)]
+            drift['activity_hours'] = {hour: (stored.get(hour, 0), actual.get(hour, 0)) for hour in hours}
+            c.execute('DELETE FROM activity_hours')
+            c.executemany('INSERT INTO activity_hours (hour, users) VALUES (?, ?)', actual.items())
+        return drift
+
+    async def reconcile_counters(self):
+        """Пересчитывает счётчики с нуля, исправляет расхождения и возвращает их"""
+        drift = await self._write(self._reconcile_counters)
+        if drift:
+            logger.warning("RECONCILE: Обнаружено расхождение счётчиков: %s", drift)
+        else:
+            logger.info("RECONCILE: Счётчики совпадают с данными")
+        return drift
+
+    def start_reconciler(self, interval):
+        """Запускает периодическую сверку счётчиков раз в interval секунд"""
+        if self._reconcile_task is None:
+            self._reconcile_task = asyncio.get_running_loop().create_task(self._reconcile_loop(interval))
+
+    async def _reconcile_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reconcile_counters()
+            except Exception as e:
+                logger.error("RECONCILE: Ошибка при сверке счётчиков: %s", e)
+            try:
+                purged = await self.purge_expired()
+                logger.info("RECONCILE: Удалено истёкших ключей общего состояния: %s", purged)
+            except Exception as e:
+                logger.error("RECONCILE: Ошибка при очистке общего состояния: %s", e)
+
+    # --- Сводки stats ---
+
+    @staticmethod
+    def _rollup_stats(c, batch):
+        # Первый оператор — запись: транзакция сразу берёт блокировку писателя, и
+        # курсор ниже читается уже под ней. Проходы из нескольких процессов идут
+        # по очереди и не учитывают одни и те же строки дважды
+        c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('stats_rollup_id', 0)")
+        last = c.execute("SELECT value FROM counters WHERE name = 'stats_rollup_id'").fetchone()[0]
+        newest = c.execute('SELECT COALESCE(MAX(id), 0) FROM stats').fetchone()[0]
+        upper = min(newest, last + batch)
+        if upper > last:
+            # id выдаёт единственный писатель в порядке фиксации, поэтому строк
+            # с id не больше upper, которые ещё не видны, не бывает
+            for table, bucket in (('stats_hourly', 'hour'), ('stats_daily', 'day')):
+                size = 3600 if bucket == 'hour' else 86400
+                c.execute(f'''INSERT INTO {table} ({bucket}, action, events)
+                              SELECT timestamp / {size}, action, COUNT(*) FROM stats
+                              WHERE id > ? AND id <= ? AND action IS NOT NULL
+                              GROUP BY timestamp / {size}, action
+                              ON CONFLICT({bucket}, action) DO UPDATE SET events = events + excluded.events''',
+                          (last, upper))
+            # Новые участники воронки попадают в когорту дня первого события,
+            # у известных только отмечаются пройденные этапы (см. триггеры funnel_users).
+            # «+action» не даёт планировщику взять idx_stats_action_ts вместо диапазона id:
+            # по индексу действия пришлось бы пройти все такие события за всю историю
+            c.execute('''INSERT INTO funnel_users (user_id, cohort_day, checked, subscribed)
+                         SELECT user_id, MIN(timestamp) / 86400,
+                                MAX(action = 'check_subscription'), MAX(action = 'subscribed')
+                         FROM stats
+                         WHERE id > ? AND id <= ? AND user_id IS NOT NULL
+                               AND +action IN ('start', 'check_subscription', 'subscribed')
+                         GROUP BY user_id
+                         ON CONFLICT(user_id) DO UPDATE
+                         SET checked = MAX(checked, excluded.checked), subscribed = MAX(subscribed, excluded.subscribed)
+                         WHERE excluded.checked > checked OR excluded.subscribed > subscribed''',
+                      (last, upper))
+            c.execute("UPDATE counters SET value = ? WHERE name = 'stats_rollup_id'", (upper,))
+        c.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('stats_rollup_at', ?)", (int(time.time()),))
+        return upper - last, newest - upper
+
+    async def rollup_stats(self, batch=50000):
+        """Добавляет новые строки stats в почасовые и дневные сводки и воронку.
+
+        Строки берутся порциями по id, каждая порция — отдельная транзакция
+        писателя, поэтому догоняющий проход по большой истории не задерживает
+        отложенную запись надолго. Возвращает число учтённых строк.
+        """
+        total = 0
+        while True:
+            rows, behind = await self._write(self._rollup_stats, batch)
+            total += rows
+            if not behind:
+                return total
+
+    def start_rollup(self, interval, batch=50000):
+        """Запускает сводку stats сразу и затем раз в interval секунд"""
+        if self._rollup_task is None:
+            self._rollup_task = asyncio.get_running_loop().create_task(self._rollup_loop(interval, batch))
+
+    async def _rollup_loop(self, interval, batch):
+        while True:
+            try:
+                start = time.perf_counter()
+                rows = await self.rollup_stats(batch)
+                if rows:
+                    logger.info("ROLLUP: Учтено строк stats: %s за %.2f сек", rows, time.perf_counter() - start)
+            except Exception as e:
+                logger.error("ROLLUP: Ошибка при сводке stats: %s", e)
+            await asyncio.sleep(interval)
+
+    @staticmethod
+    def _get_analytics(c, now):
+        hour, today = now // 3600, now // 86400
+        analytics = {'events_day': {}, 'events_week': {}, 'events_month': {}}
+        # Не больше 24 часовых и 30 дневных корзин на действие
+        for action, events in c.execute('SELECT action, SUM(events) FROM stats_hourly WHERE hour > ? GROUP BY action',
+                                        (hour - 24,)):
+            analytics['events_day'][action] = events
+        for action, week, month in c.execute('''SELECT action, SUM(CASE WHEN day > ? THEN events ELSE 0 END), SUM(events)
+                                                FROM stats_daily WHERE day > ? GROUP BY action''',
+                                             (today - 7, today - 30)):
+            analytics['events_week'][action] = week
+            analytics['events_month'][action] = month
+        for period, days in (('funnel_week', 7), ('funnel_month', 30)):
+            started, checked, subscribed = c.execute(
+                'SELECT COALESCE(SUM(started), 0), COALESCE(SUM(checked), 0), COALESCE(SUM(subscribed), 0) '
+                'FROM funnel_daily WHERE day > ?', (today - days,)).fetchone()
+            analytics[period] = {'started': started, 'checked': checked, 'subscribed': subscribed}
+        rollup_id, rollup_at = c.execute("SELECT (SELECT value FROM counters WHERE name = 'stats_rollup_id'), "
+                                         "(SELECT value FROM counters WHERE name = 'stats_rollup_at')").fetchone()
+        analytics['rollup_at'] = rollup_at
+        analytics['pending'] = c.execute('SELECT COALESCE(MAX(id), 0) FROM stats').fetchone()[0] - rollup_id
+        return analytics
+
+    async def get_analytics(self):
+        """События по действиям и воронка подписки из сводок, без чтения stats.
+
+        events_day — за последние 24 часа, events_week и events_month — за 7
+        и 30 календарных дней UTC включая сегодняшний (как активность в
+        get_user_stats). funnel_week и funnel_month — когорты пользователей,
+        впервые пришедших за эти дни: started, checked, subscribed.
+        pending — строки stats, ещё не попавшие в сводки.
+        """
+        return await self._read(self._get_analytics, int(time.time()))
+
+    @staticmethod
+    def _get_hourly_events(c, hours, now):
+        c.execute('SELECT hour, action, events FROM stats_hourly WHERE hour > ? ORDER BY hour',
+                  (now // 3600 - hours,))
+        return c.fetchall()
+
+    async def get_hourly_events(self, hours):
+        """(час, действие, событий) за последние hours часов, час — номер часа Unix (UTC)"""
+        return await self._read(self._get_hourly_events, hours, int(time.time()))
+
+    @staticmethod
+    def _count_users(c):
+        c.execute("SELECT value FROM counters WHERE name = 'users_total'")
+        return c.fetchone()[0]
+
+    async def count_users(self):
+        """Количество пользователей из счётчика users_total, за O(1)"""
+        return await self._read(self._count_users)
+
+    @staticmethod
+    def _get_raw_stats(c):
+        total, subs, active = Storage._get_user_stats(c)[:3]
+        c.execute("SELECT user_id, username, first_name, last_name, last_activity FROM users ORDER BY last_activity DESC LIMIT 10")
+        rows = c.fetchall()
+        return total, subs, active, rows
+
+    async def get_raw_stats(self):
+        """Данные для /stats_raw: счётчики и последние 10 пользователей"""
+        return await self._read(self._get_raw_stats)
+
+    @staticmethod
+    def _page(c, sql_forward, sql_backward, args, cursor, backward, limit):
+        # Берём на строку больше, чтобы узнать, есть ли что-то дальше в этом направлении
+        if backward:
+            c.execute(sql_backward, (*args, *cursor, limit + 1))
+        else:
+            c.execute(sql_forward, (*args, *cursor, limit + 1))
+        rows = c.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, more
+
+    @staticmethod
+    def _page_users(c, cursor, backward, limit):
+        # Keyset по (last_activity, user_id) через частичный idx_users_reachable_activity:
+        # любая страница стоит как первая, OFFSET не используется. Недоступных не
+        # показываем, как и в счётчике users_total в заголовке списка
+        if cursor is None:
+            cursor = (MAX_INT, MAX_INT)
+        return Storage._page(
+            c,
+            f'SELECT {USER_COLUMNS} FROM users WHERE unreachable = 0 AND (last_activity, user_id) < (?, ?) '
+            'ORDER BY last_activity DESC, user_id DESC LIMIT ?',
+            f'SELECT {USER_COLUMNS} FROM users WHERE unreachable = 0 AND (last_activity, user_id) > (?, ?) '
+            'ORDER BY last_activity ASC, user_id ASC LIMIT ?',
+            (), cursor, backward, limit)
+
+    async def page_users(self, limit, cursor=None, backward=False):
+        """Страница доступных пользователей от недавно активных к давним.
+
+        cursor — (last_activity, user_id) крайней строки соседней страницы:
+        без backward возвращаются строки после него, с backward — перед ним.
+        Результат — (строки, есть ли ещё страницы в этом направлении).
+        """
+        return await self._read(self._page_users, cursor, backward, limit)
+
+    @staticmethod
+    def _search_users(c, match, cursor, backward, limit):
+        # Keyset по rowid индекса FTS (= user_id): FTS5 отдаёт совпадения в порядке rowid,
+        # поэтому страница не требует сортировки всех совпадений
+        cursor = (MAX_INT if cursor is None else cursor,)
+        return Storage._page(
+            c,
+            f'SELECT {USER_COLUMNS} FROM users_fts JOIN users ON users.user_id = users_fts.rowid '
+            'WHERE users_fts MATCH ? AND users_fts.rowid < ? ORDER BY users_fts.rowid DESC LIMIT ?',
+            f'SELECT {USER_COLUMNS} FROM users_fts JOIN users ON users.user_id = users_fts.rowid '
+            'WHERE users_fts MATCH ? AND users_fts.rowid > ? ORDER BY users_fts.rowid ASC LIMIT ?',
+            (match,), cursor, backward, limit)
+
+    async def search_users(self, query, limit, cursor=None, backward=False):
+        """Поиск по началу слов username, имени, фамилии и ID; страницы по убыванию user_id.
+
+        cursor — user_id крайней строки соседней страницы, смысл backward и
+        результат как у page_users. Запрос без букв и цифр ничего не находит.
+        """
+        match = fts_prefix_query(query)
+        if match is None:
+            return [], False
+        return await self._read(self._search_users, match, cursor, backward, limit)
+
+    # --- Выгрузка ---
+
+    async def export_table(self, table, fmt, chunk_rows=5000, spool_size=4 * 2 ** 20):
+        """Таблица users или stats в gzip-файле CSV или JSONL: (файл, число строк).
+
+        Строки читаются порциями одним запросом, то есть из одного снимка
+        WAL; память не зависит от размера таблицы (см. export.dump_table).
+        Отложенные записи stats предварительно сбрасываются.
+        """
+        if table == 'stats':
+            await self.flush()
+        return await self._export(dump_table, table, fmt, chunk_rows, spool_size)
+
+    # --- Задания рассылки ---
+
+    @staticmethod
+    def _fetch_job(c, job_id):
+        c.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,))
+        row = c.fetchone()
+        return dict(zip([d[0] for d in c.description], row)) if row else None
+
+    @staticmethod
+    def _create_broadcast_job(c, from_chat_id, message_id, progress_chat_id, progress_message_id):
+        now = int(time.time())
+        c.execute("SELECT value FROM counters WHERE name = 'users_total'")
+        total = c.fetchone()[0]
+        c.execute('''INSERT INTO broadcast_jobs
+                     (from_chat_id, message_id, progress_chat_id, progress_message_id, status, total, created_at, updated_at)
+                     VALUES (?, ?, ?, ?, 'running', ?, ?, ?)''',
+                  (from_chat_id, message_id, progress_chat_id, progress_message_id, total, now, now))
+        return Storage._fetch_job(c, c.lastrowid)
+
+    async def create_broadcast_job(self, from_chat_id, message_id, progress_chat_id, progress_message_id):
+        """Создаёт задание рассылки со статусом running и возвращает его"""
+        return await self._write(self._create_broadcast_job, from_chat_id, message_id,
+                                 progress_chat_id, progress_message_id)
+
+    async def get_broadcast_job(self, job_id):
+        return await self._read(self._fetch_job, job_id)
+
+    @staticmethod
+    def _get_broadcast_jobs(c, statuses):
+        c.execute(f"SELECT id FROM broadcast_jobs WHERE status IN ({','.join('?' * len(statuses))}) ORDER BY id",
+                  statuses)
+        return [Storage._fetch_job(c, row[0]) for row in c.fetchall()]
+
+    async def get_broadcast_jobs(self, *statuses):
+        return await self._read(self._get_broadcast_jobs, statuses)
+
+    @staticmethod
+    def _set_broadcast_status(c, job_id, status):
+        c.execute('UPDATE broadcast_jobs SET status = ?, updated_at = ? WHERE id = ?',
+                  (status, int(time.time()), job_id))
+        if status == 'cancelled':
+            c.execute("UPDATE broadcast_deliveries SET status = 'skipped' WHERE job_id = ? AND status = 'pending'",
+                      (job_id,))
+
+    async def set_broadcast_status(self, job_id, status):
+        await self._write(self._set_broadcast_status, job_id, status)
+
+    @staticmethod
+    def _claim_broadcast_page(c, job_id, limit):
+        # Выбор страницы, запись получателей как pending и сдвиг курсора — одна транзакция
+        c.execute('SELECT cursor FROM broadcast_jobs WHERE id = ?', (job_id,))
+        cursor = c.fetchone()[0]
+        c.execute('SELECT user_id FROM users WHERE user_id > ? AND unreachable = 0 ORDER BY user_id LIMIT ?',
+                  (cursor, limit))
+        page = [row[0] for row in c.fetchall()]
+        if page:
+            c.executemany("INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id, status) VALUES (?, ?, 'pending')",
+                          [(job_id, user_id) for user_id in page])
+            c.execute('UPDATE broadcast_jobs SET cursor = ?, updated_at = ? WHERE id = ?',
+                      (page[-1], int(time.time()), job_id))
+        return page
+
+    async def claim_broadcast_page(self, job_id, limit):
+        """Берёт в работу следующую страницу получателей после курсора задания"""
+        return await self._write(self._claim_broadcast_page, job_id, limit)
+
+    @staticmethod
+    def _get_pending_deliveries(c, job_id, after, limit):
+        c.execute("SELECT user_id FROM broadcast_deliveries WHERE job_id = ? AND status = 'pending' AND user_id > ? "
+                  "ORDER BY user_id LIMIT ?", (job_id, after, limit))
+        return [row[0] for row in c.fetchall()]
+
+    async def get_pending_deliveries(self, job_id, after, limit):
+        """Получатели, взятые в работу, но не отправленные (после паузы или остановки)"""
+        return await self._read(self._get_pending_deliveries, job_id, after, limit)
+
+    @staticmethod
+    def _checkpoint_broadcast(c, job_id, outcomes):
+        c.executemany('UPDATE broadcast_deliveries SET status = ? WHERE job_id = ? AND user_id = ?',
+                      [(status, job_id, user_id) for user_id, status, _ in outcomes])
+        unreachable = [(reason, user_id) for user_id, status, reason in outcomes if status == 'unreachable']
+        if unreachable:
+            c.executemany('UPDATE users SET unreachable = 1, unreachable_reason = ? WHERE user_id = ?', unreachable)
+        sent = sum(1 for _, status, _ in outcomes if status == 'sent')
+        c.execute('''UPDATE broadcast_jobs
+                     SET sent = sent + ?, failed = failed + ?, unreachable = unreachable + ?, updated_at = ?
+                     WHERE id = ?''',
+                  (sent, len(outcomes) - sent, len(unreachable), int(time.time()), job_id))
+
+    async def checkpoint_broadcast(self, job_id, outcomes):
+        """Записывает пачку результатов [(user_id, status, reason)] одной транзакцией.
+
+        status — sent, failed (временная ошибка) или unreachable: такой
+        пользователь помечается в users и исключается из счётчиков и
+        следующих рассылок.
+        """
+        await self._write(self._checkpoint_broadcast, job_id, outcomes)
+
+    @staticmethod
+    def _recover_broadcast(c, job_id):
+        # Результат для pending неизвестен: сообщение могло уйти. Не повторяем, чтобы не было дублей
+        c.execute("UPDATE broadcast_deliveries SET status = 'unknown' WHERE job_id = ? AND status = 'pending'",
+                  (job_id,))
+        unknown = c.rowcount
+        c.execute('UPDATE broadcast_jobs SET failed = failed + ?, updated_at = ? WHERE id = ?',
+                  (unknown, int(time.time()), job_id))
+        return unknown
+
+    async def recover_broadcast(self, job_id):
+        """Подготовка задания, прерванного аварийно, к продолжению"""
+        return await self._write(self._recover_broadcast, job_id)
+
+    # --- Общее состояние воркеров ---
+    # Тот же интерфейс реализует RedisState (redis_state.py); время — wall clock,
+    # потому что строки видят все процессы
+
+    @staticmethod
+    def _get_value(c, key, now):
+        c.execute('SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                  (key, now))
+        row = c.fetchone()
+        return row[0] if row else None
+
+    async def get_value(self, key):
+        return await self._read(self._get_value, key, time.time())
+
+    @staticmethod
+    def _set_value(c, key, value, expires_at):
+        c.execute('''INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+                     ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at''',
+                  (key, value, expires_at))
+
+    async def set_value(self, key, value, ttl=None):
+        await self._write(self._set_value, key, value, time.time() + ttl if ttl else None)
+
+    @staticmethod
+    def _delete_value(c, key, owner):
+        if owner is None:
+            c.execute('DELETE FROM shared_state WHERE key = ?', (key,))
+        else:
+            c.execute('DELETE FROM shared_state WHERE key = ? AND value = ?', (key, owner))
+
+    async def delete_value(self, key):
+        await self._write(self._delete_value, key, None)
+
+    @staticmethod
+    def _add_value(c, key, value, now, expires_at, renew):
+        # Занимаем ключ, если его нет или он истёк; с renew — и если он уже наш
+        c.execute('''INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+                     ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                     WHERE shared_state.expires_at <= ? OR (? AND shared_state.value = excluded.value)''',
+                  (key, value, expires_at, now, renew))
+        return c.rowcount == 1
+
+    async def add_value(self, key, value, ttl=None):
+        """Записывает значение, только если ключа нет; True, если записали"""
+        now = time.time()
+        return await self._write(self._add_value, key, value, now, now + ttl if ttl else None, False)
+
+    async def acquire_lock(self, name, owner, ttl):
+        """Берёт или продлевает блокировку name на ttl секунд; True, если она у owner"""
+        now = time.time()
+        return await self._write(self._add_value, f"lock:{name}", owner, now, now + ttl, True)
+
+    async def release_lock(self, name, owner):
+        await self._write(self._delete_value, f"lock:{name}", owner)
+
+    @staticmethod
+    def _take_token(c, name, rate, burst, count, now):
+        c.execute('SELECT tokens, updated_at, paused_until FROM rate_buckets WHERE name = ?', (name,))
+        row = c.fetchone()
+        tokens, updated_at, paused_until = row if row else (burst, now, 0)
+        if now < paused_until:
+            return paused_until - now
+        tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+        wait = 0.0
+        if tokens >= count:
+            tokens -= count
+        else:
+            wait = (count - tokens) / rate
+        c.execute('''INSERT INTO rate_buckets (name, tokens, updated_at, paused_until) VALUES (?, ?, ?, 0)
+                     ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at''',
+                  (name, tokens, now))
+        return wait
+
+    async def take_token(self, name, rate, burst=1, count=1):
+        """Берёт count токенов из общего ограничителя name; 0, если взяли, иначе сколько секунд ждать"""
+        return await self._write(self._take_token, name, rate, burst, count, time.time())
+
+    @staticmethod
+    def _pause_bucket(c, name, until, now):
+        c.execute('''INSERT INTO rate_buckets (name, tokens, updated_at, paused_until) VALUES (?, 0, ?, ?)
+                     ON CONFLICT(name) DO UPDATE SET tokens = 0, updated_at = excluded.updated_at,
+                         paused_until = MAX(paused_until, excluded.paused_until)''',
+                  (name, now, until))
+
+    async def pause_bucket(self, name, seconds):
+        """Останавливает выдачу токенов name на seconds секунд (например, RetryAfter)"""
+        now = time.time()
+        await self._write(self._pause_bucket, name, now + seconds, now)
+
+    @staticmethod
+    def _purge_expired(c, now):
+        c.execute('DELETE FROM shared_state WHERE expires_at <= ?', (now,))
+        return c.rowcount
+
+    async def purge_expired(self):
+        """Удаляет истёкшие ключи общего состояния"""
+        return await self._write(self._purge_expired, time.time())
@@ -0,0 +1,33 @@
+import string
+
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils import json
+
+
+def keyboard(*rows):
+    """Inline-клавиатура из рядов InlineKeyboardButton, сериализованная в JSON один раз.
+
+    aiogram передаёт строку в reply_markup как есть, поэтому готовая
+    клавиатура не собирается и не сериализуется заново на каждый ответ.
+    Строка неизменяема, её можно держать в общей константе.
+    """
+    return json.dumps(InlineKeyboardMarkup(inline_keyboard=[list(row) for row in rows]).to_python())
+
+
+class Template:
+    """Текст ответа с подстановками {name}.
+
+    Разбирается при создании: ошибка в шаблоне видна при импорте, а не при
+    первом ответе. render() подставляет значения из словаря за один вызов
+    str.format_map, без промежуточных строк.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        # Только проверка синтаксиса: незакрытая скобка и т.п. падают здесь, при импорте
+        for _ in string.Formatter().parse(text):
+            pass
+        self.render = text.format_map
+
+    def __repr__(self):
+        return f"Template({self.text!r})"
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import types
+from aiogram.dispatcher.handler import Handler
+
+from callbacks import CallbackCodec, CallbackRouter
+from loop_watchdog import LoopWatchdog
+
+STALL = CallbackCodec('stall', {'seconds': float})
+
+
+def test_stall_in_routed_callback_is_blamed_on_route_handler():
+    router = CallbackRouter()
+
+    @router.route(STALL)
+    async def slow_button(callback, seconds):
+        time.sleep(seconds)
+
+    # Как в боте: aiogram вызывает router.dispatch, тот — обработчик маршрута
+    handler = Handler(None)
+    handler.register(router.dispatch)
+
+    async def main():
+        watchdog = LoopWatchdog(interval=0.02, threshold=0.05)
+        watchdog.start()
+        try:
+            await asyncio.sleep(0.1)
+            await handler.notify(types.CallbackQuery(id='1', data=STALL.pack(seconds=0.3)))
+            await asyncio.sleep(0.1)
+        finally:
+            watchdog.stop()
+        return watchdog.report()
+
+    offenders = asyncio.run(main())
+    assert offenders, "блокировка не замечена"
+    assert offenders[0]['handler'] == 'slow_button'
+    assert 'slow_button' in offenders[0]['location']